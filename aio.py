@@ -0,0 +1,1134 @@
+"""
+Asyncio execution mode: ASGI webhook, multiplexed RouterOS API client and async Bot API client
+Run with: uvicorn aio:app (or python aio.py)
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import ssl
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from routeros_api.exceptions import RouterOsApiCommunicationError
+
+from app import (
+    ADDRESS_LIST_PATH, ADMIN_KB, BLOCK_FILE_LIMIT, BLOCK_PIPELINE, BOT_TOKEN, BREAKER_MAX_BACKOFF, BREAKER_THRESHOLD,
+    CHECKLIST_SECTIONS, CHECKLIST_TIMEOUT, COMMAND_ERRORS, COMMAND_SECONDS, FILTER_PROPS, FLEET_TIMEOUT, IFACE_PROPS,
+    KB, LEASE_PATH, LEASE_PROPS, LOG_BUFFER, QUEUE_PROPS, RATE_PROBE_INTERVAL, RESOURCE_PROPS, ROUTEROS_ERRORS,
+    ROUTEROS_SECONDS, ROUTER_TIMEOUT, SNAPSHOT_DEFAULT_TTL, SNAPSHOT_TTLS, TELEGRAM_API_URL, TELEGRAM_ERRORS,
+    TELEGRAM_MAX_RETRIES, TELEGRAM_SECONDS, TERMINAL_DANGEROUS, TERMINAL_MAX_ROWS, UPDATE_DEDUP_WINDOW, Document,
+    LeaseIndex, LiveRequest, Paged, RouterDown, alerts, block_commands, commands, encode_sentence, fleet, format_bytes,
+    format_check_bandwidth, format_check_devices, format_check_services, format_check_system, format_checklist,
+    format_devices, format_firewall, format_logs, format_speed, format_status, format_terminal, format_top5,
+    format_traffic, history, instruments, is_admin, limiter, live, logger, merge_fleet, metric_path, monitoring_allowed,
+    pages, parse_block_request, parse_print_words, report_blocked, report_unblocked, split_text, start_background,
+    telegram,
+)
+
+AIO_CONCURRENCY = int(os.getenv('AIO_CONCURRENCY', '1000'))
+AIO_MAX_PENDING = int(os.getenv('AIO_MAX_PENDING', '10000'))
+AIO_TELEGRAM_CONNECTIONS = int(os.getenv('AIO_TELEGRAM_CONNECTIONS', '8'))
+AIO_BLOCKING_THREADS = int(os.getenv('AIO_BLOCKING_THREADS', '4'))
+
+# ============== RouterOS Word Protocol ==============
+async def read_length(reader):
+    first = (await reader.readexactly(1))[0]
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        return ((first & 0x3F) << 8) | (await reader.readexactly(1))[0]
+    if first < 0xE0:
+        return ((first & 0x1F) << 16) | int.from_bytes(await reader.readexactly(2), 'big')
+    if first < 0xF0:
+        return ((first & 0x0F) << 24) | int.from_bytes(await reader.readexactly(3), 'big')
+    return int.from_bytes(await reader.readexactly(4), 'big')
+
+async def read_sentence(reader):
+    """Words up to the empty terminator, decoded as UTF-8"""
+    words = []
+    while True:
+        n = await read_length(reader)
+        if n == 0:
+            return words
+        words.append((await reader.readexactly(n)).decode('utf-8', errors='replace'))
+
+# ============== Async Router Link ==============
+class AsyncRouterLink:
+    """One API connection per router; concurrent commands share it, told apart by .tag"""
+    def __init__(self, router, timeout=ROUTER_TIMEOUT):
+        self.router = router
+        self.timeout = timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.calls = 0
+        self.peak_in_flight = 0
+        self._reader = None
+        self._writer = None   # set once /login has succeeded
+        self._opening = None  # writer of a connection still logging in
+        self._last_read = 0.0
+        self._pending = {}   # tag -> (future, rows, trap, row limit)
+        self._tags = itertools.count(1)
+        self._connecting = None
+        self._entries = {}   # (path, variant) -> (expires, rows)
+        self._flights = {}   # (path, variant) -> future shared by concurrent prints
+        self._names = (None, None)
+
+    async def _ensure_connected(self):
+        if self._writer is not None:
+            return
+        if self.state == 'open' and time.monotonic() < self.retry_at:
+            raise RouterDown(f"{self.router.name} unreachable, retrying in {self.retry_at - time.monotonic():.0f}s")
+        # Callers arriving while a connection is being opened wait for that one
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+        connecting = self._connecting
+        try:
+            await asyncio.shield(connecting)
+        finally:
+            if self._connecting is connecting and connecting.done():
+                self._connecting = None
+
+    async def _connect(self):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.router.host, self.router.port), self.timeout)
+            self._opening = writer
+            asyncio.ensure_future(self._read_loop(reader, writer))
+            await self._send('/login', {'name': self.router.username or '', 'password': self.router.password or ''},
+                             writer=writer)
+            # Published only now: callers arriving during the login wait on _connecting
+            self._opening = None
+            self._reader, self._writer = reader, writer
+        except RouterOsApiCommunicationError as e:
+            self._close(e)
+            self._failure(e)
+            raise RouterDown(f"{self.router.name} login failed: {e}")
+        except (OSError, asyncio.TimeoutError, ConnectionError) as e:
+            self._close(e)
+            self._failure(e)
+            raise RouterDown(f"{self.router.name} unreachable: {e or 'timeout'}")
+
+    def _success(self):
+        # Only an answered command counts: a router may accept logins and then go silent
+        if self.state != 'closed':
+            logger.info(f"Router {self.router.name} reachable again")
+        self.state = 'closed'
+        self.failures = 0
+
+    def _failure(self, error):
+        self.failures += 1
+        self.last_error = str(error)[:120]
+        if self.failures >= BREAKER_THRESHOLD:
+            backoff = min(2 ** (self.failures - BREAKER_THRESHOLD), BREAKER_MAX_BACKOFF)
+            self.retry_at = time.monotonic() + backoff
+            if self.state != 'open':
+                logger.warning(f"Router {self.router.name} breaker open for {backoff:.0f}s: {error}")
+            self.state = 'open'
+
+    def _close(self, error):
+        """Drop the connection and fail every command still waiting on it"""
+        writer, self._reader, self._writer = self._writer, None, None
+        opening, self._opening = self._opening, None
+        for transport in (writer, opening):
+            if transport is not None:
+                transport.close()
+        pending, self._pending = self._pending, {}
+        for future, _, _, _ in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"connection lost: {error}"))
+
+    async def _read_loop(self, reader, writer):
+        """Route replies to the command that sent their tag"""
+        try:
+            while True:
+                words = await read_sentence(reader)
+                self._last_read = time.monotonic()
+                if not words:
+                    continue
+                kind, attrs, tag = words[0], {}, None
+                for word in words[1:]:
+                    if word.startswith('.tag='):
+                        tag = word[5:]
+                    elif word.startswith('='):
+                        key, _, value = word[1:].partition('=')
+                        # Same key as routeros_api hands out
+                        attrs['id' if key == '.id' else key] = value
+                if kind == '!fatal':
+                    raise ConnectionError(attrs.get('message', 'fatal'))
+                waiter = self._pending.get(tag)
+                if waiter is None:
+                    continue
+                future, rows, trap, limit = waiter
+                if kind == '!re':
+                    rows.append(attrs)
+                    if limit and len(rows) >= limit and not future.done():
+                        # Enough rows: answer now and stop the command on the router
+                        self._cancel(tag)
+                        future.set_result((rows, {}))
+                elif kind == '!trap':
+                    trap.append(attrs.get('message', 'trap'))
+                elif kind == '!done':
+                    del self._pending[tag]
+                    if future.done():
+                        continue
+                    if trap:
+                        future.set_exception(RouterOsApiCommunicationError(
+                            f"Error \"{trap[0]}\" executing command", trap[0].encode()))
+                    else:
+                        future.set_result((rows, attrs))
+        except Exception as e:
+            # Whatever ended the loop, nothing more will be read: fail every waiting command
+            if self._writer is writer:
+                self._close(e or 'closed')
+                self._failure(e or 'closed')
+            elif self._opening is writer:
+                # _connect counts the failed login
+                self._close(e or 'closed')
+
+    def _cancel(self, tag):
+        """Stop a command on the router; whatever it still sends is ignored"""
+        self._pending.pop(tag, None)
+        writer = self._writer or self._opening
+        if writer is not None:
+            writer.write(encode_sentence(['/cancel', f"=tag={tag}"]))
+
+    async def _send(self, command, attrs=None, queries=(), limit=None, writer=None):
+        tag = str(next(self._tags))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tag] = (future, [], [], limit)
+        self.peak_in_flight = max(self.peak_in_flight, len(self._pending))
+        words = [command]
+        words += [f"={key}={value}" for key, value in (attrs or {}).items()]
+        words += list(queries)
+        (writer or self._writer).write(encode_sentence(words + [f".tag={tag}"]))
+        sent = time.monotonic()
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            # Only this command gives up; the others sharing the connection keep waiting
+            self._cancel(tag)
+            if self._last_read < sent:
+                # Nothing at all read while it waited: the router is down, as a socket timeout
+                # is for RouterLink. Drop the connection, count the failure, reconnect next call
+                error = f"no reply within {self.timeout:.0f}s"
+                self._close(error)
+                self._failure(error)
+            raise RouterDown(f"{self.router.name} did not answer {command} within {self.timeout:.0f}s") from None
+
+    async def call(self, path, command, attrs=None, queries=(), limit=None):
+        """(rows, done attributes) of one command; a trap raises RouterOsApiCommunicationError
+
+        queries are raw query words such as '?disabled=false'. With a limit the command is
+        cancelled once that many rows have arrived, and only those are returned.
+        """
+        await self._ensure_connected()
+        labels = (self.router.name, metric_path(path), command)
+        self.calls += 1
+        started = time.monotonic()
+        try:
+            result = await self._send(f"{path.rstrip('/')}/{command}", attrs, queries, limit)
+        except RouterOsApiCommunicationError:
+            # A trap from the router still proves the connection works
+            self._success()
+            ROUTEROS_ERRORS.inc(*labels)
+            raise
+        except Exception:
+            ROUTEROS_ERRORS.inc(*labels)
+            raise
+        else:
+            self._success()
+            return result
+        finally:
+            ROUTEROS_SECONDS.observe(time.monotonic() - started, *labels)
+
+    async def print(self, path, where=None, props=None):
+        """Cached print with the same TTLs, filters and projections as Router.print"""
+        where = dict(where or {})
+        key = (path, (tuple(sorted(where.items())), tuple(props or ())))
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        flight = self._flights.get(key)
+        if flight is None:
+            args = {'.proplist': ','.join(props)} if props else {}
+            queries = [f"?{k}={v}" for k, v in where.items()]
+            flight = self._flights[key] = asyncio.ensure_future(self.call(path, 'print', args, queries))
+            flight.add_done_callback(lambda f: self._store(key, f))
+        rows, _ = await asyncio.shield(flight)
+        return rows
+
+    async def pipeline(self, path, commands, window=BLOCK_PIPELINE):
+        """Router.pipeline on this connection: a (done attributes, trap) pair per (command, args), in order"""
+        results = []
+        for start in range(0, len(commands), window):
+            batch = commands[start:start + window]
+            replies = await asyncio.gather(*(self.call(path, command, args) for command, args in batch),
+                                           return_exceptions=True)
+            for reply in replies:
+                if isinstance(reply, RouterOsApiCommunicationError):
+                    results.append(({}, reply))
+                elif isinstance(reply, BaseException):
+                    raise reply
+                else:
+                    results.append((reply[1], None))
+        return results
+
+    def invalidate(self, path):
+        """Forget cached prints of path after a change"""
+        for key in [key for key in self._entries if key[0] == path]:
+            del self._entries[key]
+
+    def _store(self, key, flight):
+        self._flights.pop(key, None)
+        if not flight.cancelled() and flight.exception() is None:
+            ttl = SNAPSHOT_TTLS.get(key[0], SNAPSHOT_DEFAULT_TTL)
+            self._entries[key] = (time.monotonic() + ttl, flight.result()[0])
+
+    async def lease_names(self):
+        """Lease index built from the cached lease print, rebuilt only when that print changes"""
+        rows = await self.print(LEASE_PATH, props=LEASE_PROPS)
+        if self._names[0] is not rows:
+            index = LeaseIndex(self.router)
+            index.load(rows)
+            self._names = (rows, index)
+        return self._names[1]
+
+    def close(self):
+        self._close('shutdown')
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'connected': self._writer is not None,
+            'calls': self.calls,
+            'in_flight': len(self._pending),
+            'peak_in_flight': self.peak_in_flight,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
+
+links = {name: AsyncRouterLink(router) for name, router in fleet.routers.items()}
+
+# ============== Async Telegram Client ==============
+class AsyncTelegram:
+    """Bot API client on asyncio streams: keep-alive HTTPS connections, the threaded client's rate limits, retries"""
+    def __init__(self, token, connections=AIO_TELEGRAM_CONNECTIONS, api_url=TELEGRAM_API_URL):
+        # Same endpoint as the threaded client, e.g. a local Bot API server at http://host:8081/prefix
+        url = urlsplit(api_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.host_header = url.netloc.rpartition('@')[2]
+        self.prefix = url.path.rstrip('/')
+        self.token = token
+        self.base_path = f"{self.prefix}/bot{token}"
+        self.connections = connections
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self._idle = []
+        self._slots = None
+        self._ssl = ssl.create_default_context() if url.scheme == 'https' else None
+
+    async def _open(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self._ssl), 10)
+
+    async def _exchange(self, reader, writer, verb, path, body):
+        """One request on an open connection; returns (status, body, keep_alive)"""
+        writer.write(
+            f"{verb} {path} HTTP/1.1\r\nHost: {self.host_header}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                data += await reader.readexactly(size)
+                await reader.readline()
+        else:
+            data = await reader.readexactly(int(headers.get('content-length', '0')))
+        return status, bytes(data), headers.get('connection', '').lower() != 'close'
+
+    async def _request(self, verb, path, body, timeout):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.connections)
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else None
+            try:
+                if conn:
+                    try:
+                        result = await asyncio.wait_for(self._exchange(*conn, verb, path, body), timeout)
+                    except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+                        # Telegram closed the idle connection; one fresh attempt
+                        conn[1].close()
+                        conn = None
+                if conn is None:
+                    conn = await self._open()
+                    result = await asyncio.wait_for(self._exchange(*conn, verb, path, body), timeout)
+            except BaseException:
+                if conn:
+                    conn[1].close()
+                raise
+            if result[2]:
+                self._idle.append(conn)
+            else:
+                conn[1].close()
+            return result[0], result[1]
+
+    async def call(self, method, payload=None, timeout=10):
+        """Call a Bot API method with rate limiting and retries; returns result or None"""
+        payload = payload or {}
+        chat_id = payload.get('chat_id')
+        started = time.monotonic()
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            # Same buckets as the threaded client, so both modes share Telegram's limits
+            if chat_id is not None:
+                await asyncio.sleep(telegram.chat_bucket(chat_id).reserve())
+            await asyncio.sleep(telegram.global_bucket.reserve())
+            retry_after = None
+            try:
+                status, data = await self._request('POST', f"{self.base_path}/{method}", json.dumps(payload).encode(),
+                                                   timeout)
+                if status == 429:
+                    self.throttled += 1
+                    retry_after = json.loads(data).get('parameters', {}).get('retry_after', 1)
+                elif status < 500:
+                    body = json.loads(data)
+                    if body.get('ok'):
+                        self.sent += 1
+                        TELEGRAM_SECONDS.observe(time.monotonic() - started, method)
+                        return body.get('result')
+                    self.failed += 1
+                    TELEGRAM_ERRORS.inc(method)
+                    logger.error(f"Telegram {method} rejected: {body.get('description')}")
+                    return None
+            except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                logger.warning(f"Telegram {method} error: {e}")
+            if attempt == TELEGRAM_MAX_RETRIES:
+                break
+            self.retries += 1
+            await asyncio.sleep(retry_after if retry_after is not None else min(2 ** attempt * 0.5, 30))
+        self.failed += 1
+        TELEGRAM_ERRORS.inc(method)
+        TELEGRAM_SECONDS.observe(time.monotonic() - started, method)
+        logger.error(f"Telegram {method} failed after {TELEGRAM_MAX_RETRIES} retries")
+        return None
+
+    async def download(self, file_id, limit):
+        """Text of a file sent to the bot, or None if it is missing or over limit bytes"""
+        info = await self.call('getFile', {'file_id': file_id})
+        if not info or 'file_path' not in info or info.get('file_size', 0) > limit:
+            return None
+        try:
+            status, data = await self._request('GET', f"{self.prefix}/file/bot{self.token}/{info['file_path']}", b'', 30)
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.error(f"Telegram file download error: {e}")
+            return None
+        if status != 200:
+            logger.error(f"Telegram file download error: HTTP {status}")
+            return None
+        return data[:limit].decode('utf-8', errors='replace')
+
+    async def send_message(self, chat_id, text, keyboard=None):
+        """Send text to chat_id, split into messages of Telegram's maximum length, in order"""
+        chunks = split_text(text)
+        for i, chunk in enumerate(chunks):
+            payload = {'chat_id': chat_id, 'text': chunk, 'parse_mode': 'HTML'}
+            if keyboard and i == len(chunks) - 1:
+                payload['reply_markup'] = keyboard
+            await self.call('sendMessage', payload)
+
+    async def edit_message(self, chat_id, message_id, text, keyboard=None):
+        payload = {'chat_id': chat_id, 'message_id': message_id, 'text': text, 'parse_mode': 'HTML'}
+        if keyboard:
+            payload['reply_markup'] = keyboard
+        await self.call('editMessageText', payload)
+
+    async def answer_callback(self, chat_id, query_id, text=None):
+        payload = {'callback_query_id': query_id}
+        if text:
+            payload['text'] = text
+        await self.call('answerCallbackQuery', payload)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    def stats(self):
+        done = self.sent + self.failed
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'success_rate': round(self.sent / done, 4) if done else 1.0,
+            'idle_connections': len(self._idle),
+        }
+
+atelegram = AsyncTelegram(BOT_TOKEN)
+
+async def send_reply(chat_id, reply, keyboard=None):
+    """Send a command reply, opening a cursor when it spans several pages"""
+    if isinstance(reply, LiveRequest):
+        # Live views run on their own stream thread and edit through the threaded client
+        return live.open(chat_id, reply)
+    if isinstance(reply, Document):
+        # Uploads are rare and large; the threaded client streams the file from disk
+        return telegram.send_document(chat_id, reply)
+    if not isinstance(reply, Paged):
+        return await atelegram.send_message(chat_id, reply, keyboard)
+    if reply.pages == 1:
+        return await atelegram.send_message(chat_id, reply.render(0), keyboard)
+    cursor = pages.open(chat_id, reply)
+    await atelegram.send_message(chat_id, reply.render(0), pages.keyboard(cursor, 0, reply.pages))
+
+# ============== Async Commands ==============
+rate_probes = {}   # router name -> lock held while probing its rates
+
+async def ensure_started(stream):
+    """RouterStream.ensure_started with the table printed over the async link"""
+    rows = None
+    if stream.needs_table():
+        rows = await links[stream.router.name].print(stream.path, stream.where, stream.props)
+    stream.ensure_started(rows)
+
+async def ensure_rates(router):
+    """MetricsSampler.ensure_rates with both probes read over the async link"""
+    if router.rates.age() <= max(router.metrics.interval * 2, RATE_PROBE_INTERVAL * 2):
+        return
+    link = links[router.name]
+
+    async def read(path, props):
+        # Uncached: the print cache would give the same counters twice
+        rows, _ = await link.call(path, 'print', {'.proplist': ','.join(props)})
+        return rows, time.time()
+
+    async with rate_probes.setdefault(router.name, asyncio.Lock()):
+        if router.rates.age() <= RATE_PROBE_INTERVAL * 2:
+            return
+        for probe in range(2):
+            if probe:
+                await asyncio.sleep(RATE_PROBE_INTERVAL)
+            (resource, _), ifaces, queues = await asyncio.gather(
+                read('/system/resource', RESOURCE_PROPS), read('/interface', IFACE_PROPS),
+                read('/queue/simple', QUEUE_PROPS))
+            router.metrics.ingest(resource[0], ifaces, queues)
+
+async def cmd_speed(chat_id, router=None):
+    """Get bandwidth usage with device names"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        link = links[router.name]
+        q, leases = await asyncio.gather(link.print('/queue/simple', props=QUEUE_PROPS), link.lease_names())
+        return format_speed(q, leases.name_for_target)
+    except Exception as e:
+        logger.error(f"Speed error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_devices(chat_id, router=None):
+    """Get DHCP devices"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        return format_devices(await links[router.name].print(LEASE_PATH, {'status': 'bound'}, LEASE_PROPS))
+    except Exception as e:
+        logger.error(f"Devices error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_status(chat_id, router=None):
+    """Get router status"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        return format_status((await links[router.name].print('/system/resource', props=RESOURCE_PROPS))[0])
+    except Exception as e:
+        logger.error(f"Status error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_firewall(chat_id, router=None):
+    """Show firewall rules"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    try:
+        return format_firewall(await links[router.name].print('/ip/firewall/filter', props=FILTER_PROPS))
+    except Exception as e:
+        logger.error(f"Firewall error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_top5(chat_id, router=None):
+    """Get top 5 consumers with device names"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        leases, _ = await asyncio.gather(links[router.name].lease_names(), ensure_rates(router))
+        return format_top5(router.rates, leases.name_for_target)
+    except Exception as e:
+        logger.error(f"Top5 error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_traffic(chat_id, router=None):
+    """Get interface traffic"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        await ensure_rates(router)
+        return format_traffic(router.rates)
+    except Exception as e:
+        logger.error(f"Traffic error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_live(chat_id, interface, seconds, router=None):
+    """Live bandwidth of one interface, updated in place"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        link = links[router.name]
+        if interface is None:
+            # Busiest interface by recent rate, else the first one listed
+            names = [r.name for r in router.rates.snapshot('iface')]
+            names = names or [i.get('name') for i in await link.print('/interface', props=IFACE_PROPS)]
+            if not names:
+                return "📈 No interfaces"
+            interface = names[0]
+        elif not await link.print('/interface', {'name': interface}, ('name',)):
+            return f"❌ Unknown interface: {interface}"
+        return LiveRequest(router, interface, seconds)
+    except Exception as e:
+        logger.error(f"Live error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_backup(chat_id, router=None):
+    """Create backup"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    try:
+        name = f"bot-{int(time.time())}"
+        await links[router.name].call('/system/backup', 'save', {'name': name})
+        logger.warning(f"Backup created by {chat_id}: {name}")
+        return f"✅ Backup: {name}.backup"
+    except Exception as e:
+        logger.error(f"Backup error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_logs(chat_id, router=None, topic=None, count=5):
+    """Get system logs, optionally for one topic, from the local log tail"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        await ensure_started(router.logs)
+        return format_logs(router.logs.tail(min(count, LOG_BUFFER), topic), topic)
+    except Exception as e:
+        logger.error(f"Logs error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_logs_topic(chat_id, topic, count):
+    """Logs of one topic on the default router"""
+    return await cmd_logs(chat_id, topic=topic, count=count)
+
+async def cmd_block(chat_id, args, router=None):
+    """Block IPs, CIDRs and ranges, optionally for timeout=<duration>"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    try:
+        entries, invalid, timeout = parse_block_request(args)
+        if not entries:
+            return "❌ Invalid IP" + (f": {', '.join(invalid[:5])}" if invalid else "")
+        await ensure_started(router.blocks)
+        new = [entry for entry in entries if entry not in router.blocks]
+        if not new and len(entries) == 1 and not invalid:
+            return f"ℹ️ {entries[0]} is already blocked"
+        link = links[router.name]
+        results = await link.pipeline(ADDRESS_LIST_PATH, block_commands(new, timeout))
+        link.invalidate(ADDRESS_LIST_PATH)
+        return report_blocked(chat_id, router, entries, new, results, timeout, invalid)
+    except Exception as e:
+        logger.error(f"Block error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_unblock(chat_id, args, router=None):
+    """Unblock IPs, CIDRs and ranges"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    try:
+        entries, invalid, _ = parse_block_request(args)
+        if not entries:
+            return "❌ Invalid IP" + (f": {', '.join(invalid[:5])}" if invalid else "")
+        await ensure_started(router.blocks)
+        found = [(entry, router.blocks.id_for(entry)) for entry in entries]
+        found = [(entry, entry_id) for entry, entry_id in found if entry_id]
+        if not found and len(entries) == 1 and not invalid:
+            return f"❌ {entries[0]} not found"
+        link = links[router.name]
+        results = await link.pipeline(ADDRESS_LIST_PATH, [('remove', {'.id': entry_id}) for _, entry_id in found])
+        link.invalidate(ADDRESS_LIST_PATH)
+        return report_unblocked(chat_id, router, entries, found, results, invalid)
+    except Exception as e:
+        logger.error(f"Unblock error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_terminal(chat_id, command, router=None):
+    """Execute terminal command on router"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    if any(cmd in command.lower() for cmd in TERMINAL_DANGEROUS):
+        logger.warning(f"Blocked dangerous command from {chat_id}: {command}")
+        return "🔒 Dangerous command blocked. Use WebFig for system changes."
+    parts = command.strip().split()
+    if not parts:
+        return "❌ Invalid command"
+    try:
+        path, action, props, queries = parse_print_words(parts)
+    except ValueError as e:
+        return f"❌ {e}"
+    if action != 'print':
+        return f"❌ Action '{action}' not supported. Use: /path/to/resource print"
+    try:
+        # Cancelled on the router after the rows shown: a full table belongs in terminal export
+        attrs = {'.proplist': ','.join(props)} if props else {}
+        rows, _ = await links[router.name].call(path, 'print', attrs, queries, limit=TERMINAL_MAX_ROWS + 1)
+        return format_terminal(path, rows)
+    except Exception as e:
+        return f"❌ Command error: {str(e)[:100]}"
+
+async def check_system(router):
+    """Checklist: CPU, memory, uptime and version"""
+    return format_check_system((await links[router.name].print('/system/resource', props=RESOURCE_PROPS))[0])
+
+async def check_devices(router):
+    """Checklist: bound DHCP leases, served from the lease index"""
+    return format_check_devices((await links[router.name].lease_names()).bound())
+
+async def check_bandwidth(router):
+    """Checklist: queue counts and the top consumer"""
+    link = links[router.name]
+    queues, leases = await asyncio.gather(link.print('/queue/simple', props=QUEUE_PROPS), link.lease_names())
+    return format_check_bandwidth(queues, leases.name_for_target)
+
+async def check_firewall(router):
+    """Checklist: filter rule count"""
+    rules = await links[router.name].print('/ip/firewall/filter', props=FILTER_PROPS)
+    return f"✅ Firewall Rules: {len(rules)} active\n"
+
+async def check_blocked(router):
+    """Checklist: blocked address count"""
+    await ensure_started(router.blocks)
+    return f"✅ Blocked IPs: {len(router.blocks)}\n"
+
+async def check_critical_logs(router):
+    """Checklist: critical log entries"""
+    await ensure_started(router.logs)
+    return f"✅ Critical Logs: {router.logs.count('critical')}\n"
+
+async def check_services(router):
+    """Checklist: enabled IP services"""
+    return format_check_services(await links[router.name].print('/ip/service', {'disabled': 'false'}, ('name', 'port')))
+
+# Same sections as the threaded checklist, by check name
+ASYNC_CHECKS = {check.__name__: check for check in (check_system, check_devices, check_bandwidth, check_firewall,
+                                                     check_blocked, check_critical_logs, check_services)}
+
+async def timed(check, router):
+    """Run check(router), returning (result, seconds)"""
+    started = time.monotonic()
+    result = await check(router)
+    return result, time.monotonic() - started
+
+async def cmd_daily_checklist(chat_id, router=None):
+    """Run daily monitoring checklist"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    try:
+        started = time.monotonic()
+        sections = [(title, [asyncio.ensure_future(timed(ASYNC_CHECKS[check.__name__], router)) for check in checks])
+                    for title, checks in CHECKLIST_SECTIONS]
+        tasks = [task for _, section in sections for task in section]
+        await asyncio.wait(tasks, timeout=CHECKLIST_TIMEOUT)
+        report = format_checklist(sections, started)
+        for task in tasks:
+            task.cancel()
+        return report
+    except Exception as e:
+        logger.error(f"Daily checklist error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+async def cmd_fleet(chat_id, fn, target, timeout=FLEET_TIMEOUT):
+    """Run a command on one router, or on every router concurrently"""
+    if target.lower() != 'all':
+        router = fleet.get(target)
+        if not router:
+            return f"❌ Unknown router: {target}\nKnown: {', '.join(fleet.routers) or 'none'}"
+        return await fn(chat_id, router)
+    tasks = OrderedDict((name, asyncio.ensure_future(fn(chat_id, router))) for name, router in fleet.routers.items())
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=timeout)
+    results = OrderedDict()
+    for name, task in tasks.items():
+        if not task.done():
+            task.cancel()
+            results[name] = f"⏱ No answer within {timeout:.0f}s"
+        elif task.exception():
+            results[name] = f"❌ Error: {str(task.exception())[:80]}"
+        else:
+            results[name] = task.result()
+    return merge_fleet(results)
+
+# Ported handlers by the name of the threaded handler they replace
+ASYNC_HANDLERS = {handler.__name__: handler for handler in (
+    cmd_speed, cmd_devices, cmd_status, cmd_top5, cmd_traffic, cmd_live, cmd_backup, cmd_logs, cmd_logs_topic,
+    cmd_firewall, cmd_block, cmd_unblock, cmd_terminal, cmd_daily_checklist)}
+# Threaded handlers that only read in-process state, safe to call on the loop
+INLINE_HANDLERS = {'cmd_help', 'cmd_alerts', 'cmd_routers', 'cmd_cpu_history', 'cmd_traffic_history',
+                   'cmd_top5_history'}
+
+# Everything else (talkers, terminal export, usage, seen, usage texts) blocks: a bounded pool of its own
+blocking_executor = ThreadPoolExecutor(max_workers=AIO_BLOCKING_THREADS, thread_name_prefix='aio-blocking')
+
+def async_handler(handler):
+    """Coroutine function standing in for a threaded handler"""
+    if handler.__name__ in ASYNC_HANDLERS:
+        return ASYNC_HANDLERS[handler.__name__]
+
+    async def run(*args):
+        if handler.__name__ in INLINE_HANDLERS:
+            return handler(*args)
+        return await asyncio.get_running_loop().run_in_executor(blocking_executor, handler, *args)
+    return run
+
+async def dispatch(chat_id, text):
+    """Run the command for text and return its reply, like CommandRegistry.dispatch"""
+    command, args = commands.resolve(text)
+    if command is None:
+        command = commands.exact['help']
+    if command.admin and not is_admin(chat_id):
+        return "🔒 Admin only"
+    if command.base:
+        fn = async_handler(command.base.handler)
+        handler = lambda chat_id, target: cmd_fleet(chat_id, fn, target)
+    else:
+        handler = async_handler(command.handler)
+    started = time.monotonic()
+    try:
+        return await handler(chat_id, *args)
+    except Exception:
+        COMMAND_ERRORS.inc(command.metric)
+        raise
+    finally:
+        COMMAND_SECONDS.observe(time.monotonic() - started, command.metric)
+
+# ============== Update Tasks ==============
+class AsyncUpdates:
+    """Runs each update as a task, in order within a chat, with a cap on how many run at once"""
+    def __init__(self, concurrency=AIO_CONCURRENCY, max_pending=AIO_MAX_PENDING, dedup_window=UPDATE_DEDUP_WINDOW):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.dedup_window = dedup_window
+        self.accepted = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.running = 0
+        self.peak_pending = 0
+        self._seen = OrderedDict()
+        self._tails = {}   # chat_id -> last task queued for that chat
+        self._tasks = set()
+        self._slots = None
+
+    def duplicate(self, update_id):
+        """True, and counted, for an update id already queued"""
+        if update_id is not None and update_id in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def submit(self, chat_id, update_id, job):
+        """Start job() after the chat's earlier jobs; returns 'queued', 'duplicate' or 'full'"""
+        if self.duplicate(update_id):
+            return 'duplicate'
+        if len(self._tasks) >= self.max_pending:
+            self.rejected += 1
+            return 'full'
+        if update_id is not None:
+            self._seen[update_id] = True
+            if len(self._seen) > self.dedup_window:
+                self._seen.popitem(last=False)
+        self.accepted += 1
+        task = asyncio.ensure_future(self._run(self._tails.get(chat_id), job))
+        self._tails[chat_id] = task
+        self._tasks.add(task)
+        self.peak_pending = max(self.peak_pending, len(self._tasks))
+        task.add_done_callback(lambda t: self._done(chat_id, t))
+        return 'queued'
+
+    async def _run(self, previous, job):
+        if previous is not None:
+            await asyncio.wait([previous])
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            self.running += 1
+            try:
+                await job()
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Update job failed: {e}")
+            finally:
+                self.running -= 1
+
+    def _done(self, chat_id, task):
+        self._tasks.discard(task)
+        if self._tails.get(chat_id) is task:
+            del self._tails[chat_id]
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def stats(self):
+        return {
+            'pending': len(self._tasks),
+            'peak_pending': self.peak_pending,
+            'running': self.running,
+            'accepted': self.accepted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'chats': len(self._tails),
+        }
+
+updates = AsyncUpdates()
+
+# ============== Handlers ==============
+async def handle_message(chat_id, text):
+    """Run a command and send the reply"""
+    try:
+        keyboard = ADMIN_KB if is_admin(chat_id) else KB
+        await send_reply(chat_id, await dispatch(chat_id, text), keyboard)
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        await atelegram.send_message(chat_id, "❌ Error occurred", KB)
+
+async def handle_document(chat_id, caption, document):
+    """Run block or unblock on the addresses in an attached text file"""
+    keyboard = ADMIN_KB if is_admin(chat_id) else KB
+    try:
+        command = caption.split()[0].lower().lstrip('/') if caption else ''
+        if command not in ('block', 'unblock'):
+            await atelegram.send_message(chat_id, "📎 Caption the file with block or unblock (optionally timeout=1h)",
+                                         keyboard)
+        elif not is_admin(chat_id):
+            await atelegram.send_message(chat_id, "🔒 Admin only", keyboard)
+        elif document.get('file_size', 0) > BLOCK_FILE_LIMIT:
+            await atelegram.send_message(chat_id, f"❌ File too large (max {format_bytes(BLOCK_FILE_LIMIT)})", keyboard)
+        else:
+            content = await atelegram.download(document['file_id'], BLOCK_FILE_LIMIT)
+            if content is None:
+                await atelegram.send_message(chat_id, "❌ Could not download the file", keyboard)
+            else:
+                await handle_message(chat_id, f"{caption} {content}")
+    except Exception as e:
+        logger.error(f"Document error: {e}")
+        await atelegram.send_message(chat_id, "❌ Error occurred", KB)
+
+async def run_limited(key, chat_id, text):
+    try:
+        await handle_message(chat_id, text)
+    finally:
+        limiter.release(key)
+
+async def handle_callback(chat_id, message_id, query_id, data):
+    """Inline buttons: turn the page of a paginated reply, or stop a live view"""
+    try:
+        if data == 'lv:stop':
+            stopped = live.stop(chat_id, message_id)
+            await atelegram.answer_callback(chat_id, query_id, None if stopped else "⌛ This live view already ended")
+            return
+        parts = data.split(':')
+        if len(parts) != 3 or parts[0] != 'pg' or not parts[2].isdigit():
+            await atelegram.answer_callback(chat_id, query_id)
+            return
+        _, cursor, page = parts
+        paged = pages.get(chat_id, cursor)
+        if paged is None:
+            await atelegram.answer_callback(chat_id, query_id, "⌛ This list expired, run the command again")
+            return
+        page = min(int(page), paged.pages - 1)
+        await atelegram.answer_callback(chat_id, query_id)
+        await atelegram.edit_message(chat_id, message_id, paged.render(page), pages.keyboard(cursor, page, paged.pages))
+    except Exception as e:
+        logger.error(f"Callback error: {e}")
+
+def accept(update):
+    """Validate and queue one update; returns the HTTP status for Telegram"""
+    if not isinstance(update, dict):
+        return 200
+    if updates.duplicate(update.get('update_id')):
+        # Before the limiter: a redelivered update must not spend the chat's tokens
+        return 200
+    key = None
+    if 'callback_query' in update:
+        query = update['callback_query']
+        msg = query.get('message') or {}
+        if 'chat' not in msg or 'data' not in query:
+            return 200
+        chat_id = msg['chat']['id']
+        job = lambda: handle_callback(chat_id, msg['message_id'], query['id'], query['data'])
+    elif 'message' in update:
+        msg = update['message']
+        if 'chat' not in msg or ('text' not in msg and 'document' not in msg):
+            return 200
+        chat_id = msg['chat']['id']
+        if 'document' in msg:
+            caption = msg.get('caption', '').strip()
+            logger.info(f"Document from {chat_id}: {caption}")
+            job = lambda: handle_document(chat_id, caption, msg['document'])
+        else:
+            text = msg['text'].strip()
+            logger.info(f"Message from {chat_id}: {text}")
+            key = limiter.admit(chat_id, text)
+            if key is None:
+                return 200
+            job = lambda: run_limited(key, chat_id, text)
+    else:
+        return 200
+
+    result = updates.submit(chat_id, update.get('update_id'), job)
+    if result != 'queued' and key:
+        limiter.release(key)
+    if result == 'full':
+        logger.warning(f"Update queue full, deferring update from {chat_id}")
+        return 503
+    return 200
+
+# ============== ASGI App ==============
+def health():
+    """Same shape as the Flask /health, with this mode's connections and tasks"""
+    down = [name for name, link in links.items() if link.state != 'closed']
+    return {
+        'status': 'degraded' if down else 'ok',
+        'mode': 'asyncio',
+        'routers_down': down,
+        'routers': {name: link.stats() for name, link in links.items()},
+        'updates': updates.stats(),
+        'telegram': atelegram.stats(),
+        'alerts': alerts.stats(),
+        'pages': pages.stats(),
+        'commands': commands.stats(),
+        'history': history.stats() if history else None,
+        'limiter': limiter.stats(),
+        'live': live.stats(),
+    }
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+async def respond(send, status, body, content_type='application/json'):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            start_background()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await updates.drain()
+            for link in links.values():
+                link.close()
+            atelegram.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """ASGI entry point: the webhook, /health and /metrics"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path == f"/{BOT_TOKEN}":
+        try:
+            update = json.loads(await read_body(receive))
+        except ValueError:
+            return await respond(send, 200, b'{"ok": false}')
+        status = accept(update)
+        return await respond(send, status, b'{"ok": true}' if status == 200 else b'{"ok": false}')
+    if method == 'GET' and path in ('/health', '/metrics'):
+        headers = dict(scope.get('headers', ()))
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        allowed = monitoring_allowed(headers.get(b'authorization', b'').decode('latin-1'), query.get('token', [''])[0])
+        if path == '/health':
+            report = health()
+            if not allowed:
+                report = {'status': report['status']}
+            return await respond(send, 200, json.dumps(report).encode())
+        if not allowed:
+            return await respond(send, 401, b'Unauthorized\n', 'text/plain; charset=utf-8')
+        return await respond(send, 200, instruments.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+    await respond(send, 404, b'{"ok": false}')
+
+# ============== Main ==============
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("The asyncio mode needs an ASGI server: pip install uvicorn")
+    port = int(os.getenv('PORT', 10000))
+    logger.info(f"🤖 Bot starting on port {port} (asyncio)")
+    uvicorn.run(app, host='0.0.0.0', port=port, log_level='info')
@@ -5,9 +5,46 @@ Webhook-based Flask bot for managing MikroTik RouterOS
 
 from flask import Flask, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import atexit
+import bisect
+import csv
+import fnmatch
+import gzip
+import heapq
+import hmac
+import io
+import ipaddress
+import json
+import random
+import sqlite3
 import logging
+import math
+import queue
+import re
+import socket
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait
 from routeros_api import RouterOsApiPool
+from shared_cache import CacheClient, SharedCacheError
+try:
+    # Columnar group-bys for the connection table (requirements.txt); pure Python without it
+    import numpy as np
+except ImportError:
+    np = None
+from routeros_api.exceptions import (
+    FatalRouterOsApiError,
+    RouterOsApiCommunicationError,
+    RouterOsApiConnectionError,
+    RouterOsApiFatalCommunicationError,
+)
 
 # ============== Configuration ==============
 app = Flask(__name__)
@@ -18,50 +55,1879 @@ ROUTER_HOST = os.getenv('ROUTER_HOST')
 ROUTER_PORT = int(os.getenv('ROUTER_PORT', '8728'))
 ROUTER_USER = os.getenv('ROUTER_USER')
 ROUTER_PASS = os.getenv('ROUTER_PASS')
+ROUTERS_FILE = os.getenv('ROUTERS_FILE')
+FLEET_TIMEOUT = float(os.getenv('FLEET_TIMEOUT', '8'))
+FLEET_WORKERS = int(os.getenv('FLEET_WORKERS', '16'))
+ROUTER_CONNECTIONS = int(os.getenv('ROUTER_CONNECTIONS', '3'))
+ROUTER_TIMEOUT = float(os.getenv('ROUTER_TIMEOUT', '10'))
+ROUTER_KEEPALIVE = float(os.getenv('ROUTER_KEEPALIVE', '30'))
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', '3'))
+BREAKER_MAX_BACKOFF = float(os.getenv('BREAKER_MAX_BACKOFF', '300'))
+CHECKLIST_WORKERS = int(os.getenv('CHECKLIST_WORKERS', '16'))
+CHECKLIST_TIMEOUT = float(os.getenv('CHECKLIST_TIMEOUT', '6'))
+SAMPLE_INTERVAL = float(os.getenv('SAMPLE_INTERVAL', '10'))
+SAMPLE_HISTORY = int(os.getenv('SAMPLE_HISTORY', str(24 * 3600)))
+QUEUE_HISTORY = int(os.getenv('QUEUE_HISTORY', '3600'))
+RATE_EWMA_ALPHA = float(os.getenv('RATE_EWMA_ALPHA', '0.3'))
+RATE_PROBE_INTERVAL = float(os.getenv('RATE_PROBE_INTERVAL', '1'))
+ALERT_RULES_FILE = os.getenv('ALERT_RULES_FILE')
+ALERT_COOLDOWN = float(os.getenv('ALERT_COOLDOWN', '600'))
 ADMIN_IDS = set(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else set()
+LEASE_RESYNC_INTERVAL = int(os.getenv('LEASE_RESYNC_INTERVAL', '300'))
+LOG_RESYNC_INTERVAL = int(os.getenv('LOG_RESYNC_INTERVAL', '60'))
+LOG_BUFFER = int(os.getenv('LOG_BUFFER', '1000'))
+HISTORY_DB = os.getenv('HISTORY_DB', '')
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '60'))
+HISTORY_MINUTE_DAYS = float(os.getenv('HISTORY_MINUTE_DAYS', '2'))
+HISTORY_HOUR_DAYS = float(os.getenv('HISTORY_HOUR_DAYS', '30'))
+HISTORY_DAY_DAYS = float(os.getenv('HISTORY_DAY_DAYS', '400'))
+BLOCK_RESYNC_INTERVAL = int(os.getenv('BLOCK_RESYNC_INTERVAL', '300'))
+BLOCK_PIPELINE = int(os.getenv('BLOCK_PIPELINE', '64'))
+BLOCK_FILE_LIMIT = int(os.getenv('BLOCK_FILE_LIMIT', str(1024 * 1024)))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '256'))
+UPDATE_DEDUP_WINDOW = int(os.getenv('UPDATE_DEDUP_WINDOW', '2048'))
+TELEGRAM_SEND_WORKERS = int(os.getenv('TELEGRAM_SEND_WORKERS', '4'))
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', str(20 / 60)))
+TELEGRAM_MAX_RETRIES = int(os.getenv('TELEGRAM_MAX_RETRIES', '5'))
+USER_RATE = float(os.getenv('USER_RATE', '0.5'))
+USER_BURST = float(os.getenv('USER_BURST', '5'))
+LIMITER_CHATS = int(os.getenv('LIMITER_CHATS', '10000'))
+LIMITER_INFLIGHT_TTL = int(os.getenv('LIMITER_INFLIGHT_TTL', '300'))
+BOT_MODE = os.getenv('BOT_MODE', 'webhook')
+POLL_OFFSET_FILE = os.getenv('POLL_OFFSET_FILE', 'poll_offset.json')
+POLL_BATCH = int(os.getenv('POLL_BATCH', '100'))
+POLL_TIMEOUT = int(os.getenv('POLL_TIMEOUT', '50'))
+SHARED_CACHE_SOCKET = os.getenv('SHARED_CACHE_SOCKET')
+LEADER_TTL = float(os.getenv('LEADER_TTL', '30'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+LIVE_DEFAULT_DURATION = int(os.getenv('LIVE_DEFAULT_DURATION', '60'))
+LIVE_MAX_DURATION = int(os.getenv('LIVE_MAX_DURATION', '600'))
+LIVE_EDIT_INTERVAL = float(os.getenv('LIVE_EDIT_INTERVAL', '3'))
+LIVE_MAX_VIEWS = int(os.getenv('LIVE_MAX_VIEWS', '50'))
+BULK_READ_CHUNK = int(os.getenv('BULK_READ_CHUNK', str(256 * 1024)))
+TERMINAL_MAX_ROWS = int(os.getenv('TERMINAL_MAX_ROWS', '100'))
+EXPORT_MAX_BYTES = int(os.getenv('EXPORT_MAX_BYTES', str(45 * 1024 * 1024)))
+PAGE_TTL = float(os.getenv('PAGE_TTL', '600'))
+PAGE_CURSORS = int(os.getenv('PAGE_CURSORS', '512'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# RouterOS API Pool
+# ============== Instrumentation ==============
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names, values):
+    """Prometheus label set, e.g. {path="/log",command="print"}"""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Histogram:
+    """Latency histogram per label set; observe() is one bisect and one short lock"""
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> per-bucket counts (last is +Inf), then sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def totals(self):
+        """(count, sum) per label set"""
+        with self._lock:
+            return {labels: (sum(series[:-1]), series[-1]) for labels, series in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_list = sorted((labels, list(series)) for labels, series in self._series.items())
+        bounds = [f"{b:g}" for b in self.buckets] + ['+Inf']
+        for labels, series in series_list:
+            count = 0
+            for bound, n in zip(bounds, series):
+                count += n
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + (bound,))} {count}")
+            label_text = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+class Counter:
+    """Monotonic counter per label set"""
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Collected:
+    """Values read from existing state at scrape time, so the hot path pays nothing"""
+    def __init__(self, name, help, kind, labels, collect):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        # collect() yields (label values, value)
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            for labels, value in self.collect():
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        except Exception as e:
+            logger.error(f"Metric {self.name} error: {e}")
+        return lines
+
+class Instruments:
+    """All metrics exposed on /metrics"""
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, labels=()):
+        return self._add(Histogram(name, help, labels))
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def collected(self, name, help, kind, labels, collect):
+        return self._add(Collected(name, help, kind, labels, collect))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+instruments = Instruments()
+COMMAND_SECONDS = instruments.histogram('bot_command_duration_seconds', 'Command handler latency', ('command',))
+COMMAND_ERRORS = instruments.counter('bot_command_errors_total', 'Command handlers that raised', ('command',))
+ROUTEROS_SECONDS = instruments.histogram('routeros_call_duration_seconds', 'RouterOS API call latency', ('router', 'path', 'command'))
+ROUTEROS_ERRORS = instruments.counter('routeros_call_errors_total', 'RouterOS API calls that trapped or failed', ('router', 'path', 'command'))
+TELEGRAM_SECONDS = instruments.histogram('telegram_request_duration_seconds', 'Bot API request latency including retries', ('method',))
+TELEGRAM_ERRORS = instruments.counter('telegram_request_errors_total', 'Bot API requests that were rejected or ran out of retries', ('method',))
+
+# ============== Snapshot Cache ==============
+# Seconds a print result stays fresh, per API path
+SNAPSHOT_TTLS = {
+    '/system/resource': 5,
+    '/interface': 5,
+    '/queue/simple': 5,
+    '/log': 10,
+    '/ip/dhcp-server/lease': 30,
+    '/ip/firewall/address-list': 30,
+    '/ip/firewall/filter': 60,
+    '/ip/service': 300,
+}
+SNAPSHOT_DEFAULT_TTL = float(os.getenv('SNAPSHOT_TTL', '10'))
+
+# Paths the bot itself uses; terminal commands can name any path, so the rest share one label
+METRIC_PATHS = frozenset(SNAPSHOT_TTLS) | {'/ip/firewall/connection', '/system/backup', '/system/identity'}
+
+def metric_path(path):
+    """Path label for the RouterOS call metrics: a known path, or 'other'"""
+    path = path.rstrip('/')
+    return path if path in METRIC_PATHS else 'other'
+
+class _Flight:
+    """In-flight fetch shared by concurrent callers"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SnapshotCache:
+    """TTL cache of RouterOS print results with single-flight fetches
+
+    With a shared cache, misses go to the daemon first, so workers on one host
+    fetch each snapshot from the router once between them.
+    """
+    def __init__(self, ttls=None, default_ttl=SNAPSHOT_DEFAULT_TTL, shared=None, namespace=''):
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.shared = shared
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.shared_hits = 0
+        self._entries = {}       # key -> (expires, rows, wall time fetched)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, fetch, variant=()):
+        """Return cached rows for (path, variant), calling fetch() at most once per expiry"""
+        key = (path, variant)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            flight = self._flights.get(key)
+            if flight:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                flight = self._flights[key] = _Flight()
+                leader = True
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            if self.shared:
+                flight.result, ttl, fetched_at = self._fetch_shared(key, fetch)
+            else:
+                flight.result, ttl, fetched_at = fetch(), self.ttls.get(path, self.default_ttl), time.time()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self._lock:
+                # Skip storing if invalidated while the fetch was running
+                if self._flights.get(key) is flight:
+                    self._entries[key] = (time.monotonic() + ttl, flight.result, fetched_at)
+            return flight.result
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+
+    def _shared_key(self, path, variant=None):
+        if variant is None:
+            # Prefix of every variant's key
+            return json.dumps([self.namespace, path])[:-1] + ','
+        return json.dumps([self.namespace, path, variant])
+
+    def _fetch_shared(self, key, fetch):
+        """(rows, ttl left, fetched at): another worker's snapshot, or fetched here and published"""
+        path, variant = key
+        ttl = self.ttls.get(path, self.default_ttl)
+        name = self._shared_key(path, variant)
+        try:
+            reply = self.shared.get(name, claim=ROUTER_TIMEOUT * 2)
+        except SharedCacheError as e:
+            logger.warning(f"{e}; fetching directly")
+            return fetch(), ttl, time.time()
+        if 'value' in reply:
+            self.shared_hits += 1
+            return reply['value']['rows'], reply['ttl'], reply['value']['at']
+        try:
+            rows = fetch()
+        except Exception:
+            try:
+                self.shared.release(name)
+            except SharedCacheError:
+                pass
+            raise
+        fetched_at = time.time()
+        try:
+            self.shared.put(name, {'at': fetched_at, 'rows': rows}, ttl)
+        except SharedCacheError as e:
+            logger.warning(f"{e}; snapshot not shared")
+        return rows, ttl, fetched_at
+
+    def fetched_at(self, path, variant=()):
+        """Wall time the cached rows for (path, variant) were read from the router"""
+        with self._lock:
+            entry = self._entries.get((path, variant))
+        return entry[2] if entry else None
+
+    def invalidate(self, path=None):
+        """Drop every cached variant of path (or everything)"""
+        if self.shared:
+            try:
+                self.shared.drop(self._shared_key(path) if path else json.dumps([self.namespace])[:-1])
+            except SharedCacheError as e:
+                logger.warning(f"{e}; other workers keep their snapshot until it expires")
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+                self._flights.clear()
+                return
+            for store in (self._entries, self._flights):
+                for key in [k for k in store if k[0] == path]:
+                    del store[key]
+
+    def stats(self):
+        """Hit/miss counters"""
+        total = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': round((self.hits + self.coalesced) / total, 3) if total else 0.0,
+            'shared_hits': self.shared_hits,
+            'entries': len(self._entries),
+        }
+
+shared_cache = CacheClient(SHARED_CACHE_SOCKET) if SHARED_CACHE_SOCKET else None
+
+class Leadership:
+    """Which worker on a host fires alerts and writes history; every worker when running alone"""
+    def __init__(self, shared, ttl=LEADER_TTL):
+        self.shared = shared
+        self.ttl = ttl
+        self.active = shared is None
+        self._thread = None
+
+    def start(self):
+        if self.shared is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='leader', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # The lease lapses unless renewed, so a dead leader is replaced within ttl
+        while True:
+            try:
+                granted = self.shared.lease('background', f"{socket.gethostname()}:{os.getpid()}", self.ttl)
+            except SharedCacheError as e:
+                logger.warning(f"{e}; background leadership unknown")
+                granted = False
+            if granted != self.active:
+                logger.info(f"Worker {os.getpid()} {'is now' if granted else 'is no longer'} the background leader")
+                self.active = granted
+            time.sleep(self.ttl / 3)
+
+    def stats(self):
+        return {'shared': self.shared is not None, 'active': self.active}
+
+leader = Leadership(shared_cache)
+
+# ============== Query Layer ==============
+# Column projections shared by handlers so they also share snapshots
+LEASE_PROPS = ('.id', 'address', 'mac-address', 'host-name', 'comment', 'status')
+QUEUE_PROPS = ('name', 'target', 'rate', 'bytes')
+RESOURCE_PROPS = ('cpu-load', 'uptime', 'total-memory', 'free-memory', 'version')
+IFACE_PROPS = ('name', 'rx-byte', 'tx-byte')
+LOG_PROPS = ('time', 'topics', 'message')
+FILTER_PROPS = ('action', 'protocol', 'comment')
+ADDRESS_LIST_PROPS = ('.id', 'list', 'address')
+
+# ============== Router Streams ==============
+def enable_keepalive(sock, idle=15, interval=5, count=3):
+    """Probe an idle connection so a read on a dead peer fails after about idle + interval * count seconds"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux names; elsewhere the system defaults apply, which take hours
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+class RouterStream:
+    """Local state loaded from one full print, then kept current from a streaming command"""
+    path = None
+    props = ()
+    command = 'listen'
+    command_args = {}
+    where = {}
+    kind = 'stream'
+    # Follow the shared snapshot instead of a stream per worker when a shared cache is set
+    shareable = False
+
+    def __init__(self, router, resync_interval):
+        self.router = router
+        self.resync_interval = resync_interval
+        self.streaming = False
+        self.resyncs = 0
+        self.events = 0
+        self._loaded = False
+        self._rows = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        """Replace local state with a full table"""
+        raise NotImplementedError
+
+    def apply(self, row):
+        """Apply one streamed row"""
+        raise NotImplementedError
+
+    def _reload(self, rows):
+        self.load(rows)
+        self._loaded = True
+        self.resyncs += 1
+
+    def needs_table(self):
+        """True when ensure_started() would print the table first"""
+        return not self._loaded or (self.shareable and self.router.cache.shared and self._thread is None)
+
+    def ensure_started(self, rows=None):
+        """Load the table on first use and start the streaming thread
+
+        rows is the table when the caller has printed it already, as the asyncio mode does.
+        """
+        if self.shareable and self.router.cache.shared and self._thread is None:
+            # Trails the router by up to the snapshot TTL; reloads only when the snapshot changes
+            if rows is None:
+                rows = self.router.print(self.path, self.where, self.props)
+            if rows is not self._rows:
+                self._rows = rows
+                self._reload(rows)
+            return
+        self.start_stream(rows)
+
+    def start_stream(self, rows=None):
+        """Load the table if needed and stream changes, even where the shared snapshot would do"""
+        if not self._loaded:
+            self._reload(rows if rows is not None else self.router.print(self.path, self.where, self.props))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f'{self.kind}-{self.router.name}', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        """Follow changes; resync the full table whenever the stream drops"""
+        # start_stream() has just loaded the table; a shared snapshot may be a TTL old
+        resync = self._rows is not None
+        args = dict(self.command_args)
+        if self.props:
+            args['.proplist'] = ','.join(self.props)
+        while True:
+            stream_pool = None
+            try:
+                stream_pool = self.router.open_pool()
+                api = stream_pool.get_api()
+                if resync:
+                    self._reload(api.get_resource(self.path).call('print', {'.proplist': ','.join(self.props)}, self.where))
+                # Idle streams are normal, so no read timeout; keepalive probes catch dead peers
+                stream_pool.set_timeout(None)
+                enable_keepalive(stream_pool.socket.socket)
+                self.streaming = True
+                for row in api.get_resource(self.path).call_async(self.command, args):
+                    self.events += 1
+                    self.apply(row)
+            except Exception as e:
+                logger.warning(f"{self.kind} stream dropped on {self.router.name}: {e}")
+            finally:
+                self.streaming = False
+                resync = True
+                if stream_pool:
+                    try:
+                        stream_pool.disconnect()
+                    except Exception:
+                        pass
+            time.sleep(self.resync_interval)
+
+    def stats(self):
+        return {
+            'streaming': self.streaming,
+            'events': self.events,
+            'resyncs': self.resyncs,
+        }
+
+# ============== Lease Index ==============
+LEASE_PATH = '/ip/dhcp-server/lease'
+
+def lease_name(lease):
+    """Display name for a DHCP lease: comment, then host name"""
+    return lease.get('comment', '').strip() or lease.get('host-name', '').strip()
+
+class LeaseIndex(RouterStream):
+    """DHCP leases indexed by IP and MAC, kept current from a listen stream"""
+    path = LEASE_PATH
+    props = LEASE_PROPS
+    kind = 'lease-index'
+    shareable = True
+
+    def __init__(self, router, resync_interval=LEASE_RESYNC_INTERVAL):
+        super().__init__(router, resync_interval)
+        self._by_id = {}
+        self._by_ip = {}
+        self._by_mac = {}
+
+    def load(self, rows):
+        """Replace the index with a full lease table"""
+        by_id, by_ip, by_mac = {}, {}, {}
+        for row in rows:
+            lease_id = row.get('id') or row.get('address')
+            by_id[lease_id] = row
+            if row.get('address'):
+                by_ip[row['address']] = lease_id
+            if row.get('mac-address'):
+                by_mac[row['mac-address'].upper()] = lease_id
+        with self._lock:
+            self._by_id, self._by_ip, self._by_mac = by_id, by_ip, by_mac
+
+    def apply(self, row):
+        """Apply one listen event (add, change or .dead removal)"""
+        lease_id = row.get('id')
+        if not lease_id:
+            return
+        with self._lock:
+            old = self._by_id.pop(lease_id, None)
+            if old:
+                if self._by_ip.get(old.get('address')) == lease_id:
+                    del self._by_ip[old['address']]
+                if self._by_mac.get(old.get('mac-address', '').upper()) == lease_id:
+                    del self._by_mac[old['mac-address'].upper()]
+            if row.get('.dead') == 'true':
+                return
+            self._by_id[lease_id] = row
+            if row.get('address'):
+                self._by_ip[row['address']] = lease_id
+            if row.get('mac-address'):
+                self._by_mac[row['mac-address'].upper()] = lease_id
+
+    def _get(self, index, key):
+        with self._lock:
+            return self._by_id.get(index.get(key))
+
+    def by_ip(self, ip):
+        """Lease row for an IP address"""
+        return self._get(self._by_ip, ip)
+
+    def by_mac(self, mac):
+        """Lease row for a MAC address"""
+        return self._get(self._by_mac, mac.upper())
+
+    def bound(self):
+        """Leases currently bound, in table order"""
+        with self._lock:
+            return [row for row in self._by_id.values() if row.get('status') == 'bound']
+
+    def name_for_ip(self, ip):
+        """Device name for an IP, or empty string"""
+        lease = self.by_ip(ip)
+        return lease_name(lease) if lease else ''
+
+    def name_for_target(self, target):
+        """Device name for a simple queue target such as 10.0.0.5/32"""
+        for part in target.split(','):
+            address, _, prefix = part.strip().partition('/')
+            if prefix in ('', '32'):
+                name = self.name_for_ip(address)
+                if name:
+                    return name
+        return ''
+
+    def stats(self):
+        """Index size and stream state"""
+        return dict(super().stats(), leases=len(self._by_id))
+
+# ============== Log Tail ==============
+class LogTail(RouterStream):
+    """Recent /log entries in a bounded ring with a per-topic index"""
+    path = '/log'
+    props = LOG_PROPS
+    command = 'print'
+    command_args = {'follow-only': ''}
+    kind = 'log-tail'
+
+    def __init__(self, router, size=LOG_BUFFER, resync_interval=LOG_RESYNC_INTERVAL):
+        super().__init__(router, resync_interval)
+        self.size = size
+        self._ring = deque()
+        self._topics = {}
+
+    def load(self, rows):
+        """Replace the ring with the newest entries of a full /log print"""
+        with self._lock:
+            self._ring.clear()
+            self._topics.clear()
+            for row in rows[-self.size:]:
+                self._append(row)
+
+    def apply(self, row):
+        with self._lock:
+            self._append(row)
+
+    def _append(self, row):
+        if len(self._ring) >= self.size:
+            # The evicted entry is also the oldest in each of its topic queues
+            _, old_topics = self._ring.popleft()
+            for topic in old_topics:
+                entries = self._topics[topic]
+                entries.popleft()
+                if not entries:
+                    del self._topics[topic]
+        topics = tuple(t for t in row.get('topics', '').lower().split(',') if t)
+        self._ring.append((row, topics))
+        for topic in topics:
+            self._topics.setdefault(topic, deque()).append(row)
+
+    def tail(self, count, topic=None):
+        """Newest count entries, optionally for one topic, oldest first"""
+        with self._lock:
+            if topic:
+                rows = list(islice(reversed(self._topics.get(topic, ())), count))
+            else:
+                rows = [row for row, _ in islice(reversed(self._ring), count)]
+        rows.reverse()
+        return rows
+
+    def count(self, topic):
+        """Buffered entries carrying topic"""
+        with self._lock:
+            return len(self._topics.get(topic, ()))
+
+    def topic_counts(self):
+        with self._lock:
+            return {topic: len(entries) for topic, entries in self._topics.items()}
+
+    def stats(self):
+        return dict(super().stats(), entries=len(self._ring), topics=len(self._topics))
+
+# ============== Block List ==============
+ADDRESS_LIST_PATH = '/ip/firewall/address-list'
+BLOCK_LIST = 'blocked'
+
+class BlockIndex(RouterStream):
+    """Entries of the blocked address list by address, kept current from a listen stream"""
+    path = ADDRESS_LIST_PATH
+    props = ADDRESS_LIST_PROPS
+    where = {'list': BLOCK_LIST}
+    kind = 'block-index'
+
+    def __init__(self, router, resync_interval=BLOCK_RESYNC_INTERVAL):
+        super().__init__(router, resync_interval)
+        self._by_address = {}
+        self._by_id = {}
+
+    def load(self, rows):
+        """Replace the index with the full blocked list"""
+        by_address, by_id = {}, {}
+        for row in rows:
+            if row.get('id') and row.get('address'):
+                by_address[row['address']] = row['id']
+                by_id[row['id']] = row['address']
+        with self._lock:
+            self._by_address, self._by_id = by_address, by_id
+
+    def apply(self, row):
+        """Apply one listen event; the stream covers every list, so others are dropped"""
+        entry_id = row.get('id')
+        if not entry_id:
+            return
+        with self._lock:
+            address = self._by_id.pop(entry_id, None)
+            if address and self._by_address.get(address) == entry_id:
+                del self._by_address[address]
+            if row.get('.dead') != 'true' and row.get('list') == BLOCK_LIST and row.get('address'):
+                self._by_address[row['address']] = entry_id
+                self._by_id[entry_id] = row['address']
+
+    def record(self, address, entry_id):
+        """Add an entry the bot has just written, ahead of its listen event"""
+        with self._lock:
+            self._by_address[address] = entry_id
+            if entry_id:
+                self._by_id[entry_id] = address
+
+    def forget(self, address):
+        """Drop an entry the bot has just removed"""
+        with self._lock:
+            self._by_id.pop(self._by_address.pop(address, None), None)
+
+    def id_for(self, address):
+        """RouterOS id of a blocked address, or None"""
+        with self._lock:
+            return self._by_address.get(address)
+
+    def __contains__(self, address):
+        with self._lock:
+            return address in self._by_address
+
+    def __len__(self):
+        return len(self._by_address)
+
+    def stats(self):
+        """Index size and stream state"""
+        return dict(super().stats(), addresses=len(self._by_address))
+
+# ============== Metrics History ==============
+class SampleRing:
+    """Fixed-capacity series sharing one time axis, stored in typed arrays"""
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self.times = array('d', [0.0]) * self.capacity
+        self.series = {}
+        self.head = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def append(self, t, values):
+        """Record one sample; series missing from values get NaN for this slot"""
+        with self._lock:
+            slot = self.head
+            self.times[slot] = t
+            for key, column in self.series.items():
+                column[slot] = values.get(key, math.nan)
+            for key, value in values.items():
+                if key not in self.series:
+                    column = self.series[key] = array('d', [math.nan]) * self.capacity
+                    column[slot] = value
+            self.head = (slot + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            if self.head == 0:
+                self._prune()
+
+    def _prune(self):
+        """Drop series with no data left in the ring (deleted queues, interfaces)"""
+        for key in [k for k, col in self.series.items() if all(math.isnan(v) for v in col)]:
+            del self.series[key]
+
+    def window(self, key, since):
+        """Values for key sampled at or after since"""
+        with self._lock:
+            column = self.series.get(key)
+            if column is None:
+                return []
+            values = []
+            slot = self.head
+            for _ in range(self.count):
+                slot = (slot - 1) % self.capacity
+                if self.times[slot] < since:
+                    break
+                if not math.isnan(column[slot]):
+                    values.append(column[slot])
+            return values
+
+    def keys(self, prefix=''):
+        with self._lock:
+            return [k for k in self.series if k.startswith(prefix)]
+
+    def nbytes(self):
+        return (len(self.series) + 1) * self.capacity * 8
+
+def summarize(values):
+    """min/avg/max/p95 of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        'min': ordered[0],
+        'avg': sum(ordered) / len(ordered),
+        'max': ordered[-1],
+        'p95': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+        'n': len(ordered),
+    }
+
+# Deltas implying more than this are counter resets, not wraps
+MAX_PLAUSIBLE_BPS = 400e9
+# A wrap may carry a counter at most this many times faster than its last rate
+WRAP_HEADROOM = 4
+
+def parse_uptime(text):
+    """RouterOS uptime like 1w2d03:04:05 or 2d3h4m5s to seconds"""
+    m = re.fullmatch(r'(?:(\d+)w)?(?:(\d+)d)?(?:(\d+):(\d+):(\d+)|(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?)(?:\d+ms)?', text or '')
+    if not m or not text:
+        return None
+    w, d, hh, mm, ss, h, mi, sec = (int(g) if g else 0 for g in m.groups())
+    return w * 604800 + d * 86400 + (hh + h) * 3600 + (mm + mi) * 60 + ss + sec
+
+class Rate:
+    """Current and EWMA-smoothed bits/s for one interface or queue"""
+    __slots__ = ('name', 'meta', 'rx', 'tx', 'rx_avg', 'tx_avg', 'at')
+
+    def __init__(self, name, meta, rx, tx, rx_avg, tx_avg, at):
+        self.name, self.meta = name, meta
+        self.rx, self.tx, self.rx_avg, self.tx_avg, self.at = rx, tx, rx_avg, tx_avg, at
+
+    @property
+    def total(self):
+        return self.rx + self.tx
+
+class RateEngine:
+    """Bits/s from byte-counter deltas, tolerant of counter wraps and reboots"""
+    def __init__(self, alpha=RATE_EWMA_ALPHA):
+        self.alpha = alpha
+        self.uptime = None
+        self.reboots = 0
+        self.wraps = 0
+        self.resets = 0
+        self.updated = 0.0
+        self._prev = {}
+        self._rates = {}
+        self._lock = threading.Lock()
+
+    def observe_uptime(self, uptime):
+        """Forget every previous counter when uptime goes backwards (reboot)"""
+        if uptime is None:
+            return
+        with self._lock:
+            if self.uptime is not None and uptime < self.uptime:
+                self.reboots += 1
+                self._prev.clear()
+            self.uptime = uptime
+
+    def _delta(self, old, new, dt, last_bps):
+        if new >= old:
+            return new - old
+        # A drop is a reset (counters cleared, queue re-created) unless the old value sat close
+        # enough to the width it fits in for the last known rate to have carried it over
+        width = 2 ** 32 if old < 2 ** 32 else 2 ** 64
+        room = min(last_bps * WRAP_HEADROOM, MAX_PLAUSIBLE_BPS) * dt / 8
+        d = new + width - old
+        if width - old > room or d > room:
+            self.resets += 1
+            return None
+        self.wraps += 1
+        return d
+
+    def update(self, key, t, counters, meta=None):
+        """Feed (rx_bytes, tx_bytes) sampled at t; returns (rx_bps, tx_bps) or None
+
+        Queue counters are (upload, download), so rx/tx read as up/down there.
+        """
+        with self._lock:
+            prev = self._prev.get(key)
+            self._prev[key] = (t, counters)
+            if not prev or t <= prev[0]:
+                return None
+            dt = t - prev[0]
+            old = self._rates.get(key)
+            last = (old.rx, old.tx) if old else (0, 0)
+            deltas = [self._delta(o, n, dt, b) for o, n, b in zip(prev[1], counters, last)]
+            if None in deltas:
+                return None
+            rx, tx = (d * 8 / dt for d in deltas)
+            if old:
+                rx_avg = self.alpha * rx + (1 - self.alpha) * old.rx_avg
+                tx_avg = self.alpha * tx + (1 - self.alpha) * old.tx_avg
+            else:
+                rx_avg, tx_avg = rx, tx
+            self._rates[key] = Rate(key.partition(':')[2], meta, rx, tx, rx_avg, tx_avg, t)
+            self.updated = t
+            return rx, tx
+
+    def snapshot(self, kind, key=lambda r: r.total):
+        """Latest rates of one kind ('iface' or 'queue'), highest first"""
+        prefix = kind + ':'
+        with self._lock:
+            rates = [r for k, r in self._rates.items() if k.startswith(prefix)]
+        if not rates:
+            return []
+        # Entries missing from the latest sample belong to removed interfaces/queues
+        latest = max(r.at for r in rates)
+        return sorted((r for r in rates if r.at >= latest - 1), key=key, reverse=True)
+
+    def age(self):
+        return time.time() - self.updated if self.updated else math.inf
+
+class MetricsSampler:
+    """Background poller of interface, queue and resource metrics for one router"""
+    def __init__(self, router, interval=SAMPLE_INTERVAL):
+        self.router = router
+        self.interval = interval
+        self.system = SampleRing(SAMPLE_HISTORY / interval if interval > 0 else 1)
+        self.queues = SampleRing(QUEUE_HISTORY / interval if interval > 0 else 1)
+        self.samples = 0
+        self.errors = 0
+        self.last_error = None
+        self._thread = None
+        self._probe_lock = threading.Lock()
+        self._lease_events = None
+        self._last_sample = None
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=f'sampler-{self.router.name}', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)[:120]
+                logger.warning(f"Sampler error on {self.router.name}: {e}")
+            time.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+    def read(self, fresh=False):
+        """Read resource, interface and queue counters into the rate engine; (system, queues, usage)"""
+        return self.ingest(self.router.sample_print('/system/resource', RESOURCE_PROPS, fresh)[0][0],
+                           self.router.sample_print('/interface', IFACE_PROPS, fresh),
+                           self.router.sample_print('/queue/simple', QUEUE_PROPS, fresh))
+
+    def ingest(self, resource, iface_rows, queue_rows):
+        """Feed a resource row and (rows, wall time read) of interfaces and queues to the rate engine"""
+        system = {}
+        rates = self.router.rates
+        rates.observe_uptime(parse_uptime(resource.get('uptime')))
+        system['cpu'] = float(resource.get('cpu-load', 0))
+        total = int(resource.get('total-memory', 0))
+        if total:
+            system['mem'] = (total - int(resource.get('free-memory', 0))) / total * 100
+
+        ifaces, read_at = iface_rows
+        for iface in ifaces:
+            name = iface.get('name', '?')
+            counters = (int(iface.get('rx-byte', 0)), int(iface.get('tx-byte', 0)))
+            bps = rates.update(f'iface:{name}', read_at, counters)
+            if bps:
+                system[f'{name}:rx'], system[f'{name}:tx'] = bps
+
+        queues = {}
+        usage = []
+        rows, read_at = queue_rows
+        for q in rows:
+            name = q.get('name', '?')
+            up, _, down = q.get('bytes', '0/0').partition('/')
+            try:
+                counters = (int(up), int(down or 0))
+            except ValueError:
+                continue
+            bps = rates.update(f'queue:{name}', read_at, counters, meta=q.get('target', ''))
+            if bps:
+                queues[f'{name}:up'], queues[f'{name}:down'] = bps
+                usage.append((name, q.get('target', ''), bps))
+        return system, queues, usage
+
+    def sample(self, fresh=False):
+        """Poll the router once and append to the rings"""
+        now = time.time()
+        system, queues, usage = self.read(fresh)
+
+        # DHCP churn: lease changes seen by the listen stream since the last sample. Only the
+        # leader streams leases when workers share snapshots; the others follow the snapshot
+        if leader.active:
+            try:
+                self.router.leases.start_stream()
+            except Exception as e:
+                logger.warning(f"Lease stream unavailable on {self.router.name}: {e}")
+        if self.router.leases.streaming:
+            events = self.router.leases.events
+            if self._lease_events is not None:
+                system['dhcp_events'] = events - self._lease_events
+            self._lease_events = events
+
+        self.system.append(now, system)
+        self.queues.append(now, queues)
+        self.samples += 1
+        if not leader.active:
+            # Another worker on this host records history and fires alerts
+            self._last_sample = None
+            return
+        if history and self._last_sample is not None:
+            history.record(self.router, now, now - self._last_sample, usage)
+        self._last_sample = now
+        alerts.evaluate(self.router, now, system)
+        if alerts.watches_queues:
+            alerts.evaluate(self.router, now, {f'queue:{k}': v for k, v in queues.items()})
+
+    def ensure_rates(self):
+        """Make sure the rate engine holds a recent sample, probing twice if not"""
+        if self.router.rates.age() <= max(self.interval * 2, RATE_PROBE_INTERVAL * 2):
+            return
+        with self._probe_lock:
+            if self.router.rates.age() <= RATE_PROBE_INTERVAL * 2:
+                return
+            # Two reads a second apart; a shared snapshot would give the same counters twice.
+            # Rates only: samples off schedule would skew the rings, history and alerts
+            self.read(fresh=True)
+            time.sleep(RATE_PROBE_INTERVAL)
+            self.read(fresh=True)
+
+    def stats(self):
+        return {
+            'running': self._thread is not None,
+            'samples': self.samples,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'series': len(self.system.series) + len(self.queues.series),
+            'bytes': self.system.nbytes() + self.queues.nbytes(),
+        }
+
+# ============== Alerts ==============
+DEFAULT_ALERT_RULES = [
+    {'name': 'High CPU', 'metric': 'cpu', 'above': 90, 'clear': 75, 'for': 3},
+    {'name': 'Low memory', 'metric': 'mem', 'above': 90, 'clear': 80, 'for': 3},
+    {'name': 'DHCP churn', 'metric': 'dhcp_events', 'above': 50, 'clear': 10, 'for': 2},
+]
+
+class AlertRule:
+    """Threshold or rate-of-change rule over one metric key or glob"""
+    __slots__ = ('name', 'metric', 'above', 'below', 'clear', 'sustain', 'cooldown', 'change', 'routers')
+
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.metric = spec['metric']
+        self.above = spec.get('above')
+        self.below = spec.get('below')
+        if (self.above is None) == (self.below is None):
+            raise ValueError(f"Alert rule {self.name}: set exactly one of above/below")
+        self.clear = spec.get('clear', self.above if self.above is not None else self.below)
+        self.sustain = int(spec.get('for', 1))
+        self.cooldown = float(spec.get('cooldown', ALERT_COOLDOWN))
+        # change: compare the per-minute rate of change instead of the value
+        self.change = bool(spec.get('change', False))
+        self.routers = set(spec['routers']) if spec.get('routers') else None
+
+    def breached(self, value):
+        return value > self.above if self.above is not None else value < self.below
+
+    def cleared(self, value):
+        return value <= self.clear if self.above is not None else value >= self.clear
+
+    def describe(self):
+        op, limit = ('>', self.above) if self.above is not None else ('<', self.below)
+        return f"{'Δ/min ' if self.change else ''}{op} {format_metric(self.metric, limit)}"
+
+def format_metric(key, value):
+    """Render a metric value by key type"""
+    if key.endswith((':rx', ':tx', ':up', ':down')):
+        return format_bits(value)
+    if key in ('cpu', 'mem'):
+        return f"{value:.0f}%"
+    return f"{value:g}"
+
+def load_alert_rules():
+    """Rules from ALERT_RULES_FILE, or the defaults"""
+    if ALERT_RULES_FILE:
+        with open(ALERT_RULES_FILE) as f:
+            specs = json.load(f)
+        logger.info(f"Loaded {len(specs)} alert rules from {ALERT_RULES_FILE}")
+    else:
+        specs = DEFAULT_ALERT_RULES
+    return [AlertRule(spec) for spec in specs]
+
+class AlertEngine:
+    """Evaluates rules against each sample with hysteresis, pushing changes to admins"""
+    def __init__(self, rules):
+        self.exact = {}
+        self.globs = []
+        for rule in rules:
+            if any(c in rule.metric for c in '*?['):
+                self.globs.append(rule)
+            else:
+                self.exact.setdefault(rule.metric, []).append(rule)
+        self.rules = rules
+        self.watches_queues = any(r.metric.startswith('queue:') for r in rules)
+        self.sent = 0
+        self._matches = {}
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def rules_for(self, key):
+        """Rules watching key; glob matching is done once per key"""
+        rules = self._matches.get(key)
+        if rules is None:
+            rules = self.exact.get(key, []) + [r for r in self.globs if fnmatch.fnmatchcase(key, r.metric)]
+            self._matches[key] = rules
+        return rules
+
+    def evaluate(self, router, t, values):
+        """Check one sample; only keys with rules cost more than a dict lookup"""
+        events = []
+        with self._lock:
+            for key, value in values.items():
+                for rule in self.rules_for(key):
+                    if rule.routers and router.name not in rule.routers:
+                        continue
+                    event = self._step(rule, router.name, key, t, value)
+                    if event:
+                        events.append(event)
+        for event in events:
+            self.notify(event)
+
+    def _step(self, rule, router_name, key, t, value):
+        state = self._state.setdefault((rule.name, router_name, key), {'active': False, 'count': 0, 'prev': None, 'fired': -math.inf})
+        if rule.change:
+            prev, state['prev'] = state['prev'], (t, value)
+            if not prev or t <= prev[0]:
+                return None
+            value = (value - prev[1]) / (t - prev[0]) * 60
+        if not state['active']:
+            state['count'] = state['count'] + 1 if rule.breached(value) else 0
+            if state['count'] >= rule.sustain and t - state['fired'] >= rule.cooldown:
+                state['active'] = True
+                state['fired'] = t
+                return f"🚨 [{router_name}] {rule.name}: {key} = {format_metric(key, value)} ({rule.describe()})"
+        elif rule.cleared(value):
+            state['active'] = False
+            state['count'] = 0
+            return f"✅ [{router_name}] {rule.name} resolved: {key} = {format_metric(key, value)}"
+        return None
+
+    def notify(self, text):
+        logger.warning(f"Alert: {text}")
+        self.sent += 1
+        for admin_id in ADMIN_IDS:
+            send_message(admin_id, text)
+
+    def active(self):
+        with self._lock:
+            return [key for key, state in self._state.items() if state['active']]
+
+    def stats(self):
+        return {'rules': len(self.rules), 'active': len(self.active()), 'sent': self.sent}
+
 try:
-    pool = RouterOsApiPool(
-        ROUTER_HOST,
-        username=ROUTER_USER,
-        password=ROUTER_PASS,
-        port=ROUTER_PORT,
-        use_ssl=False,
-        plaintext_login=True
-    )
-    logger.info("RouterOS API initialized")
+    alerts = AlertEngine(load_alert_rules())
 except Exception as e:
-    logger.error(f"RouterOS API error: {e}")
-    pool = None
-
-# ============== Keyboards ==============
-KB = {
-    'keyboard': [
-        [{'text': '📊 Speed'}, {'text': '📱 Devices'}],
-        [{'text': '⚙️ Status'}, {'text': '🔥 Top5'}],
-        [{'text': '🗂️ Backup'}, {'text': '📝 Logs'}],
-        [{'text': '📈 Traffic'}, {'text': '❓ Help'}]
-    ],
-    'resize_keyboard': True
-}
+    logger.error(f"Alert rules error: {e}")
+    alerts = AlertEngine([])
 
-ADMIN_KB = {
-    'keyboard': [
-        [{'text': '📊 Speed'}, {'text': '📱 Devices'}],
-        [{'text': '⚙️ Status'}, {'text': '🔥 Top5'}],
-        [{'text': '🗂️ Backup'}, {'text': '📝 Logs'}],
-        [{'text': '📈 Traffic'}, {'text': '🚫 Firewall'}],
-        [{'text': '🔒 Block IP'}, {'text': '✅ Unblock IP'}],
-        [{'text': '💻 Terminal'}, {'text': '📋 Checklist'}],
-        [{'text': '❓ Help'}]
-    ],
-    'resize_keyboard': True
-}
+# ============== History Store ==============
+# Usage is kept at three resolutions; each bucket is retained for its own number of days
+USAGE_SPANS = ((60, HISTORY_MINUTE_DAYS), (3600, HISTORY_HOUR_DAYS), (86400, HISTORY_DAY_DAYS))
+MAC_RE = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}$')
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    router TEXT NOT NULL,
+    device TEXT NOT NULL,
+    span INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    rx INTEGER NOT NULL,
+    tx INTEGER NOT NULL,
+    PRIMARY KEY (router, device, span, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS usage_age ON usage (span, bucket);
+CREATE TABLE IF NOT EXISTS devices (
+    router TEXT NOT NULL,
+    device TEXT NOT NULL,
+    mac TEXT,
+    ip TEXT,
+    name TEXT,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    PRIMARY KEY (router, device)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS devices_mac ON devices (mac);
+CREATE INDEX IF NOT EXISTS devices_ip ON devices (ip);
+CREATE INDEX IF NOT EXISTS devices_name ON devices (name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS sessions (
+    router TEXT NOT NULL,
+    mac TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_mac ON sessions (router, mac, end);
+"""
+
+class HistoryStore:
+    """SQLite (WAL) store of per-device usage and presence, written in batches"""
+    def __init__(self, path, flush_interval=HISTORY_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        # A device seen again within this gap continues its previous session
+        self.session_gap = max(flush_interval * 3, 300)
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_error = None
+        self.flush_ms = None
+        self._usage = {}     # (router, device, minute) -> [rx, tx]
+        self._devices = {}   # (router, device) -> [mac, ip, name, first_seen, last_seen]
+        self._presence = {}  # (router, mac) -> last seen
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self._writer = self._connect()
+        self._writer.executescript(HISTORY_SCHEMA)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def reopen(self):
+        """New connections for a forked worker; SQLite handles must not cross fork"""
+        self._writer = self._connect()
+        self._local = threading.local()
+        self._thread = None
+
+    def _reader(self):
+        """Per-thread read connection; WAL lets reads run beside the writer"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def record(self, router, now, seconds, queues):
+        """Add one sample: queues is [(name, target, (up bps, down bps))] over the last seconds"""
+        router.leases.ensure_started()
+        minute = int(now) // 60 * 60
+        bound = router.leases.bound()
+        with self._lock:
+            for name, target, (up, down) in queues:
+                lease = None
+                for part in target.split(','):
+                    lease = router.leases.by_ip(part.strip().partition('/')[0])
+                    if lease:
+                        break
+                if lease and lease.get('mac-address'):
+                    device = lease['mac-address'].upper()
+                    self._see(router.name, device, device, lease.get('address'), lease_name(lease) or name, now)
+                else:
+                    device = f"queue:{name}"
+                    self._see(router.name, device, None, None, name, now)
+                totals = self._usage.setdefault((router.name, device, minute), [0, 0])
+                # Queue "up" is the device sending, "down" the device receiving
+                totals[0] += int(down * seconds / 8)
+                totals[1] += int(up * seconds / 8)
+            for lease in bound:
+                mac = lease.get('mac-address', '').upper()
+                if mac:
+                    self._see(router.name, mac, mac, lease.get('address'), lease_name(lease), now)
+                    self._presence[(router.name, mac)] = int(now)
+
+    def _see(self, router_name, device, mac, ip, name, now):
+        entry = self._devices.get((router_name, device))
+        if entry is None:
+            self._devices[(router_name, device)] = [mac, ip, name, int(now), int(now)]
+        else:
+            entry[1] = ip or entry[1]
+            entry[2] = name or entry[2]
+            entry[4] = int(now)
+
+    def flush(self):
+        """Write buffered samples in one transaction, then apply retention"""
+        with self._lock:
+            usage, self._usage = self._usage, {}
+            devices, self._devices = self._devices, {}
+            presence, self._presence = self._presence, {}
+        if not (usage or devices or presence):
+            return
+        started = time.monotonic()
+        now = int(time.time())
+        try:
+            with self._writer as db:
+                rows = [(router_name, device, span, minute // span * span, rx, tx)
+                        for (router_name, device, minute), (rx, tx) in usage.items()
+                        for span, _ in USAGE_SPANS]
+                db.executemany(
+                    'INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (router, device, span, bucket) DO UPDATE SET rx = rx + excluded.rx, tx = tx + excluded.tx',
+                    rows)
+                db.executemany(
+                    'INSERT INTO devices VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (router, device) DO UPDATE SET '
+                    'ip = coalesce(excluded.ip, ip), name = coalesce(nullif(excluded.name, \'\'), name), last_seen = excluded.last_seen',
+                    [(router_name, device, *entry) for (router_name, device), entry in devices.items()])
+                for (router_name, mac), seen in presence.items():
+                    extended = db.execute(
+                        'UPDATE sessions SET end = ? WHERE router = ? AND mac = ? AND end >= ?',
+                        (seen, router_name, mac, seen - self.session_gap)).rowcount
+                    if not extended:
+                        db.execute('INSERT INTO sessions VALUES (?, ?, ?, ?)', (router_name, mac, seen, seen))
+                for span, days in USAGE_SPANS:
+                    db.execute('DELETE FROM usage WHERE span = ? AND bucket < ?', (span, now - days * 86400))
+                db.execute('DELETE FROM sessions WHERE end < ?', (now - HISTORY_DAY_DAYS * 86400,))
+            self.flushes += 1
+            self.rows_written += len(rows) + len(devices) + len(presence)
+            self.flush_ms = round((time.monotonic() - started) * 1000, 1)
+        except sqlite3.Error as e:
+            self.errors += 1
+            self.last_error = str(e)[:120]
+            logger.error(f"History flush error: {e}")
+            self._restore(usage, devices, presence)
+
+    def _restore(self, usage, devices, presence):
+        """Put a batch that failed to write back, merged with what was buffered since"""
+        with self._lock:
+            for key, (rx, tx) in usage.items():
+                totals = self._usage.setdefault(key, [0, 0])
+                totals[0] += rx
+                totals[1] += tx
+            for key, (mac, ip, name, first_seen, last_seen) in devices.items():
+                entry = self._devices.get(key)
+                if entry is None:
+                    self._devices[key] = [mac, ip, name, first_seen, last_seen]
+                else:
+                    entry[0] = entry[0] or mac
+                    entry[1] = entry[1] or ip
+                    entry[2] = entry[2] or name
+                    entry[3] = min(entry[3], first_seen)
+            for key, seen in presence.items():
+                self._presence[key] = max(self._presence.get(key, 0), seen)
+
+    def find_devices(self, text):
+        """Devices matching a MAC, an IP or a name (exact, then substring)"""
+        db = self._reader()
+        columns = 'router, device, mac, ip, name, first_seen, last_seen'
+        text = text.strip()
+        if MAC_RE.match(text):
+            return db.execute(f'SELECT {columns} FROM devices WHERE mac = ?', (text.upper().replace('-', ':'),)).fetchall()
+        if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', text):
+            return db.execute(f'SELECT {columns} FROM devices WHERE ip = ?', (text,)).fetchall()
+        rows = db.execute(f'SELECT {columns} FROM devices WHERE name = ? COLLATE NOCASE', (text,)).fetchall()
+        return rows or db.execute(f'SELECT {columns} FROM devices WHERE name LIKE ? LIMIT 5', (f'%{text}%',)).fetchall()
+
+    def usage(self, router_name, device, since):
+        """(rx, tx) totals and per-day (day, rx, tx) rows since a Unix time"""
+        db = self._reader()
+        # Finest buckets still retained for the whole window
+        window = time.time() - since
+        span = 60 if window <= 6 * 3600 else 3600 if window <= HISTORY_HOUR_DAYS * 86400 else 86400
+        rx, tx = db.execute(
+            'SELECT coalesce(sum(rx), 0), coalesce(sum(tx), 0) FROM usage '
+            'WHERE router = ? AND device = ? AND span = ? AND bucket >= ?',
+            (router_name, device, span, int(since) // span * span)).fetchone()
+        days = db.execute(
+            'SELECT bucket, rx, tx FROM usage WHERE router = ? AND device = ? AND span = 86400 AND bucket >= ? ORDER BY bucket',
+            (router_name, device, int(since) // 86400 * 86400)).fetchall()
+        return rx, tx, days
+
+    def sessions(self, router_name, mac, limit=5):
+        """Most recent (start, end) online intervals of a MAC"""
+        return self._reader().execute(
+            'SELECT start, end FROM sessions WHERE router = ? AND mac = ? ORDER BY end DESC LIMIT ?',
+            (router_name, mac, limit)).fetchall()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'flush_ms': self.flush_ms,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+history = None
+if HISTORY_DB:
+    try:
+        history = HistoryStore(HISTORY_DB)
+    except Exception as e:
+        logger.error(f"History store error: {e}")
+    else:
+        # Up to a flush interval of samples is still buffered at shutdown
+        atexit.register(history.flush)
+
+# ============== Router Connections ==============
+# Errors that leave the socket unusable; command traps are not among them
+CONNECTION_ERRORS = (
+    RouterOsApiConnectionError,
+    FatalRouterOsApiError,
+    RouterOsApiFatalCommunicationError,
+    OSError,
+)
+
+class RouterDown(Exception):
+    """Raised without touching the network while a router's breaker is open"""
+
+class TimedResource:
+    """RouterOS resource whose calls are recorded per router, path and command"""
+    def __init__(self, resource, labels):
+        self._resource = resource
+        self._labels = labels
+
+    def call(self, command, *args, **kwargs):
+        labels = self._labels + (command,)
+        started = time.monotonic()
+        try:
+            return self._resource.call(command, *args, **kwargs)
+        except Exception:
+            ROUTEROS_ERRORS.inc(*labels)
+            raise
+        finally:
+            ROUTEROS_SECONDS.observe(time.monotonic() - started, *labels)
+
+    def call_async(self, command, *args, **kwargs):
+        return TimedPromise(self._resource.call_async(command, *args, **kwargs), self._labels + (command,))
+
+    def __getattr__(self, name):
+        return getattr(self._resource, name)
+
+class TimedPromise:
+    """Pipelined call, timed from send until its reply has been read"""
+    def __init__(self, promise, labels):
+        self._promise = promise
+        self._labels = labels
+        self._started = time.monotonic()
+
+    def get(self):
+        try:
+            return self._promise.get()
+        except Exception:
+            ROUTEROS_ERRORS.inc(*self._labels)
+            raise
+        finally:
+            ROUTEROS_SECONDS.observe(time.monotonic() - self._started, *self._labels)
+
+    def __iter__(self):
+        return iter(self._promise)
+
+class TimedApi:
+    """RouterOS API handle that hands out timed resources"""
+    def __init__(self, api, router_name):
+        self._api = api
+        self._router_name = router_name
+
+    def get_resource(self, path):
+        return TimedResource(self._api.get_resource(path), (self._router_name, metric_path(path)))
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+class RouterLink:
+    """Managed RouterOS connections: lazy connect, keepalive, backoff, circuit breaker"""
+    def __init__(self, router, size=ROUTER_CONNECTIONS, timeout=ROUTER_TIMEOUT):
+        self.router = router
+        self.timeout = timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.retry_at = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.connect_ms = None
+        self.last_error = None
+        self._slots = queue.LifoQueue()
+        for _ in range(max(size, 1)):
+            self._slots.put({'pool': None, 'used': 0.0})
+        self.size = max(size, 1)
+        self._trial = False
+        self._keepalive = None
+        self._lock = threading.Lock()
+
+    def call(self, fn):
+        """Run fn(api) on an exclusively held connection"""
+        self._admit()
+        try:
+            slot = self._slots.get(timeout=self.timeout)
+        except queue.Empty:
+            self._release_trial()
+            raise TimeoutError(f"{self.router.name}: no free connection within {self.timeout:.0f}s")
+        try:
+            try:
+                api = self._connect(slot)
+            except Exception as e:
+                # Refused, timed out or rejected login: all count against the breaker
+                self._drop(slot)
+                self._failure(e)
+                raise
+            try:
+                result = fn(TimedApi(api, self.router.name))
+            except CONNECTION_ERRORS as e:
+                self._drop(slot)
+                self._failure(e)
+                raise
+            except Exception:
+                # A trap from the router still proves the connection works
+                self._success()
+                raise
+            self._success()
+            return result
+        finally:
+            slot['used'] = time.monotonic()
+            self._slots.put(slot)
+
+    @contextmanager
+    def dedicated(self):
+        """A connection of its own, for a stream too long to hold a pooled one
+
+        Admitted and counted by the breaker like call(), with the same socket timeout.
+        Yields the pool; leaving the block disconnects it, which ends the command on the router.
+        """
+        self._admit()
+        pool = None
+        try:
+            try:
+                pool = self.router.open_pool()
+                pool.set_timeout(self.timeout)
+                pool.get_api()
+            except Exception as e:
+                self._failure(e)
+                raise
+            try:
+                yield pool
+            except CONNECTION_ERRORS as e:
+                self._failure(e)
+                raise
+            except BaseException:
+                # A trap, or the reader stopping early: the connection itself worked
+                self._success()
+                raise
+            self._success()
+        finally:
+            if pool is not None:
+                try:
+                    pool.disconnect()
+                except Exception:
+                    pass
+
+    def _admit(self):
+        """Fail fast while open; let a single trial call through once the backoff expires"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            wait = self.retry_at - time.monotonic()
+            if wait > 0 or self._trial:
+                raise RouterDown(f"{self.router.name} unreachable, retrying in {max(wait, 0):.0f}s")
+            self.state = 'half-open'
+            self._trial = True
+
+    def _release_trial(self):
+        with self._lock:
+            self._trial = False
+
+    def _connect(self, slot):
+        if slot['pool'] is not None and slot['pool'].connected:
+            return slot['pool'].api
+        started = time.monotonic()
+        reconnect = slot['pool'] is not None
+        pool = slot['pool'] or self.router.open_pool()
+        pool.set_timeout(self.timeout)
+        api = pool.get_api()
+        slot['pool'] = pool
+        self.connect_ms = round((time.monotonic() - started) * 1000, 1)
+        if reconnect:
+            self.reconnects += 1
+        self.connects += 1
+        self._start_keepalive()
+        return api
+
+    def _drop(self, slot):
+        if slot['pool'] is not None:
+            try:
+                slot['pool'].disconnect()
+            except Exception:
+                pass
+
+    def _success(self):
+        with self._lock:
+            if self.state != 'closed':
+                logger.info(f"Router {self.router.name} back online")
+            self.state = 'closed'
+            self.failures = 0
+            self._trial = False
+
+    def _failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error)[:120]
+            self._trial = False
+            if self.state == 'half-open' or self.failures >= BREAKER_THRESHOLD:
+                backoff = min(2 ** max(self.failures - BREAKER_THRESHOLD, 0), BREAKER_MAX_BACKOFF)
+                self.retry_at = time.monotonic() + backoff
+                if self.state != 'open':
+                    logger.warning(f"Router {self.router.name} breaker open for {backoff:.0f}s: {error}")
+                self.state = 'open'
+
+    def _start_keepalive(self):
+        if self._keepalive is None and ROUTER_KEEPALIVE > 0:
+            self._keepalive = threading.Thread(target=self._keepalive_loop, name=f'keepalive-{self.router.name}', daemon=True)
+            self._keepalive.start()
+
+    def _keepalive_loop(self):
+        """Probe idle connections, and reconnect in the background once the backoff expires"""
+        while True:
+            time.sleep(min(ROUTER_KEEPALIVE, 5))
+            with self._lock:
+                due = self.state != 'closed' and time.monotonic() >= self.retry_at and not self._trial
+            idle = []
+            for _ in range(self.size):
+                try:
+                    slot = self._slots.get_nowait()
+                except queue.Empty:
+                    break
+                if slot['pool'] is not None and slot['pool'].connected and time.monotonic() - slot['used'] >= ROUTER_KEEPALIVE:
+                    idle.append(slot)
+                self._slots.put(slot)
+            if not due and not idle:
+                continue
+            try:
+                self.call(lambda api: api.get_resource('/system/identity').call('print'))
+            except Exception as e:
+                logger.debug(f"Keepalive probe failed on {self.router.name}: {e}")
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'retry_in': round(max(self.retry_at - time.monotonic(), 0), 1) if self.state != 'closed' else 0,
+            'connections': self.size,
+            'idle': self._slots.qsize(),
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'connect_ms': self.connect_ms,
+            'last_error': self.last_error,
+        }
+
+# ============== Bulk Reads ==============
+def encode_length(n):
+    """RouterOS API word length prefix"""
+    if n < 0x80:
+        return bytes([n])
+    if n < 0x4000:
+        return (n | 0x8000).to_bytes(2, 'big')
+    if n < 0x200000:
+        return (n | 0xC00000).to_bytes(3, 'big')
+    if n < 0x10000000:
+        return (n | 0xE0000000).to_bytes(4, 'big')
+    return b'\xF0' + n.to_bytes(4, 'big')
+
+def encode_sentence(words):
+    out = bytearray()
+    for word in words:
+        data = word.encode()
+        out += encode_length(len(data)) + data
+    out += b'\x00'
+    return bytes(out)
+
+def iter_sentences(sock, chunk=BULK_READ_CHUNK):
+    """Sentences off a raw API socket as lists of words, parsed out of large reads
+
+    routeros_api does a recv per length byte and per word, which dominates on tables
+    with tens of thousands of rows; here only the unparsed tail of a read is kept.
+    """
+    buf, pos, words = b'', 0, []
+    while True:
+        end = len(buf)
+        while pos < end:
+            first = buf[pos]
+            if first < 0x80:
+                head, n = 1, first
+            else:
+                head = 2 if first < 0xC0 else 3 if first < 0xE0 else 4 if first < 0xF0 else 5
+                if pos + head > end:
+                    break
+                if head == 5:
+                    n = int.from_bytes(buf[pos + 1:pos + 5], 'big')
+                else:
+                    n = int.from_bytes(buf[pos:pos + head], 'big') & ((1 << (7 * head)) - 1)
+            start = pos + head
+            if start + n > end:
+                break
+            if n:
+                words.append(buf[start:start + n].decode('utf-8', errors='replace'))
+            else:
+                yield words
+                words = []
+            pos = start + n
+        data = sock.recv(chunk)
+        if not data:
+            raise RouterOsApiConnectionError('router closed the connection')
+        buf, pos = buf[pos:] + data, 0
+
+# ============== Fleet ==============
+class Router:
+    """One RouterOS device with its own connections, cache and lease index"""
+    def __init__(self, name, host, username=None, password=None, port=8728):
+        self.name = name
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = int(port)
+        self.cache = SnapshotCache(SNAPSHOT_TTLS, shared=shared_cache, namespace=name)
+        self.leases = LeaseIndex(self)
+        self.logs = LogTail(self)
+        self.blocks = BlockIndex(self)
+        self.rates = RateEngine()
+        self.metrics = MetricsSampler(self)
+        self.link = RouterLink(self)
+
+    def open_pool(self):
+        """Create a new RouterOS API pool for this router"""
+        return RouterOsApiPool(
+            self.host,
+            username=self.username,
+            password=self.password,
+            port=self.port,
+            use_ssl=False,
+            plaintext_login=True
+        )
+
+    def call(self, fn):
+        """Run fn(api) on a managed connection"""
+        return self.link.call(fn)
+
+    def print(self, path, where=None, props=None, cached=True):
+        """Print path with router-side ?key=value filters and a .proplist projection"""
+        where = dict(where or {})
+        args = {'.proplist': ','.join(props)} if props else {}
+
+        def fetch():
+            return self.call(lambda api: api.get_resource(path).call('print', args, where))
+
+        if not cached:
+            return fetch()
+        return self.cache.get(path, fetch, (tuple(sorted(where.items())), tuple(props or ())))
+
+    def sample_print(self, path, props, fresh=False):
+        """(rows, wall time read) for the sampler; shared with other workers when a shared cache is set"""
+        if self.cache.shared and not fresh:
+            rows = self.print(path, props=props)
+            return rows, self.cache.fetched_at(path, ((), tuple(props))) or time.time()
+        return self.print(path, props=props, cached=False), time.time()
+
+    def stream(self, path, command='print', attrs=None, queries=()):
+        """Yield the rows of a command as they arrive, over a dedicated connection
+
+        For replies too large to buffer: rows are parsed from bulk reads and only one is
+        held at a time. queries are raw query words such as '?disabled=false'. Closing
+        the generator early drops the connection, which ends the command on the router.
+        """
+        labels = (self.name, metric_path(path), command)
+        started = time.monotonic()
+        try:
+            with self.link.dedicated() as stream_pool:
+                sock = stream_pool.socket.socket
+                words = [f"{path}/{command}"] + [f"={k}={v}" for k, v in (attrs or {}).items()] + list(queries)
+                sock.sendall(encode_sentence(words))
+                trap = None
+                for sentence in iter_sentences(sock):
+                    kind = sentence[0] if sentence else ''
+                    if kind == '!re':
+                        row = dict(word[1:].split('=', 1) for word in sentence[1:] if word[:1] == '=')
+                        if '.id' in row:
+                            # Same key as rows read through routeros_api
+                            row['id'] = row.pop('.id')
+                        yield row
+                    elif kind == '!trap':
+                        trap = next((word[9:] for word in sentence if word.startswith('=message=')), 'trap')
+                    elif kind == '!fatal':
+                        raise RouterOsApiConnectionError(' '.join(sentence[1:]) or 'fatal')
+                    elif kind == '!done':
+                        break
+                if trap:
+                    raise RouterOsApiCommunicationError(trap, trap.encode())
+        except Exception:
+            ROUTEROS_ERRORS.inc(*labels)
+            raise
+        finally:
+            ROUTEROS_SECONDS.observe(time.monotonic() - started, *labels)
+
+    def pipeline(self, path, commands, window=BLOCK_PIPELINE):
+        """Run (command, args) pairs over one connection, up to window in flight at once
+
+        Returns a (done attributes, trap) pair per command, in order.
+        """
+        def run(api):
+            resource = api.get_resource(path)
+            results = []
+            for start in range(0, len(commands), window):
+                # Send the whole window before reading any reply; tags keep them apart
+                promises = [resource.call_async(command, args) for command, args in commands[start:start + window]]
+                for promise in promises:
+                    try:
+                        results.append((promise.get().done_message, None))
+                    except RouterOsApiCommunicationError as e:
+                        results.append(({}, e))
+            return results
+
+        return self.call(run) if commands else []
+
+    def stats(self):
+        return {
+            'connection': self.link.stats(),
+            'cache': self.cache.stats(),
+            'leases': self.leases.stats(),
+            'logs': self.logs.stats(),
+            'blocks': self.blocks.stats(),
+            'metrics': self.metrics.stats(),
+            'rates': {'reboots': self.rates.reboots, 'wraps': self.rates.wraps, 'resets': self.rates.resets},
+        }
+
+class Fleet:
+    """Registry of routers with concurrent fan-out"""
+    def __init__(self, routers, default=None):
+        self.routers = OrderedDict((r.name, r) for r in routers)
+        self.default = self.routers.get(default) or next(iter(self.routers.values()), None)
+        self._executor = ThreadPoolExecutor(max_workers=FLEET_WORKERS, thread_name_prefix='fleet')
+
+    @classmethod
+    def load(cls):
+        """Build the fleet from ROUTERS_FILE, or the single ROUTER_* router"""
+        if ROUTERS_FILE:
+            with open(ROUTERS_FILE) as f:
+                config = json.load(f)
+            routers = [Router(
+                r['name'],
+                r['host'],
+                username=r.get('username', ROUTER_USER),
+                password=r.get('password', ROUTER_PASS),
+                port=r.get('port', ROUTER_PORT),
+            ) for r in config.get('routers', [])]
+            logger.info(f"Loaded {len(routers)} routers from {ROUTERS_FILE}")
+            return cls(routers, config.get('default'))
+        if ROUTER_HOST:
+            return cls([Router('main', ROUTER_HOST, ROUTER_USER, ROUTER_PASS, ROUTER_PORT)])
+        return cls([])
+
+    def get(self, name):
+        return self.routers.get(name)
+
+    def fan_out(self, fn, *args, timeout=FLEET_TIMEOUT):
+        """Run fn(*args, router) on every router concurrently; one reply per router, in fleet order"""
+        futures = {name: self._executor.submit(fn, *args, router) for name, router in self.routers.items()}
+        wait(futures.values(), timeout=timeout)
+        results = OrderedDict()
+        for name, future in futures.items():
+            if not future.done():
+                # Left running in the background; the next call starts fresh
+                results[name] = f"⏱ No answer within {timeout:.0f}s"
+            elif future.exception():
+                results[name] = f"❌ Error: {str(future.exception())[:80]}"
+            else:
+                results[name] = future.result()
+        return results
+
+    def start_samplers(self):
+        for router in self.routers.values():
+            router.metrics.start()
+
+    def stats(self):
+        return {name: router.stats() for name, router in self.routers.items()}
+
+try:
+    fleet = Fleet.load()
+except Exception as e:
+    logger.error(f"Fleet config error: {e}")
+    fleet = Fleet([])
 
 # ============== Helpers ==============
 def format_bytes(b):
@@ -72,324 +1938,984 @@ def format_bytes(b):
         b /= 1024
     return f"{b:.1f}TB"
 
+def format_bits(b):
+    """Convert bits per second to human readable"""
+    for unit in ['bps', 'Kbps', 'Mbps', 'Gbps']:
+        if abs(b) < 1000:
+            return f"{b:.1f}{unit}"
+        b /= 1000
+    return f"{b:.1f}Tbps"
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(text):
+    """Parse '15m', '1h', '24h' or '7d' into seconds, or None"""
+    m = re.fullmatch(r'(\d+)\s*([smhd])', text.strip().lower())
+    return int(m.group(1)) * DURATION_UNITS[m.group(2)] if m else None
+
+# Shorter prefixes would block a large part of the Internet, including the admins
+MIN_BLOCK_PREFIX = 8
+
+def parse_block_entry(token):
+    """Address-list entries for an IP, a CIDR or a range (a.b.c.d-e.f.g.h or a.b.c.d-h)"""
+    start, sep, end = token.partition('-')
+    if sep:
+        if end.isdigit():
+            end = f"{start.rsplit('.', 1)[0]}.{end}"
+        # Ranges become the covering CIDR blocks, so they match like any other entry
+        networks = list(ipaddress.summarize_address_range(ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)))
+    else:
+        networks = [ipaddress.IPv4Network(token, strict=False)]
+    if any(n.prefixlen < MIN_BLOCK_PREFIX for n in networks):
+        raise ValueError(f"{token} is broader than /{MIN_BLOCK_PREFIX}")
+    # RouterOS stores a /32 as the bare address
+    return [str(n.network_address) if n.prefixlen == 32 else str(n) for n in networks]
+
+def parse_block_request(text):
+    """Parse block/unblock arguments into (entries, invalid tokens, timeout)"""
+    entries, invalid, timeout = [], [], None
+    seen = set()
+    for line in text.splitlines():
+        for token in re.split(r'[\s,;]+', line.split('#', 1)[0]):
+            if not token:
+                continue
+            if token.lower().startswith('timeout='):
+                value = token.split('=', 1)[1].lower()
+                if parse_duration(value):
+                    timeout = value
+                else:
+                    invalid.append(token)
+                continue
+            try:
+                for entry in parse_block_entry(token):
+                    if entry not in seen:
+                        seen.add(entry)
+                        entries.append(entry)
+            except ValueError:
+                invalid.append(token)
+    return entries, invalid, timeout
+
+def bulk_summary(verb, done, suffix='', skipped=0, skip_label='', rejected=(), invalid=()):
+    """Reply for a bulk address-list change"""
+    if len(done) == 1 and not (skipped or rejected or invalid):
+        return f"{verb} {done[0]}{suffix}"
+    lines = [f"{verb} {len(done)} address{'' if len(done) == 1 else 'es'}{suffix}"]
+    if skipped:
+        lines.append(f"↩️ {skipped} {skip_label}")
+    if rejected:
+        lines.append(f"⚠️ {len(rejected)} rejected by router: {rejected[0]}")
+    if invalid:
+        more = ' ...' if len(invalid) > 5 else ''
+        lines.append(f"❌ {len(invalid)} invalid: {', '.join(invalid[:5])}{more}")
+    return "\n".join(lines)
+
+def trap_message(error):
+    """The router's own message from a !trap reply"""
+    message = error.original_message
+    return message.decode(errors='replace') if isinstance(message, bytes) else str(message)
+
+def format_time(t):
+    """Unix time as local date and minute"""
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+def format_age(seconds):
+    """Rough age like 45s, 12m, 3h or 2d"""
+    for unit, size in [('d', 86400), ('h', 3600), ('m', 60)]:
+        if seconds >= size:
+            return f"{int(seconds // size)}{unit}"
+    return f"{int(seconds)}s"
+
 def is_admin(chat_id):
     """Check if user is admin"""
     return not ADMIN_IDS or chat_id in ADMIN_IDS
 
 def send_message(chat_id, text, keyboard=None):
-    """Send Telegram message"""
+    """Queue a Telegram message for delivery"""
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': text,
-            'parse_mode': 'HTML'
-        }
-        if keyboard:
-            payload['reply_markup'] = keyboard
-        requests.post(url, json=payload, timeout=10)
+        telegram.send_message(chat_id, text, keyboard)
     except Exception as e:
         logger.error(f"Send message error: {e}")
 
+def utf16_len(text):
+    """Length as Telegram measures it: UTF-16 code units, so most emoji count twice"""
+    return len(text.encode('utf-16-le')) // 2
+
+def split_text(text, limit=4096):
+    """Split text into chunks of at most limit UTF-16 units, preferring line breaks"""
+    chunks = []
+    while utf16_len(text) > limit:
+        # The longest prefix within limit units; a surrogate pair cut in half is dropped
+        end = len(text[:limit].encode('utf-16-le')[:limit * 2].decode('utf-16-le', 'ignore'))
+        cut = text.rfind('\n', 0, end)
+        if cut <= 0:
+            cut = end
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+# ============== Pagination ==============
+class Paged:
+    """A titled list of reply items, shown a page at a time"""
+    def __init__(self, title, items, per_page):
+        self.title = title
+        self.items = items
+        self.per_page = per_page
+
+    @property
+    def pages(self):
+        return max(1, math.ceil(len(self.items) / self.per_page))
+
+    def render(self, page, limit=4096):
+        """Text of one page, cut after the last whole item that fits in limit UTF-16 units"""
+        start = page * self.per_page
+        header = self.title if self.pages == 1 else f"{self.title.rstrip(':')} · page {page + 1}/{self.pages}"
+        kept = [header, '']
+        room = limit - utf16_len(header) - 1
+        for item in self.items[start:start + self.per_page]:
+            room -= utf16_len(item) + 1
+            if room < 0:
+                if len(kept) == 2:
+                    # One oversized item is cut rather than leaving the page empty
+                    kept.append(split_text(item, room + utf16_len(item))[0])
+                break
+            kept.append(item)
+        return "\n".join(kept)
+
+    def __str__(self):
+        # First page only, for replies merged into one message (fleet fan-out)
+        rest = len(self.items) - self.per_page
+        text = f"{self.title}\n\n" + "\n".join(self.items[:self.per_page])
+        return text + (f"\n... and {rest} more" if rest > 0 else "")
+
+class ResultPages:
+    """Short-lived result snapshots behind inline ◀ ▶ buttons, keyed by cursor
+
+    With a shared cache, results are also stored in the daemon: a page turn may reach
+    any worker, not only the one that sent the list.
+    """
+    def __init__(self, ttl=PAGE_TTL, capacity=PAGE_CURSORS, shared=None):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.shared = shared
+        self.opened = 0
+        self.turns = 0
+        self.expired = 0
+        self._results = OrderedDict()  # cursor -> (chat_id, paged, expires), oldest first
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        while self._results:
+            cursor, (_, _, expires) = next(iter(self._results.items()))
+            if expires > now and len(self._results) <= self.capacity:
+                break
+            del self._results[cursor]
+
+    def open(self, chat_id, paged):
+        """Store a result and return its cursor id"""
+        now = time.monotonic()
+        with self._lock:
+            cursor = f"{random.getrandbits(32):08x}"
+            while cursor in self._results:
+                cursor = f"{random.getrandbits(32):08x}"
+            self._results[cursor] = (chat_id, paged, now + self.ttl)
+            self.opened += 1
+            self._prune(now)
+        if self.shared:
+            try:
+                self.shared.put(f"page:{cursor}", {'chat_id': chat_id, 'title': paged.title, 'items': paged.items,
+                                                   'per_page': paged.per_page}, self.ttl)
+            except SharedCacheError as e:
+                logger.warning(f"{e}; page turns may expire on other workers")
+        return cursor
+
+    def get(self, chat_id, cursor):
+        """The stored result for cursor, or None once expired or for another chat"""
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            entry = self._results.get(cursor)
+        if entry is None and self.shared:
+            entry = self._get_shared(cursor)
+        elif entry is not None and self.shared:
+            try:
+                # Paging keeps a result alive for the other workers too
+                self.shared.touch(f"page:{cursor}", self.ttl)
+            except SharedCacheError:
+                pass
+        with self._lock:
+            if entry is None or entry[0] != chat_id:
+                self.expired += 1
+                return None
+            # Paging keeps a result alive
+            self._results[cursor] = (chat_id, entry[1], now + self.ttl)
+            self._results.move_to_end(cursor)
+            self._prune(now)
+            self.turns += 1
+            return entry[1]
+
+    def _get_shared(self, cursor):
+        """(chat_id, paged) stored by another worker, or None"""
+        try:
+            value = self.shared.peek(f"page:{cursor}")
+            if value is None or not self.shared.touch(f"page:{cursor}", self.ttl):
+                return None
+        except SharedCacheError as e:
+            logger.warning(f"{e}; page {cursor} unavailable")
+            return None
+        return value['chat_id'], Paged(value['title'], value['items'], value['per_page'])
+
+    def keyboard(self, cursor, page, pages):
+        """Inline navigation row for page of pages"""
+        row = []
+        if page > 0:
+            row.append({'text': '◀', 'callback_data': f"pg:{cursor}:{page - 1}"})
+        row.append({'text': f"{page + 1}/{pages}", 'callback_data': 'pg:noop'})
+        if page < pages - 1:
+            row.append({'text': '▶', 'callback_data': f"pg:{cursor}:{page + 1}"})
+        return {'inline_keyboard': [row]}
+
+    def stats(self):
+        """Cursor store metrics"""
+        with self._lock:
+            return {'open': len(self._results), 'opened': self.opened, 'turns': self.turns, 'expired': self.expired}
+
+pages = ResultPages(shared=shared_cache)
+
+def send_reply(chat_id, reply, keyboard=None):
+    """Send a command reply, opening a cursor when it spans several pages"""
+    if isinstance(reply, LiveRequest):
+        return live.open(chat_id, reply)
+    if isinstance(reply, Document):
+        return telegram.send_document(chat_id, reply)
+    if not isinstance(reply, Paged):
+        return send_message(chat_id, reply, keyboard)
+    if reply.pages == 1:
+        return send_message(chat_id, reply.render(0), keyboard)
+    cursor = pages.open(chat_id, reply)
+    send_message(chat_id, reply.render(0), pages.keyboard(cursor, 0, reply.pages))
+
+# ============== Live View ==============
+SPARK = '▁▂▃▄▅▆▇█'
+
+def sparkline(values):
+    """Bar per value, scaled to the largest"""
+    top = max(values, default=0)
+    if not top:
+        return SPARK[0] * len(values)
+    return ''.join(SPARK[min(int(v / top * len(SPARK)), len(SPARK) - 1)] for v in values)
+
+class LiveRequest:
+    """A command reply asking for a live view instead of a message"""
+    def __init__(self, router, interface, seconds):
+        self.router = router
+        self.interface = interface
+        self.seconds = seconds
+
+class LiveStream(threading.Thread):
+    """One monitor-traffic stream for a router interface, shown in every message watching it"""
+    def __init__(self, views, router, interface):
+        super().__init__(name=f'live-{router.name}-{interface}', daemon=True)
+        self.views = views
+        self.router = router
+        self.interface = interface
+        self.viewers = {}  # (chat_id, message_id) -> monotonic end time
+        self.rx = deque(maxlen=20)
+        self.tx = deque(maxlen=20)
+        self.latest = None
+        self.rows = 0
+        self.next_edit = 0.0
+
+    def run(self):
+        error = None
+        try:
+            # Closing the connection on the way out is what stops the stream on the router
+            with self.router.link.dedicated() as stream_pool:
+                api = stream_pool.get_api()
+                # Without once=, monitor-traffic keeps sending a row every second until cancelled
+                for row in api.get_resource('/interface').call_async('monitor-traffic', {'interface': self.interface}):
+                    self.rows += 1
+                    self.latest = row
+                    self.rx.append(int(row.get('rx-bits-per-second', 0)))
+                    self.tx.append(int(row.get('tx-bits-per-second', 0)))
+                    if not self.views.tick(self):
+                        break
+        except Exception as e:
+            error = e
+            logger.warning(f"Live stream {self.interface} on {self.router.name} dropped: {e}")
+        finally:
+            self.views.closed(self, f"⚠️ Stream dropped: {str(error)[:80]}" if error else None)
+
+    def render(self, end, footer=None):
+        now = time.monotonic()
+        msg = f"📈 Live: {self.interface} ({self.router.name})\n\n"
+        if self.latest is None:
+            msg += "Connecting...\n"
+        else:
+            row = self.latest
+            msg += f"↓ {format_bits(self.rx[-1])}  ↑ {format_bits(self.tx[-1])}\n"
+            msg += f"Packets: ↓ {row.get('rx-packets-per-second', '?')}/s  ↑ {row.get('tx-packets-per-second', '?')}/s\n"
+            msg += f"↓ {sparkline(self.rx)}\n↑ {sparkline(self.tx)}\n"
+        if footer:
+            return msg + f"\n{footer}"
+        return msg + f"\nUpdated {time.strftime('%H:%M:%S')} · {max(end - now, 0):.0f}s left"
+
+LIVE_STOP_KB = {'inline_keyboard': [[{'text': '⏹ Stop', 'callback_data': 'lv:stop'}]]}
+
+class LiveViews:
+    """Live messages by stream; a stream runs while at least one message watches it
+
+    With a shared cache, open messages are registered in the daemon: Stop pressed on
+    another worker leaves a flag that the owning worker picks up on its next edit.
+    """
+    def __init__(self, interval=LIVE_EDIT_INTERVAL, max_views=LIVE_MAX_VIEWS, shared=None):
+        self.interval = interval
+        self.max_views = max_views
+        self.shared = shared
+        self.opened = 0
+        self.edits = 0
+        self._streams = {}  # (router name, interface) -> LiveStream
+        self._lock = threading.Lock()
+
+    def open(self, chat_id, request):
+        """Send the live message, then attach it to the interface's stream"""
+        def job():
+            sent = telegram.call('sendMessage', {
+                'chat_id': chat_id,
+                'text': f"📈 Live: {request.interface} ({request.router.name})\n\nConnecting...",
+                'reply_markup': LIVE_STOP_KB,
+            })
+            if sent:
+                self.watch(chat_id, sent['message_id'], request)
+        # Through the outbox so the live message stays in order with the chat's other replies
+        if telegram.outbox.submit(chat_id, None, job) == 'full':
+            logger.error(f"Outbound queue full, dropping live view for {chat_id}")
+
+    def watch(self, chat_id, message_id, request):
+        end = time.monotonic() + request.seconds
+        key = (request.router.name, request.interface)
+        ended = []
+        with self._lock:
+            # One live view per chat; a new one replaces the old
+            for stream in self._streams.values():
+                for viewer in [v for v in stream.viewers if v[0] == chat_id]:
+                    del stream.viewers[viewer]
+                    ended.append((stream, viewer))
+            if sum(len(s.viewers) for s in self._streams.values()) >= self.max_views:
+                refused = True
+            else:
+                refused = False
+                stream = self._streams.get(key)
+                if stream is None:
+                    stream = self._streams[key] = LiveStream(self, request.router, request.interface)
+                    stream.start()
+                stream.viewers[(chat_id, message_id)] = end
+                stream.next_edit = 0.0
+                self.opened += 1
+        for stream, viewer in ended:
+            self._finish(stream, viewer, "⏹ Replaced by a newer live view")
+        if refused:
+            telegram.edit_message(chat_id, message_id, "❌ Too many live views open, try again later")
+        elif self.shared:
+            self._register(chat_id, message_id, request.seconds + self.interval, [v for _, v in ended])
+
+    def _register(self, chat_id, message_id, ttl, replaced):
+        """Publish an open message; a live view of this chat held by another worker is told to stop"""
+        try:
+            previous = self.shared.peek(f"live-chat:{chat_id}")
+            if previous and previous != message_id and (chat_id, previous) not in replaced:
+                self.shared.put(f"live-stop:{chat_id}:{previous}", 1, LIVE_MAX_DURATION)
+            self.shared.put(f"live:{chat_id}:{message_id}", 1, ttl)
+            self.shared.put(f"live-chat:{chat_id}", message_id, ttl)
+        except SharedCacheError as e:
+            logger.warning(f"{e}; live view {chat_id}:{message_id} only stoppable on this worker")
+
+    def _stopped(self, viewers):
+        """Viewers another worker was asked to stop"""
+        try:
+            return [v for v in viewers if self.shared.peek(f"live-stop:{v[0]}:{v[1]}")]
+        except SharedCacheError:
+            return []
+
+    def tick(self, stream):
+        """Called on every streamed row: edit messages when due; False once nobody watches"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [v for v, end in stream.viewers.items() if end <= now]
+            for viewer in expired:
+                del stream.viewers[viewer]
+            watched = bool(stream.viewers)
+            if not watched:
+                self._streams.pop((stream.router.name, stream.interface), None)
+            due = now >= stream.next_edit
+            if due:
+                stream.next_edit = now + self.interval
+            viewers = list(stream.viewers.items()) if due else []
+        stopped = self._stopped([v for v, _ in viewers]) if viewers and self.shared else []
+        if stopped:
+            with self._lock:
+                for viewer in stopped:
+                    stream.viewers.pop(viewer, None)
+                watched = bool(stream.viewers)
+                if not watched and self._streams.get((stream.router.name, stream.interface)) is stream:
+                    del self._streams[(stream.router.name, stream.interface)]
+            viewers = [(v, end) for v, end in viewers if v not in stopped]
+        for viewer in stopped:
+            self._finish(stream, viewer, "⏹ Stopped")
+        for viewer in expired:
+            self._finish(stream, viewer, "⏹ Live view ended")
+        for (chat_id, message_id), end in viewers:
+            self.edits += 1
+            telegram.edit_message(chat_id, message_id, stream.render(end), LIVE_STOP_KB)
+        return watched
+
+    def closed(self, stream, reason):
+        """The stream ended; close any message still watching it"""
+        with self._lock:
+            if self._streams.get((stream.router.name, stream.interface)) is stream:
+                del self._streams[(stream.router.name, stream.interface)]
+            viewers, stream.viewers = list(stream.viewers), {}
+        for viewer in viewers:
+            self._finish(stream, viewer, reason or "⏹ Live view ended")
+
+    def stop(self, chat_id, message_id):
+        """Stop button: detach the message; returns False if it was no longer live"""
+        with self._lock:
+            for stream in self._streams.values():
+                if (chat_id, message_id) in stream.viewers:
+                    del stream.viewers[(chat_id, message_id)]
+                    break
+            else:
+                return self._stop_shared(chat_id, message_id)
+        self._finish(stream, (chat_id, message_id), "⏹ Stopped")
+        return True
+
+    def _stop_shared(self, chat_id, message_id):
+        """Flag a message another worker is updating; it stops on that worker's next edit"""
+        if not self.shared:
+            return False
+        try:
+            if self.shared.peek(f"live:{chat_id}:{message_id}") is None:
+                return False
+            self.shared.put(f"live-stop:{chat_id}:{message_id}", 1, LIVE_MAX_DURATION)
+        except SharedCacheError as e:
+            logger.warning(f"{e}; cannot stop live view {chat_id}:{message_id}")
+            return False
+        return True
+
+    def _finish(self, stream, viewer, footer):
+        # Final edit without the button; the last reading stays on screen
+        telegram.edit_message(viewer[0], viewer[1], stream.render(0, footer))
+        if self.shared:
+            try:
+                # A zero ttl expires the entry: a later Stop press answers "already ended"
+                self.shared.put(f"live:{viewer[0]}:{viewer[1]}", None, 0)
+            except SharedCacheError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': len(self._streams),
+                'viewers': sum(len(s.viewers) for s in self._streams.values()),
+                'opened': self.opened,
+                'edits': self.edits,
+            }
+
+live = LiveViews(shared=shared_cache)
+
+# ============== Connection Analytics ==============
+CONNECTION_PATH = '/ip/firewall/connection'
+CONNECTION_PROPS = ('protocol', 'src-address', 'dst-address', 'orig-bytes', 'repl-bytes')
+
+class ConnectionColumns:
+    """Connection-tracking rows as columns of integer codes, one per distinct value
+
+    Rows are split into column arrays as they are read; each column is then coded at
+    once with np.unique, so ranking it is a weighted bincount over small ints. Without
+    numpy, values are coded by first appearance in a dict and summed in Python.
+    """
+    COLUMNS = ('src', 'dst', 'service', 'protocol')
+
+    def __init__(self, rows):
+        columns = {column: [] for column in self.COLUMNS}
+        src, dst, service, protocol = (columns[c] for c in self.COLUMNS)
+        size = []
+        for row in rows:
+            proto = row.get('protocol', '?')
+            # ICMP and other portless protocols show a bare address
+            address = row.get('src-address', '?')
+            host, sep, _ = address.rpartition(':')
+            src.append(host if sep else address)
+            address = row.get('dst-address', '?')
+            host, sep, port = address.rpartition(':')
+            dst.append(host if sep else address)
+            service.append(f"{proto}/{port}" if sep else proto)
+            protocol.append(proto)
+            size.append(int(row.get('orig-bytes') or 0) + int(row.get('repl-bytes') or 0))
+        self.labels, self.codes = {}, {}
+        if np is not None:
+            self.size = np.asarray(size, dtype=np.int64)
+            for column, values in columns.items():
+                labels, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+                self.labels[column], self.codes[column] = labels.tolist(), codes.reshape(-1)
+            return
+        self.size = array('q', size)
+        for column, values in columns.items():
+            index = {}
+            self.codes[column] = array('i', [index.setdefault(value, len(index)) for value in values])
+            self.labels[column] = list(index)
+
+    def __len__(self):
+        return len(self.size)
+
+    def top(self, column, n=5, by_bytes=True):
+        """[(key, bytes, connections)] of the n largest groups of one column"""
+        labels = self.labels[column]
+        codes = self.codes[column]
+        if np is not None:
+            totals = np.bincount(codes, weights=self.size, minlength=len(labels)).astype(np.int64)
+            counts = np.bincount(codes, minlength=len(labels))
+            # Stable on the negated key: ties keep label order
+            order = np.argsort(-(totals if by_bytes else counts), kind='stable')[:n]
+            return [(labels[i], int(totals[i]), int(counts[i])) for i in order]
+        totals, counts = [0] * len(labels), [0] * len(labels)
+        for code, size in zip(codes, self.size):
+            totals[code] += size
+            counts[code] += 1
+        ranked = heapq.nlargest(n, range(len(labels)), key=(totals if by_bytes else counts).__getitem__)
+        return [(labels[i], totals[i], counts[i]) for i in ranked]
+
+# ============== Exports ==============
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+class Document:
+    """A command reply uploaded as a file; fileobj is closed once it has been sent"""
+    def __init__(self, filename, fileobj, caption):
+        self.filename = filename
+        self.fileobj = fileobj
+        self.caption = caption
+
+def parse_print_words(words):
+    """Split '/path [print] [.proplist=a,b] [?query ...]' into (path, action, props, queries)"""
+    if not words or not words[0].startswith('/'):
+        raise ValueError("Command must start with / (e.g., /system/resource)")
+    path, action, props, queries = words[0].rstrip('/'), None, None, []
+    for word in words[1:]:
+        if word.startswith('.proplist='):
+            props = [p for p in word[len('.proplist='):].split(',') if p]
+        elif word.startswith('?'):
+            # Passed through as API query words: ?name=value, ?-name, ?>name=value, ?#|
+            queries.append(word)
+        elif action is None:
+            action = word
+        else:
+            raise ValueError(f"Unexpected '{word[:30]}'")
+    return path, action or 'print', props, queries
+
+def write_export(rows, fmt, fileobj, props=None, limit=EXPORT_MAX_BYTES):
+    """Write rows into fileobj as gzip CSV or JSON lines; returns (rows written, truncated)
+
+    Rows are written as they are read, so memory stays flat however large the table.
+    CSV columns are the .proplist: rows of one table can differ in their fields.
+    """
+    if fmt == 'csv' and not props:
+        raise ValueError("CSV needs .proplist for its columns")
+    columns = [('id' if p == '.id' else p) for p in props or ()]
+    count, truncated = 0, False
+    with io.TextIOWrapper(gzip.GzipFile(fileobj=fileobj, mode='wb'), encoding='utf-8', newline='') as out:
+        writer = None
+        for row in rows:
+            if fmt == 'jsonl':
+                out.write(json.dumps(row, ensure_ascii=False) + '\n')
+            else:
+                if writer is None:
+                    writer = csv.DictWriter(out, columns, extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow(row)
+            count += 1
+            # The compressed size trails the rows by the gzip buffer; checked now and then
+            if count % 1000 == 0 and fileobj.tell() > limit:
+                truncated = True
+                break
+    return count, truncated
+
 # ============== Commands ==============
-def cmd_speed(chat_id):
+def format_speed(q, name_for_target):
+    """Bandwidth reply for queue rows, naming targets through name_for_target"""
+    if not q:
+        return "📊 No bandwidth data"
+    
+    lines = []
+    for i, item in enumerate(q, 1):
+        queue_name = item.get('name', '?')
+        rate = item.get('rate', '0/0')
+        
+        # Try to get device name from target IP
+        target = item.get('target', '')
+        display_name = name_for_target(target) or queue_name
+        
+        lines.append(f"{i}. {display_name}: {rate}")
+    return Paged("📊 Current Bandwidth:", lines, 10)
+
+def cmd_speed(chat_id, router=None):
     """Get bandwidth usage with device names"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     try:
-        api = pool.get_api()
-        
-        # Get all DHCP leases to map IPs to device names
-        leases = api.get_resource('/ip/dhcp-server/lease').call('print')
-        device_names = {}
-        for lease in leases:
-            ip = lease.get('address', '')
-            name = lease.get('comment', '').strip()
-            if not name:
-                name = lease.get('host-name', '').strip()
-            if name and ip:
-                device_names[ip] = name
-        
-        # Get queues
-        q = api.get_resource('/queue/simple').call('print')
-        if not q:
-            return "📊 No bandwidth data"
-        
-        msg = "📊 Current Bandwidth:\n\n"
-        for i, item in enumerate(q[:10], 1):
-            queue_name = item.get('name', '?')
-            rate = item.get('rate', '0/0')
-            
-            # Try to get device name from target IP
-            target = item.get('target', '')
-            display_name = device_names.get(target, queue_name)
-            
-            msg += f"{i}. {display_name}: {rate}\n"
-        return msg
+        router.leases.ensure_started()
+        q = router.print('/queue/simple', props=QUEUE_PROPS)
+        return format_speed(q, router.leases.name_for_target)
     except Exception as e:
         logger.error(f"Speed error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_devices(chat_id):
+def format_devices(a):
+    """Devices reply for bound lease rows"""
+    if not a:
+        return "📱 No devices connected"
+    lines = []
+    for i, d in enumerate(a, 1):
+        # Get device name from comment, or use hostname, or fallback to MAC
+        name = d.get('comment', '').strip()
+        if not name:
+            name = d.get('host-name', '').strip()
+        if not name:
+            name = d.get('mac-address', '?')[:17]
+        
+        ip = d.get('address', '?')
+        lines.append(f"{i}. {name} → {ip}")
+    return Paged(f"📱 Connected Devices ({len(a)}):", lines, 15)
+
+def cmd_devices(chat_id, router=None):
     """Get DHCP devices"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     try:
-        api = pool.get_api()
-        l = api.get_resource('/ip/dhcp-server/lease').call('print')
-        a = [i for i in l if i.get('status') == 'bound'][:15]
-        if not a:
-            return "📱 No devices connected"
-        msg = f"📱 Connected Devices ({len(a)}):\n\n"
-        for i, d in enumerate(a, 1):
-            # Get device name from comment, or use hostname, or fallback to MAC
-            name = d.get('comment', '').strip()
-            if not name:
-                name = d.get('host-name', '').strip()
-            if not name:
-                name = d.get('mac-address', '?')[:17]
-            
-            ip = d.get('address', '?')
-            msg += f"{i}. {name} → {ip}\n"
-        return msg
+        return format_devices(router.print(LEASE_PATH, {'status': 'bound'}, LEASE_PROPS))
     except Exception as e:
         logger.error(f"Devices error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_status(chat_id):
+def format_status(r):
+    """Status reply for a /system/resource row"""
+    msg = "⚙️ Router Status:\n\n"
+    msg += f"CPU: {r.get('cpu-load','?')}%\n"
+    msg += f"Uptime: {r.get('uptime','?')}\n"
+    msg += f"Memory: {r.get('total-memory','?')}\n"
+    msg += f"Version: {r.get('version','?')}\n"
+    return msg
+
+def cmd_status(chat_id, router=None):
     """Get router status"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     try:
-        api = pool.get_api()
-        r = api.get_resource('/system/resource').call('print')[0]
-        msg = "⚙️ Router Status:\n\n"
-        msg += f"CPU: {r.get('cpu-load','?')}%\n"
-        msg += f"Uptime: {r.get('uptime','?')}\n"
-        msg += f"Memory: {r.get('total-memory','?')}\n"
-        msg += f"Version: {r.get('version','?')}\n"
-        return msg
+        return format_status(router.print('/system/resource', props=RESOURCE_PROPS)[0])
     except Exception as e:
         logger.error(f"Status error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_top5(chat_id):
+def cmd_top5(chat_id, router=None):
     """Get top 5 consumers with device names"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     try:
-        api = pool.get_api()
-        
-        # Get all DHCP leases to map IPs to device names
-        leases = api.get_resource('/ip/dhcp-server/lease').call('print')
-        device_names = {}
-        for lease in leases:
-            ip = lease.get('address', '')
-            name = lease.get('comment', '').strip()
-            if not name:
-                name = lease.get('host-name', '').strip()
-            if name and ip:
-                device_names[ip] = name
-        
-        # Get queues and sort by bandwidth
-        q = api.get_resource('/queue/simple').call('print')
-        t = []
-        for i in q:
-            try:
-                rate = i.get('rate', '0/0')
-                b = int(rate.split('/')[1]) if '/' in rate else 0
-                queue_name = i.get('name', '?')
-                target = i.get('target', '')
-                # Use device name if available, otherwise queue name
-                display_name = device_names.get(target, queue_name)
-                t.append((display_name, b))
-            except:
-                pass
+        router.leases.ensure_started()
+        router.metrics.ensure_rates()
         
-        t.sort(key=lambda x: x[1], reverse=True)
-        if not t:
-            return "🔥 No data"
-        msg = "🔥 Top 5 Consumers:\n\n"
-        for idx, (n, b) in enumerate(t[:5], 1):
-            msg += f"{idx}. {n}: {format_bytes(b)}\n"
+        return format_top5(router.rates, router.leases.name_for_target)
+    except Exception as e:
+        logger.error(f"Top5 error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+def format_top5(rates, name_for_target):
+    """Top consumers reply from the rate engine, naming targets through name_for_target"""
+    # Queues sorted by download rate from counter deltas
+    t = rates.snapshot('queue', key=lambda r: r.tx)
+    if not t:
+        return "🔥 No data"
+    msg = "🔥 Top 5 Consumers (now / avg):\n\n"
+    for idx, r in enumerate(t[:5], 1):
+        # Use device name if available, otherwise queue name
+        name = name_for_target(r.meta or '') or r.name
+        msg += f"{idx}. {name}: ↓{format_bits(r.tx)} / {format_bits(r.tx_avg)}\n"
+    return msg
+
+def cmd_talkers(chat_id, router=None):
+    """Top sources, destinations and services in the connection-tracking table"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    try:
+        router.leases.ensure_started()
+        started = time.perf_counter()
+        table = ConnectionColumns(router.stream(CONNECTION_PATH, attrs={'.proplist': ','.join(CONNECTION_PROPS)}))
+        read = time.perf_counter() - started
+        if not len(table):
+            return "🗣 No tracked connections"
+        # Without connection accounting every byte counter is zero; rank by connection count
+        by_bytes = any(table.size)
+        started = time.perf_counter()
+        sources = table.top('src', by_bytes=by_bytes)
+        destinations = table.top('dst', by_bytes=by_bytes)
+        services = table.top('service', by_bytes=by_bytes)
+        protocols = table.top('protocol', n=3, by_bytes=by_bytes)
+        aggregate = time.perf_counter() - started
+
+        def line(i, label, total, count):
+            return f"{i}. {label}: {format_bytes(total)} · {count:,} conns\n" if by_bytes else f"{i}. {label}: {count:,} conns\n"
+
+        msg = f"🗣 Top Talkers ({len(table):,} connections, by {'bytes' if by_bytes else 'count'}):\n\nSources:\n"
+        for i, (host, total, count) in enumerate(sources, 1):
+            name = router.leases.name_for_ip(host)
+            msg += line(i, f"{name} ({host})" if name else host, total, count)
+        msg += "\nDestinations:\n"
+        for i, (host, total, count) in enumerate(destinations, 1):
+            msg += line(i, host, total, count)
+        msg += "\nServices:\n"
+        for i, (service, total, count) in enumerate(services, 1):
+            msg += line(i, service, total, count)
+        shares = [f"{proto} {(total if by_bytes else count) / (sum(table.size) if by_bytes else len(table)):.0%}"
+                  for proto, total, count in protocols]
+        msg += f"\nProtocols: {' · '.join(shares)}\n"
+        engine = 'numpy' if np is not None else 'python'
+        msg += f"\n⏱ Read and parsed in {read:.2f}s · aggregated in {aggregate * 1000:.0f}ms ({engine})"
         return msg
     except Exception as e:
-        logger.error(f"Top5 error: {e}")
+        logger.error(f"Talkers error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_traffic(chat_id):
+def cmd_traffic(chat_id, router=None):
     """Get interface traffic"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     try:
-        api = pool.get_api()
-        ifaces = api.get_resource('/interface').call('print')
-        if not ifaces:
-            return "📈 No interfaces"
-        msg = "📈 Interface Traffic:\n\n"
-        for iface in ifaces[:8]:
-            name = iface.get('name', '?')
-            rx = int(iface.get('rx-byte', '0'))
-            tx = int(iface.get('tx-byte', '0'))
-            msg += f"{name}: ↓{format_bytes(rx)} ↑{format_bytes(tx)}\n"
-        return msg
+        router.metrics.ensure_rates()
+        return format_traffic(router.rates)
     except Exception as e:
         logger.error(f"Traffic error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_backup(chat_id):
+def format_traffic(rates):
+    """Interface traffic reply from the rate engine"""
+    ifaces = rates.snapshot('iface')
+    if not ifaces:
+        return "📈 No interfaces"
+    msg = "📈 Interface Traffic (now, avg in brackets):\n\n"
+    for r in ifaces[:8]:
+        msg += f"{r.name}: ↓{format_bits(r.rx)} ({format_bits(r.rx_avg)}) ↑{format_bits(r.tx)} ({format_bits(r.tx_avg)})\n"
+    return msg
+
+def cmd_live(chat_id, interface, seconds, router=None):
+    """Live bandwidth of one interface, updated in place"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    try:
+        if interface is None:
+            # Busiest interface by recent rate, else the first one listed
+            names = [r.name for r in router.rates.snapshot('iface')]
+            names = names or [i.get('name') for i in router.print('/interface', props=IFACE_PROPS)]
+            if not names:
+                return "📈 No interfaces"
+            interface = names[0]
+        elif not router.print('/interface', {'name': interface}, ('name',)):
+            return f"❌ Unknown interface: {interface}"
+        return LiveRequest(router, interface, seconds)
+    except Exception as e:
+        logger.error(f"Live error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+def cmd_backup(chat_id, router=None):
     """Create backup"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     if not is_admin(chat_id):
         return "🔒 Admin only"
     try:
-        import time
-        api = pool.get_api()
         name = f"bot-{int(time.time())}"
-        api.get_resource('/system/backup').call('save', {'name': name})
+        router.call(lambda api: api.get_resource('/system/backup').call('save', {'name': name}))
         logger.warning(f"Backup created by {chat_id}: {name}")
         return f"✅ Backup: {name}.backup"
     except Exception as e:
         logger.error(f"Backup error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_logs(chat_id):
-    """Get system logs"""
-    if not pool:
+def cmd_logs(chat_id, router=None, topic=None, count=5):
+    """Get system logs, optionally for one topic, from the local log tail"""
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     try:
-        api = pool.get_api()
-        lg = api.get_resource('/log').call('print')
-        if not lg:
-            return "📝 No logs"
-        msg = "📝 Last Logs:\n\n"
-        for log in lg[-5:]:
-            t = log.get('time', '?')
-            m = log.get('message', '?')[:40]
-            msg += f"[{t}] {m}\n"
-        return msg
+        router.logs.ensure_started()
+        return format_logs(router.logs.tail(min(count, LOG_BUFFER), topic), topic)
     except Exception as e:
         logger.error(f"Logs error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_firewall(chat_id):
+def format_logs(lg, topic=None):
+    """Logs reply for log rows, newest last"""
+    if not lg:
+        return f"📝 No {topic} logs" if topic else "📝 No logs"
+    msg = f"📝 Last {len(lg)} {topic} Logs:\n\n" if topic else "📝 Last Logs:\n\n"
+    for log in lg:
+        t = log.get('time', '?')
+        m = log.get('message', '?')[:40]
+        msg += f"[{t}] {m}\n"
+    return msg
+
+def cmd_logs_topic(chat_id, topic, count):
+    """Logs of one topic on the default router"""
+    return cmd_logs(chat_id, topic=topic, count=count)
+
+def format_firewall(rules):
+    """Firewall reply for filter rule rows"""
+    if not rules:
+        return "🚫 No rules"
+    lines = []
+    for i, r in enumerate(rules, 1):
+        proto = r.get('protocol', 'any')
+        action = r.get('action', '?').upper()
+        comment = r.get('comment', 'rule')[:25]
+        lines.append(f"{i}. [{action}] {proto}: {comment}")
+    return Paged("🚫 Firewall Rules:", lines, 10)
+
+def cmd_firewall(chat_id, router=None):
     """Show firewall rules"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     if not is_admin(chat_id):
         return "🔒 Admin only"
     try:
-        api = pool.get_api()
-        rules = api.get_resource('/ip/firewall/filter').call('print')[:10]
-        if not rules:
-            return "🚫 No rules"
-        msg = "🚫 Firewall Rules:\n\n"
-        for i, r in enumerate(rules, 1):
-            proto = r.get('protocol', 'any')
-            action = r.get('action', '?').upper()
-            comment = r.get('comment', 'rule')[:25]
-            msg += f"{i}. [{action}] {proto}: {comment}\n"
-        return msg
+        return format_firewall(router.print('/ip/firewall/filter', props=FILTER_PROPS))
     except Exception as e:
         logger.error(f"Firewall error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_block(chat_id, ip):
-    """Block IP address"""
-    if not pool:
+def cmd_block(chat_id, args, router=None):
+    """Block IPs, CIDRs and ranges, optionally for timeout=<duration>"""
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     if not is_admin(chat_id):
         return "🔒 Admin only"
     try:
-        import re
-        if not re.match(r'^(\d{1,3}\.){3}\d{1,3}$', ip):
-            return "❌ Invalid IP"
-        api = pool.get_api()
-        api.get_resource('/ip/firewall/address-list').call('add', {
-            'list': 'blocked',
-            'address': ip,
-            'comment': 'blocked-by-bot'
-        })
-        logger.warning(f"IP blocked by {chat_id}: {ip}")
-        return f"🚫 Blocked {ip}"
+        entries, invalid, timeout = parse_block_request(args)
+        if not entries:
+            return "❌ Invalid IP" + (f": {', '.join(invalid[:5])}" if invalid else "")
+        router.blocks.ensure_started()
+        new = [entry for entry in entries if entry not in router.blocks]
+        if not new and len(entries) == 1 and not invalid:
+            return f"ℹ️ {entries[0]} is already blocked"
+        results = router.pipeline(ADDRESS_LIST_PATH, block_commands(new, timeout))
+        return report_blocked(chat_id, router, entries, new, results, timeout, invalid)
     except Exception as e:
         logger.error(f"Block error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_unblock(chat_id, ip):
-    """Unblock IP address"""
-    if not pool:
+def block_commands(entries, timeout):
+    """Address-list adds for entries, as (command, args) pairs"""
+    params = {'list': BLOCK_LIST, 'comment': 'blocked-by-bot'}
+    if timeout:
+        params['timeout'] = timeout
+    return [('add', dict(params, address=entry)) for entry in entries]
+
+def report_blocked(chat_id, router, entries, new, results, timeout, invalid):
+    """Record the adds the router accepted and summarize the block"""
+    added, rejected = [], []
+    for entry, (done, error) in zip(new, results):
+        if error:
+            rejected.append(trap_message(error))
+        else:
+            added.append(entry)
+            router.blocks.record(entry, done.get('ret'))
+    router.cache.invalidate(ADDRESS_LIST_PATH)
+    logger.warning(f"{len(added)} addresses blocked by {chat_id}: {' '.join(added[:20])}")
+    return bulk_summary("🚫 Blocked", added, f" for {timeout}" if timeout else "",
+                        len(entries) - len(new), "already blocked", rejected, invalid)
+
+def cmd_unblock(chat_id, args, router=None):
+    """Unblock IPs, CIDRs and ranges"""
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     if not is_admin(chat_id):
         return "🔒 Admin only"
     try:
-        api = pool.get_api()
-        rules = api.get_resource('/ip/firewall/address-list').call('print')
-        found = False
-        for rule in rules:
-            if rule.get('address') == ip and rule.get('list') == 'blocked':
-                api.get_resource('/ip/firewall/address-list').call('remove', {'.id': rule['.id']})
-                found = True
-        if not found:
-            return f"❌ {ip} not found"
-        logger.warning(f"IP unblocked by {chat_id}: {ip}")
-        return f"✅ Unblocked {ip}"
+        entries, invalid, _ = parse_block_request(args)
+        if not entries:
+            return "❌ Invalid IP" + (f": {', '.join(invalid[:5])}" if invalid else "")
+        router.blocks.ensure_started()
+        found = [(entry, router.blocks.id_for(entry)) for entry in entries]
+        found = [(entry, entry_id) for entry, entry_id in found if entry_id]
+        if not found and len(entries) == 1 and not invalid:
+            return f"❌ {entries[0]} not found"
+        results = router.pipeline(ADDRESS_LIST_PATH, [('remove', {'.id': entry_id}) for _, entry_id in found])
+        return report_unblocked(chat_id, router, entries, found, results, invalid)
     except Exception as e:
         logger.error(f"Unblock error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_terminal(chat_id, command):
+def report_unblocked(chat_id, router, entries, found, results, invalid):
+    """Forget the entries the router removed and summarize the unblock"""
+    removed, rejected = [], []
+    for (entry, _), (_, error) in zip(found, results):
+        if error:
+            rejected.append(trap_message(error))
+        else:
+            removed.append(entry)
+            router.blocks.forget(entry)
+    router.cache.invalidate(ADDRESS_LIST_PATH)
+    logger.warning(f"{len(removed)} addresses unblocked by {chat_id}: {' '.join(removed[:20])}")
+    return bulk_summary("✅ Unblocked", removed, "", len(entries) - len(found), "not found", rejected, invalid)
+
+TERMINAL_DANGEROUS = ['reboot', 'reset', 'shutdown', 'remove', 'delete']
+
+def cmd_terminal(chat_id, command, router=None):
     """Execute terminal command on router"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     if not is_admin(chat_id):
         return "🔒 Admin only"
     
     # Block dangerous commands
-    dangerous = ['reboot', 'reset', 'shutdown', 'remove', 'delete']
-    if any(cmd in command.lower() for cmd in dangerous):
+    if any(cmd in command.lower() for cmd in TERMINAL_DANGEROUS):
         logger.warning(f"Blocked dangerous command from {chat_id}: {command}")
         return "🔒 Dangerous command blocked. Use WebFig for system changes."
     
     try:
-        api = pool.get_api()
-        
         # Parse command path and parameters
-        # Format: /system/resource or /ip/address print etc.
+        # Format: /system/resource or /ip/address print .proplist=address ?interface=ether1
         parts = command.strip().split()
         if not parts:
             return "❌ Invalid command"
-        
-        path = parts[0]
-        action = parts[1] if len(parts) > 1 else 'print'
-        
-        # Validate path starts with /
-        if not path.startswith('/'):
-            return "❌ Command must start with / (e.g., /system/resource)"
+        try:
+            path, action, props, queries = parse_print_words(parts)
+        except ValueError as e:
+            return f"❌ {e}"
         
         # Execute command
         try:
-            resource = api.get_resource(path)
-            
             if action == 'print':
-                result = resource.call('print')
-                if isinstance(result, list):
-                    if not result:
-                        return f"No data from {path}"
-                    msg = f"📟 {path}\n\n"
-                    # Show first 5 results max
-                    for i, item in enumerate(result[:5], 1):
-                        msg += f"─ Entry {i}:\n"
-                        for key, value in list(item.items())[:5]:
-                            if key not in ['.id', '.path']:
-                                msg += f"  {key}: {str(value)[:50]}\n"
-                        msg += "\n"
-                    if len(result) > 5:
-                        msg += f"... and {len(result)-5} more entries"
-                    return msg
-                else:
-                    return f"Result: {str(result)[:200]}"
+                # Streamed and cut off: a full table belongs in terminal export
+                attrs = {'.proplist': ','.join(props)} if props else {}
+                rows = router.stream(path, attrs=attrs, queries=queries)
+                try:
+                    return format_terminal(path, list(islice(rows, TERMINAL_MAX_ROWS + 1)))
+                finally:
+                    rows.close()
             else:
                 return f"❌ Action '{action}' not supported. Use: /path/to/resource print"
                 
@@ -400,229 +2926,1452 @@ def cmd_terminal(chat_id, command):
         logger.error(f"Terminal error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
-def cmd_daily_checklist(chat_id):
+def format_terminal(path, result):
+    """Terminal reply for up to TERMINAL_MAX_ROWS + 1 printed rows"""
+    if not result:
+        return f"No data from {path}"
+    entries = []
+    for i, item in enumerate(result[:TERMINAL_MAX_ROWS], 1):
+        entry = f"─ Entry {i}:\n"
+        for key, value in list(item.items())[:5]:
+            if key not in ['id', '.id', '.path']:
+                entry += f"  {key}: {str(value)[:50]}\n"
+        entries.append(entry)
+    if len(result) > TERMINAL_MAX_ROWS:
+        entries.append(f"✂️ First {TERMINAL_MAX_ROWS} rows only. For all of them:\n"
+                       f"terminal export {path}")
+    # 5 entries per page
+    return Paged(f"📟 {path}", entries, 5)
+
+def cmd_export(chat_id, command, router=None):
+    """Stream a print into a gzip CSV or JSON lines document"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    if any(cmd in command.lower() for cmd in TERMINAL_DANGEROUS):
+        logger.warning(f"Blocked dangerous export from {chat_id}: {command}")
+        return "🔒 Dangerous command blocked. Use WebFig for system changes."
+    words = command.split()
+    fmt = words.pop(0).lower() if words and words[0].lower() in EXPORT_FORMATS else None
+    try:
+        path, action, props, queries = parse_print_words(words)
+    except ValueError as e:
+        return f"❌ {e}"
+    if action != 'print':
+        return "❌ Only print can be exported, e.g. terminal export csv /ip/route .proplist=dst-address,gateway"
+    # CSV columns must be known up front; JSON lines keep every field of every row
+    fmt = fmt or ('csv' if props else 'jsonl')
+    if fmt == 'csv' and not props:
+        return f"❌ CSV needs the columns: terminal export csv {path} .proplist=name,..."
+    started = time.monotonic()
+    out = tempfile.TemporaryFile(prefix='export-')
+    rows = router.stream(path, attrs={'.proplist': ','.join(props)} if props else {}, queries=queries)
+    try:
+        count, truncated = write_export(rows, fmt, out, props)
+    except Exception as e:
+        out.close()
+        logger.error(f"Export error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+    finally:
+        rows.close()
+    if not count:
+        out.close()
+        return f"No data from {path}"
+    size = out.seek(0, os.SEEK_END)
+    name = f"{router.name}{path.replace('/', '-')}-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}.gz"
+    caption = f"📦 {path}: {count:,} rows, {format_bytes(size)} gzipped in {time.monotonic() - started:.1f}s"
+    if truncated:
+        caption += f"\n⚠️ Cut off at the {format_bytes(EXPORT_MAX_BYTES)} upload limit"
+    return Document(name, out, caption)
+
+def check_system(router):
+    """Checklist: CPU, memory, uptime and version"""
+    return format_check_system(router.print('/system/resource', props=RESOURCE_PROPS)[0])
+
+def format_check_system(resource):
+    """Checklist section for a /system/resource row"""
+    cpu = resource.get('cpu-load', '?')
+    mem_total = int(resource.get('total-memory', 0))
+    mem_free = int(resource.get('free-memory', 0))
+    mem_used = mem_total - mem_free
+    mem_percent = (mem_used / mem_total * 100) if mem_total > 0 else 0
+    uptime = resource.get('uptime', '?')
+    
+    msg = f"✅ CPU Load: {cpu}%\n"
+    msg += f"✅ Memory: {mem_percent:.1f}% used\n"
+    msg += f"✅ Uptime: {uptime}\n"
+    msg += f"✅ Version: {resource.get('version', '?')}\n"
+    return msg
+
+def check_devices(router):
+    """Checklist: bound DHCP leases, served from the lease index"""
+    router.leases.ensure_started()
+    return format_check_devices(router.leases.bound())
+
+def format_check_devices(bound):
+    """Checklist section for bound lease rows"""
+    msg = f"✅ Connected: {len(bound)} devices\n"
+    for device in bound[:3]:
+        name = device.get('comment', device.get('host-name', 'Unknown'))
+        ip = device.get('address', '?')
+        msg += f"   • {name}: {ip}\n"
+    if len(bound) > 3:
+        msg += f"   ... and {len(bound)-3} more\n"
+    return msg
+
+def check_bandwidth(router):
+    """Checklist: queue counts and the top consumer"""
+    queues = router.print('/queue/simple', props=QUEUE_PROPS)
+    if any(q.get('rate', '0/0') != '0/0' for q in queues):
+        router.leases.ensure_started()
+    return format_check_bandwidth(queues, router.leases.name_for_target)
+
+def format_check_bandwidth(queues, name_for_target):
+    """Checklist section for queue rows, naming targets through name_for_target"""
+    active = [q for q in queues if q.get('rate', '0/0') != '0/0']
+    msg = f"✅ Total Queues: {len(queues)}\n"
+    msg += f"✅ Active Traffic: {len(active)} queues\n"
+    
+    # Top consumer
+    if active:
+        top = max(active, key=lambda q: int(q.get('rate', '0/0').split('/')[1] or 0))
+        name = name_for_target(top.get('target', '?')) or top.get('name', '?')
+        msg += f"✅ Top Consumer: {name}\n"
+    return msg
+
+def check_firewall(router):
+    """Checklist: filter rule count"""
+    rules = router.print('/ip/firewall/filter', props=FILTER_PROPS)
+    return f"✅ Firewall Rules: {len(rules)} active\n"
+
+def check_blocked(router):
+    """Checklist: blocked address count"""
+    router.blocks.ensure_started()
+    return f"✅ Blocked IPs: {len(router.blocks)}\n"
+
+def check_critical_logs(router):
+    """Checklist: critical log entries"""
+    router.logs.ensure_started()
+    return f"✅ Critical Logs: {router.logs.count('critical')}\n"
+
+def check_services(router):
+    """Checklist: enabled IP services"""
+    return format_check_services(router.print('/ip/service', {'disabled': 'false'}, ('name', 'port')))
+
+def format_check_services(enabled):
+    """Checklist section for enabled service rows"""
+    msg = f"✅ Services Enabled: {len(enabled)}\n"
+    for svc in enabled[:4]:
+        port = svc.get('port', '?')
+        name = svc.get('name', '?')
+        msg += f"   • {name}: {port}\n"
+    return msg
+
+# Sections in report order; every check runs concurrently
+CHECKLIST_SECTIONS = [
+    ('🔧 SYSTEM HEALTH', [check_system]),
+    ('📱 CONNECTED DEVICES', [check_devices]),
+    ('📊 BANDWIDTH STATUS', [check_bandwidth]),
+    ('🔒 SECURITY', [check_firewall, check_blocked, check_critical_logs]),
+    ('🌐 SERVICES', [check_services]),
+]
+
+checklist_executor = ThreadPoolExecutor(max_workers=CHECKLIST_WORKERS, thread_name_prefix='checklist')
+
+def timed(fn, *args):
+    """Run fn, returning (result, seconds)"""
+    started = time.monotonic()
+    result = fn(*args)
+    return result, time.monotonic() - started
+
+def cmd_daily_checklist(chat_id, router=None):
     """Run daily monitoring checklist"""
-    if not pool:
+    router = router or fleet.default
+    if not router:
         return "❌ Router offline"
     if not is_admin(chat_id):
         return "🔒 Admin only"
     
     try:
-        api = pool.get_api()
-        msg = "📋 Daily System Checklist\n\n"
-        
-        # 1. System Health
-        msg += "━━━━━ 🔧 SYSTEM HEALTH ━━━━━\n"
-        try:
-            resource = api.get_resource('/system/resource').call('print')[0]
-            cpu = resource.get('cpu-load', '?')
-            mem_total = int(resource.get('total-memory', 0))
-            mem_free = int(resource.get('free-memory', 0))
-            mem_used = mem_total - mem_free
-            mem_percent = (mem_used / mem_total * 100) if mem_total > 0 else 0
-            uptime = resource.get('uptime', '?')
-            
-            msg += f"✅ CPU Load: {cpu}%\n"
-            msg += f"✅ Memory: {mem_percent:.1f}% used\n"
-            msg += f"✅ Uptime: {uptime}\n"
-            msg += f"✅ Version: {resource.get('version', '?')}\n\n"
-        except Exception as e:
-            msg += f"❌ Error: {str(e)[:50]}\n\n"
-        
-        # 2. Connected Devices
-        msg += "━━━━━ 📱 CONNECTED DEVICES ━━━━━\n"
-        try:
-            leases = api.get_resource('/ip/dhcp-server/lease').call('print')
-            bound = [l for l in leases if l.get('status') == 'bound']
-            msg += f"✅ Connected: {len(bound)} devices\n"
-            for device in bound[:3]:
-                name = device.get('comment', device.get('host-name', 'Unknown'))
-                ip = device.get('address', '?')
-                msg += f"   • {name}: {ip}\n"
-            if len(bound) > 3:
-                msg += f"   ... and {len(bound)-3} more\n"
-            msg += "\n"
-        except Exception as e:
-            msg += f"❌ Error: {str(e)[:50]}\n\n"
-        
-        # 3. Bandwidth Status
-        msg += "━━━━━ 📊 BANDWIDTH STATUS ━━━━━\n"
-        try:
-            queues = api.get_resource('/queue/simple').call('print')
-            active = [q for q in queues if q.get('rate', '0/0') != '0/0']
-            msg += f"✅ Total Queues: {len(queues)}\n"
-            msg += f"✅ Active Traffic: {len(active)} queues\n"
-            
-            # Top consumer
-            if active:
-                leases = api.get_resource('/ip/dhcp-server/lease').call('print')
-                device_names = {}
-                for lease in leases:
-                    ip = lease.get('address', '')
-                    name = lease.get('comment', '').strip()
-                    if not name:
-                        name = lease.get('host-name', '').strip()
-                    if name and ip:
-                        device_names[ip] = name
-                
-                top_rate = max([int(q.get('rate', '0/0').split('/')[1] or 0) for q in active], default=0)
-                for q in active:
-                    if int(q.get('rate', '0/0').split('/')[1] or 0) == top_rate:
-                        target = q.get('target', '?')
-                        name = device_names.get(target, q.get('name', '?'))
-                        msg += f"✅ Top Consumer: {name}\n"
-                        break
+        started = time.monotonic()
+        futures = {check: checklist_executor.submit(timed, check, router)
+                   for _, checks in CHECKLIST_SECTIONS for check in checks}
+        wait(futures.values(), timeout=CHECKLIST_TIMEOUT)
+        # Partial report: a slow check keeps running in the background
+        return format_checklist([(title, [futures[check] for check in checks]) for title, checks in CHECKLIST_SECTIONS],
+                                started)
+    except Exception as e:
+        logger.error(f"Daily checklist error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+def format_checklist(sections, started):
+    """Checklist report from (title, futures) sections; each future holds a (text, seconds) result"""
+    msg = "📋 Daily System Checklist\n\n"
+    incomplete = 0
+    for title, futures in sections:
+        body = ""
+        took = 0.0
+        for future in futures:
+            if not future.done():
+                body += f"⏱ No answer within {CHECKLIST_TIMEOUT:.0f}s\n"
+                took = CHECKLIST_TIMEOUT
+                incomplete += 1
+            elif future.exception():
+                body += f"❌ Error: {str(future.exception())[:50]}\n"
+                incomplete += 1
+            else:
+                text, seconds = future.result()
+                body += text
+                took = max(took, seconds)
+        msg += f"━━━━━ {title} ━━━━━ ⏱{took * 1000:.0f}ms\n{body}\n"
+    
+    # Summary
+    msg += "━━━━━ ✅ SUMMARY ━━━━━\n"
+    if incomplete:
+        msg += f"⚠️ {incomplete} check(s) incomplete\n"
+    else:
+        msg += "All systems operational\n"
+    msg += f"Report built in {(time.monotonic() - started) * 1000:.0f}ms\n"
+    msg += "Check details with /terminal command\n"
+    return msg
+
+def cmd_cpu_history(chat_id, seconds, router=None):
+    """CPU and memory statistics from the sample history"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    since = time.time() - seconds
+    msg = f"⚙️ Last {format_window(seconds)}:\n\n"
+    found = False
+    for key, label in [('cpu', 'CPU'), ('mem', 'Memory')]:
+        st = summarize(router.metrics.system.window(key, since))
+        if st:
+            found = True
+            msg += f"{label}: min {st['min']:.0f}% · avg {st['avg']:.0f}% · max {st['max']:.0f}% · p95 {st['p95']:.0f}%\n"
+    if not found:
+        return "⏳ No samples yet. History fills in every SAMPLE_INTERVAL seconds."
+    return msg
+
+def cmd_traffic_history(chat_id, seconds, router=None):
+    """Per-interface throughput statistics from the sample history"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    since = time.time() - seconds
+    ring = router.metrics.system
+    msg = f"📈 Traffic, last {format_window(seconds)} (avg / p95 / max):\n\n"
+    lines = 0
+    for key in sorted(ring.keys()):
+        if not key.endswith(':rx'):
+            continue
+        name = key[:-3]
+        rx = summarize(ring.window(key, since))
+        tx = summarize(ring.window(f'{name}:tx', since))
+        if not rx or not tx:
+            continue
+        msg += f"{name}\n  ↓ {format_bits(rx['avg'])} / {format_bits(rx['p95'])} / {format_bits(rx['max'])}\n"
+        msg += f"  ↑ {format_bits(tx['avg'])} / {format_bits(tx['p95'])} / {format_bits(tx['max'])}\n"
+        lines += 1
+    if not lines:
+        return "⏳ No samples yet. History fills in every SAMPLE_INTERVAL seconds."
+    return msg
+
+def cmd_top5_history(chat_id, seconds, router=None):
+    """Top 5 queues by average download rate over a window"""
+    router = router or fleet.default
+    if not router:
+        return "❌ Router offline"
+    since = time.time() - seconds
+    ring = router.metrics.queues
+    t = []
+    for key in ring.keys():
+        if key.endswith(':down'):
+            st = summarize(ring.window(key, since))
+            if st:
+                t.append((key[:-5], st))
+    if not t:
+        return "⏳ No samples yet. History fills in every SAMPLE_INTERVAL seconds."
+    t.sort(key=lambda x: x[1]['avg'], reverse=True)
+    msg = f"🔥 Top 5, last {format_window(seconds)} (avg / max):\n\n"
+    for idx, (n, st) in enumerate(t[:5], 1):
+        msg += f"{idx}. {n}: {format_bits(st['avg'])} / {format_bits(st['max'])}\n"
+    return msg
+
+def describe_device(row):
+    """Name, MAC and IP of a history device row, plus its router in a fleet"""
+    router_name, device, mac, ip, name = row[:5]
+    where = f" @{router_name}" if len(fleet.routers) > 1 else ""
+    details = ', '.join(x for x in (mac, ip) if x)
+    return f"{name or device}{f' ({details})' if details else ''}{where}"
+
+def cmd_usage(chat_id, query, seconds):
+    """Traffic of one device over a window, from the history store"""
+    if not history:
+        return "❌ History store is disabled (HISTORY_DB)"
+    try:
+        devices = history.find_devices(query)
+        if not devices:
+            return f"❓ No device matching {query}"
+        if len(devices) > 1:
+            return "❓ Several devices match:\n\n" + "\n".join(f"• {describe_device(d)}" for d in devices[:5])
+        router_name, device = devices[0][:2]
+        rx, tx, days = history.usage(router_name, device, time.time() - seconds)
+        msg = f"📦 {describe_device(devices[0])}\nLast {format_window(seconds)}: ⬇️ {format_bytes(rx)} ⬆️ {format_bytes(tx)}\n"
+        if len(days) > 1:
             msg += "\n"
-        except Exception as e:
-            msg += f"❌ Error: {str(e)[:50]}\n\n"
-        
-        # 4. Security Status
-        msg += "━━━━━ 🔒 SECURITY ━━━━━\n"
-        try:
-            # Check firewall
-            rules = api.get_resource('/ip/firewall/filter').call('print')
-            msg += f"✅ Firewall Rules: {len(rules)} active\n"
-            
-            # Check address list (blocked IPs)
-            blocked = api.get_resource('/ip/firewall/address-list').call('print')
-            blocked_list = [b for b in blocked if b.get('list') == 'blocked']
-            msg += f"✅ Blocked IPs: {len(blocked_list)}\n"
-            
-            # Check recent logs
-            logs = api.get_resource('/log').call('print')
-            critical = [l for l in logs if 'critical' in l.get('topics', '').lower()]
-            msg += f"✅ Critical Logs: {len(critical)}\n\n"
-        except Exception as e:
-            msg += f"❌ Error: {str(e)[:50]}\n\n"
-        
-        # 5. Services
-        msg += "━━━━━ 🌐 SERVICES ━━━━━\n"
-        try:
-            services = api.get_resource('/ip/service').call('print')
-            enabled = [s for s in services if not s.get('disabled')]
-            msg += f"✅ Services Enabled: {len(enabled)}\n"
-            for svc in enabled[:4]:
-                port = svc.get('port', '?')
-                name = svc.get('name', '?')
-                msg += f"   • {name}: {port}\n"
+            for day, day_rx, day_tx in days[-14:]:
+                msg += f"{time.strftime('%a %d %b', time.gmtime(day))}: ⬇️ {format_bytes(day_rx)} ⬆️ {format_bytes(day_tx)}\n"
+        return msg
+    except Exception as e:
+        logger.error(f"Usage error: {e}")
+        return f"❌ Error: {str(e)[:80]}"
+
+def cmd_seen(chat_id, query):
+    """When a device was first, last and recently online, from the history store"""
+    if not history:
+        return "❌ History store is disabled (HISTORY_DB)"
+    try:
+        devices = history.find_devices(query)
+        if not devices:
+            return f"❓ No device matching {query}"
+        now = time.time()
+        msg = ""
+        for row in devices[:5]:
+            router_name, device, mac, ip, name, first_seen, last_seen = row
+            router = fleet.get(router_name)
+            lease = router.leases.by_mac(mac) if router and mac else None
+            online = lease is not None and lease.get('status') == 'bound'
+            msg += f"{'🟢' if online else '⚪'} {describe_device(row)}\n"
+            msg += f"First seen: {format_time(first_seen)}\n"
+            msg += f"Last seen: {format_time(last_seen)} ({format_age(now - last_seen)} ago)\n"
+            if mac:
+                for start, end in history.sessions(router_name, mac):
+                    until = format_time(end)
+                    msg += f"  {format_time(start)} → {until[11:] if until[:10] == format_time(start)[:10] else until}\n"
             msg += "\n"
-        except Exception as e:
-            msg += f"❌ Error: {str(e)[:50]}\n\n"
-        
-        # 6. Summary
-        msg += "━━━━━ ✅ SUMMARY ━━━━━\n"
-        msg += "All systems operational\n"
-        msg += "Check details with /terminal command\n"
-        
         return msg
-        
     except Exception as e:
-        logger.error(f"Daily checklist error: {e}")
+        logger.error(f"Seen error: {e}")
         return f"❌ Error: {str(e)[:80]}"
 
+def format_window(seconds):
+    """Render a window length like 90m or 24h"""
+    for unit, size in [('d', 86400), ('h', 3600), ('m', 60)]:
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+# Help sections in display order; admin and fleet sections are shown when they apply
+HELP_SECTIONS = (
+    ('main', ''),
+    ('history', '📉 History:'),
+    ('admin', '🔒 Admin:'),
+    ('fleet', '🌐 Fleet:'),
+)
+
 def cmd_help(chat_id):
-    """Show help"""
+    """Show help, generated from the command registry"""
     admin = is_admin(chat_id)
-    msg = "📚 MikroTik Bot Commands:\n\n"
-    msg += "📊 Speed - Bandwidth\n"
-    msg += "📱 Devices - DHCP list\n"
-    msg += "⚙️ Status - Router info\n"
-    msg += "🔥 Top5 - Top consumers\n"
-    msg += "📈 Traffic - Interface stats\n"
-    msg += "📝 Logs - System logs\n"
-    if admin:
-        msg += "\n🔒 Admin:\n"
-        msg += "🗂️ Backup - Save config\n"
-        msg += "🚫 Firewall - View rules\n"
-        msg += "🔒 Block/Unblock IP\n"
-        msg += "💻 Terminal - Run commands\n"
-        msg += "📋 Checklist - Daily health check\n\n"
-        msg += "Format:\n"
-        msg += "block 192.168.1.100\n"
-        msg += "terminal /system/resource\n"
+    msg = "📚 MikroTik Bot Commands:\n"
+    for section, title in HELP_SECTIONS:
+        if section == 'admin' and not admin:
+            continue
+        if section == 'fleet' and len(fleet.routers) < 2:
+            continue
+        msg += f"\n{title}\n" if title else "\n"
+        for command in commands.section(section, admin):
+            msg += f"{command.button or command.usage or command.name} - {command.help}\n"
+        if section == 'fleet':
+            msg += "status all - Every router at once\n"
+            msg += f"top5 {next(iter(fleet.routers))} - One router\n"
+    return msg
+
+def cmd_alerts(chat_id):
+    """List alerts that are currently firing"""
+    if not is_admin(chat_id):
+        return "🔒 Admin only"
+    active = alerts.active()
+    if not active:
+        return f"✅ No active alerts ({len(alerts.rules)} rules)"
+    msg = f"🚨 Active Alerts ({len(active)}):\n\n"
+    for rule, router_name, key in active:
+        msg += f"• [{router_name}] {rule}: {key}\n"
+    return msg
+
+def cmd_routers(chat_id):
+    """List configured routers"""
+    if not fleet.routers:
+        return "❌ No routers configured"
+    msg = f"🌐 Routers ({len(fleet.routers)}):\n\n"
+    for name, router in fleet.routers.items():
+        mark = " (default)" if router is fleet.default else ""
+        msg += f"• {name}: {router.host}{mark}\n"
     return msg
 
+def merge_fleet(results):
+    """One message from per-router replies, in fleet order"""
+    if not results:
+        return "❌ No routers configured"
+    return "\n".join(f"━━━━━ 🌐 {name} ━━━━━\n{reply}" for name, reply in results.items())
+
+def cmd_fleet(chat_id, fn, target):
+    """Run a command on one router, or on every router concurrently"""
+    if target.lower() == 'all':
+        return merge_fleet(fleet.fan_out(fn, chat_id))
+    router = fleet.get(target)
+    if not router:
+        return f"❌ Unknown router: {target}\nKnown: {', '.join(fleet.routers) or 'none'}"
+    return fn(chat_id, router)
+
+# ============== Command Registry ==============
+class Command:
+    """One way to invoke a handler: by exact alias, or by keyword followed by arguments"""
+    def __init__(self, name, handler, button=None, aliases=(), admin=False, parse=None,
+                 fleet=False, usage=None, help=None, section=None, metric=None, limit=None, base=None):
+        self.name = name
+        self.handler = handler
+        self.button = button
+        self.aliases = aliases
+        self.admin = admin
+        # parse(rest) returns handler args, or None when the text is not this command
+        self.parse = parse
+        self.fleet = fleet
+        self.usage = usage
+        self.help = help
+        self.section = section or ('admin' if admin else 'main')
+        self.metric = metric or name
+        # (requests per second, burst) per chat, on top of the per-chat limit
+        self.limit = limit
+        # For a '<name> <router|all>' form: the command it runs on each router
+        self.base = base
+
+class _TrieNode:
+    __slots__ = ('children', 'forms', 'fallback')
+
+    def __init__(self):
+        self.children = {}
+        self.forms = []
+        # Fleet forms accept any single word, so they are tried last
+        self.fallback = []
+
+class CommandRegistry:
+    """Commands by exact alias, plus a word trie of keyword commands that take arguments"""
+    def __init__(self, commands):
+        self.commands = []
+        self.exact = {}
+        self.trie = _TrieNode()
+        for command in commands:
+            self.add(command)
+
+    def _node(self, name):
+        node = self.trie
+        for word in name.split():
+            node = node.children.setdefault(word, _TrieNode())
+        return node
+
+    def add(self, command):
+        """Register a command and, for fleet commands, its '<name> <router|all>' form"""
+        self.commands.append(command)
+        if command.parse is None:
+            for alias in (command.name, f"/{command.name}", command.button, *command.aliases):
+                if alias:
+                    self.exact[alias.lower()] = command
+        else:
+            self._node(command.name).forms.append(command)
+        if command.fleet:
+            self._node(command.name).fallback.append(Command(
+                command.name,
+                lambda chat_id, target, fn=command.handler: cmd_fleet(chat_id, fn, target),
+                admin=command.admin,
+                parse=parse_target_args,
+                metric=f"{command.name}:fleet",
+                limit=command.limit,
+                base=command,
+            ))
+
+    def resolve(self, text):
+        """(command, args) for a message, or (None, ()) when nothing matches"""
+        key = text.strip().lower()
+        # "/speed@MyBot" is how commands arrive in groups; with arguments it is a keyword command
+        command = self.exact.get(key) or (None if ' ' in key else self.exact.get(key.split('@', 1)[0]))
+        if command:
+            return command, ()
+        words = text.split()
+        path = []
+        node = self.trie
+        for depth, word in enumerate(words):
+            word = word.lower()
+            if depth == 0:
+                word = word.lstrip('/').split('@', 1)[0]
+            node = node.children.get(word)
+            if node is None:
+                break
+            path.append(node)
+        # Longest keyword first; the rest of the message is passed verbatim
+        for depth in range(len(path), 0, -1):
+            node = path[depth - 1]
+            rest = text.split(None, depth)[depth] if len(words) > depth else ''
+            for command in node.forms + node.fallback:
+                args = command.parse(rest)
+                if args is not None:
+                    return command, args
+        return None, ()
+
+    def dispatch(self, chat_id, text):
+        """Run the command for text and return its reply; unknown text gets help"""
+        command, args = self.resolve(text)
+        if command is None:
+            command = self.exact['help']
+        if command.admin and not is_admin(chat_id):
+            return "🔒 Admin only"
+        started = time.monotonic()
+        try:
+            return command.handler(chat_id, *args)
+        except Exception:
+            COMMAND_ERRORS.inc(command.metric)
+            raise
+        finally:
+            COMMAND_SECONDS.observe(time.monotonic() - started, command.metric)
+
+    def section(self, section, admin):
+        """Commands listed in one help section"""
+        return [c for c in self.commands if c.section == section and c.help and (admin or not c.admin)]
+
+    def keyboard(self, admin):
+        """Reply keyboard of every button the user may press, two per row"""
+        buttons = [{'text': c.button} for c in self.commands if c.button and (admin or not c.admin)]
+        return {
+            'keyboard': [buttons[i:i + 2] for i in range(0, len(buttons), 2)],
+            'resize_keyboard': True
+        }
+
+    def stats(self):
+        """Calls, errors and mean handler latency per command"""
+        errors = COMMAND_ERRORS.values()
+        return {
+            labels[0]: {
+                'calls': count,
+                'errors': errors.get(labels, 0),
+                'avg_ms': round(total / count * 1000, 1) if count else 0.0,
+            }
+            for labels, (count, total) in COMMAND_SECONDS.totals().items()
+        }
+
+def parse_text_args(rest):
+    """Any non-empty argument text, verbatim"""
+    return (rest,) if rest.strip() else None
+
+def parse_window_args(rest):
+    """'[last] <duration>' as (seconds,)"""
+    words = rest.lower().split()
+    if words[:1] == ['last']:
+        words = words[1:]
+    seconds = parse_duration(words[0]) if len(words) == 1 else None
+    return (seconds,) if seconds else None
+
+def parse_usage_args(rest):
+    """'<device> [duration]' as (device, seconds), 7 days by default"""
+    device, _, last = rest.strip().rpartition(' ')
+    seconds = parse_duration(last)
+    if not seconds:
+        device, seconds = rest.strip(), 7 * 86400
+    return (device, seconds) if device else None
+
+def parse_live_args(rest):
+    """'[interface] [duration]' as (interface or None, seconds)"""
+    interface, seconds = None, LIVE_DEFAULT_DURATION
+    for word in rest.split():
+        duration = parse_duration(word)
+        if duration:
+            seconds = duration
+        elif interface is None:
+            interface = word
+        else:
+            return None
+    return (interface, min(seconds, LIVE_MAX_DURATION))
+
+def parse_logs_args(rest):
+    """'[topic] [count]' as (topic, count)"""
+    args = rest.lower().split()
+    # "logs <router>" and "logs all" are fleet commands
+    if len(args) == 1 and (args[0] == 'all' or args[0] in fleet.routers):
+        return None
+    if len(args) > 2:
+        return None
+    count = int(args.pop()) if args and args[-1].isdigit() else 5
+    if len(args) > 1:
+        return None
+    return (args[0] if args else None, count)
+
+def parse_target_args(rest):
+    """A router name or 'all'"""
+    words = rest.split()
+    return (words[0],) if len(words) == 1 else None
+
+TERMINAL_USAGE = ("💻 Terminal Mode\n\nSend commands like:\n/system/resource\n/ip/address print\n/interface print\n"
+                  "/ip/arp print .proplist=address,mac-address ?interface=bridge\n\nExample:\nterminal /system/resource\n\n"
+                  "Whole tables as a gzip file:\nterminal export csv /ip/route .proplist=dst-address,gateway\n"
+                  "terminal export jsonl /ip/arp")
+BLOCK_USAGE = "🔒 Block IPs\n\nSend addresses, CIDRs or ranges:\nblock 192.168.1.100\nblock 10.0.0.0/24 1.2.3.4-9 timeout=1h\n\nOr send a text file captioned block"
+UNBLOCK_USAGE = "✅ Unblock IPs\n\nSend addresses, CIDRs or ranges:\nunblock 192.168.1.100\nunblock 10.0.0.0/24, 1.2.3.4-9\n\nOr send a text file captioned unblock"
+
+commands = CommandRegistry([
+    # Buttons, in keyboard order
+    Command('speed', cmd_speed, button='📊 Speed', help='Bandwidth', fleet=True, limit=(1 / 5, 3)),
+    Command('devices', cmd_devices, button='📱 Devices', help='DHCP list', fleet=True, limit=(1 / 5, 3)),
+    Command('status', cmd_status, button='⚙️ Status', help='Router info', fleet=True),
+    Command('top5', cmd_top5, button='🔥 Top5', help='Top consumers', fleet=True, limit=(1 / 10, 2)),
+    Command('backup', cmd_backup, button='🗂️ Backup', admin=True, help='Save config', limit=(1 / 300, 1)),
+    Command('logs', cmd_logs, button='📝 Logs', help='System logs', fleet=True),
+    Command('traffic', cmd_traffic, button='📈 Traffic', help='Interface stats', fleet=True, limit=(1 / 10, 2)),
+    Command('firewall', cmd_firewall, button='🚫 Firewall', admin=True, help='View rules', fleet=True),
+    Command('block', lambda chat_id: BLOCK_USAGE, button='🔒 Block IP', admin=True),
+    Command('unblock', lambda chat_id: UNBLOCK_USAGE, button='✅ Unblock IP', admin=True),
+    Command('terminal', lambda chat_id: TERMINAL_USAGE, button='💻 Terminal', admin=True),
+    Command('checklist', cmd_daily_checklist, button='📋 Checklist', admin=True, help='Daily health check', fleet=True,
+            limit=(1 / 60, 2)),
+    Command('help', cmd_help, button='❓ Help'),
+    Command('alerts', cmd_alerts, admin=True, help='Active alerts'),
+    Command('talkers', cmd_talkers, admin=True, help='Top hosts, remotes and ports by connection', limit=(1 / 30, 2)),
+    Command('routers', cmd_routers, help='List routers', section='fleet'),
+
+    # Keywords with arguments
+    Command('logs', cmd_logs_topic, parse=parse_logs_args, usage='logs critical 50', help='Logs by topic'),
+    Command('cpu', cmd_cpu_history, parse=parse_window_args, usage='cpu 24h',
+            help='CPU/memory min/avg/max/p95', section='history'),
+    Command('traffic', cmd_traffic_history, parse=parse_window_args, usage='traffic last 1h',
+            help='Interface throughput', section='history'),
+    Command('top5', cmd_top5_history, parse=parse_window_args, usage='top5 1h',
+            help='Top queues over a window', section='history'),
+    Command('live', cmd_live, parse=parse_live_args, usage='live ether1 2m',
+            help='Live interface bandwidth', limit=(1 / 10, 2)),
+    Command('speed live', cmd_live, parse=parse_live_args, metric='live', limit=(1 / 10, 2)),
+    Command('traffic live', cmd_live, parse=parse_live_args, metric='live', limit=(1 / 10, 2)),
+    Command('usage', cmd_usage, parse=parse_usage_args, usage='usage laptop 7d',
+            help='Traffic of one device', section='history'),
+    Command('seen', cmd_seen, parse=parse_text_args, usage='seen AA:BB:CC:DD:EE:FF',
+            help='When a device was online', section='history'),
+    Command('block', cmd_block, admin=True, parse=parse_text_args,
+            usage='block 10.0.0.0/24 1.2.3.4-9 timeout=1h', help='Block IPs, or send a file captioned block'),
+    Command('unblock', cmd_unblock, admin=True, parse=parse_text_args,
+            usage='unblock 192.168.1.100', help='Unblock IPs'),
+    Command('terminal', cmd_terminal, admin=True, parse=parse_text_args,
+            usage='terminal /system/resource', help='Run a print command', limit=(1 / 5, 3)),
+    Command('terminal export', cmd_export, admin=True, parse=parse_text_args,
+            usage='terminal export /ip/arp', help='Whole table as a gzip CSV/JSONL file', limit=(1 / 30, 2)),
+])
+
+KB = commands.keyboard(admin=False)
+ADMIN_KB = commands.keyboard(admin=True)
+
+# ============== Update Queue ==============
+class ChatQueue:
+    """Bounded job queue run by a worker pool, in order within each chat"""
+    def __init__(self, name, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE, dedup_window=UPDATE_DEDUP_WINDOW):
+        self.name = name
+        self.workers = workers
+        self.maxsize = maxsize
+        self.dedup_window = dedup_window
+        self.depth = 0
+        self.peak_depth = 0
+        self.busy = 0
+        self.accepted = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self._ready = queue.Queue()
+        self._pending = {}
+        self._seen = OrderedDict()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def duplicate(self, update_id):
+        """True, and counted, for an update id already queued"""
+        with self._lock:
+            return self._duplicate(update_id)
+
+    def _duplicate(self, update_id):
+        if update_id is not None and update_id in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def submit(self, key, update_id, job):
+        """Queue job behind earlier jobs for key; returns 'queued', 'duplicate' or 'full'"""
+        with self._lock:
+            if self._duplicate(update_id):
+                return 'duplicate'
+            if self.depth >= self.maxsize:
+                self.rejected += 1
+                return 'full'
+            if update_id is not None:
+                self._seen[update_id] = True
+                if len(self._seen) > self.dedup_window:
+                    self._seen.popitem(last=False)
+            self.depth += 1
+            self.peak_depth = max(self.peak_depth, self.depth)
+            self.accepted += 1
+            jobs = self._pending.get(key)
+            if jobs is None:
+                jobs = self._pending[key] = deque()
+                self._ready.put(key)
+            jobs.append((time.monotonic(), job))
+        if self.workers <= 0:
+            self._drain()
+        else:
+            self._ensure_workers()
+        return 'queued'
+
+    def _ensure_workers(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work, name=f'{self.name}-{len(self._threads)}', daemon=True)
+                self._threads.append(t)
+                t.start()
+
+    def _work(self):
+        while True:
+            self._run_next(self._ready.get())
+
+    def _drain(self):
+        """Run queued jobs on the calling thread (workers=0)"""
+        while True:
+            try:
+                key = self._ready.get_nowait()
+            except queue.Empty:
+                return
+            self._run_next(key)
+
+    def _run_next(self, key):
+        """Run one job for key, then requeue key if it has more"""
+        with self._lock:
+            queued_at, job = self._pending[key].popleft()
+            self.depth -= 1
+            self.busy += 1
+            self.wait_total += time.monotonic() - queued_at
+        try:
+            job()
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"{self.name} job error: {e}")
+        finally:
+            with self._lock:
+                self.busy -= 1
+                self.processed += 1
+                if self._pending[key]:
+                    self._ready.put(key)
+                else:
+                    del self._pending[key]
+
+    def stats(self):
+        """Backpressure metrics"""
+        started = self.processed + self.busy
+        return {
+            'workers': self.workers,
+            'depth': self.depth,
+            'peak_depth': self.peak_depth,
+            'capacity': self.maxsize,
+            'busy': self.busy,
+            'accepted': self.accepted,
+            'processed': self.processed,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self.wait_total / started * 1000, 1) if started else 0.0,
+        }
+
+updates = ChatQueue('update-worker')
+
+# ============== Telegram Client ==============
+class TokenBucket:
+    """Thread-safe token bucket"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returning how long to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_take(self):
+        """Take a token if one is available; otherwise return seconds until one is"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    def refilled(self):
+        """True once the bucket is back to its burst, when it is no different from a new one"""
+        with self._lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+class TelegramClient:
+    """Bot API client: pooled keep-alive session, rate limits, retries"""
+    def __init__(self, token, workers=TELEGRAM_SEND_WORKERS, max_chats=LIMITER_CHATS):
+        self.base_url = f"{TELEGRAM_API_URL}/bot{token}"
+        self.file_url = f"{TELEGRAM_API_URL}/file/bot{token}"
+        self.workers = workers
+        self.max_chats = max_chats
+        self.reset_session()
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, burst=TELEGRAM_GLOBAL_RATE)
+        self.outbox = ChatQueue('telegram-sender', workers=workers, maxsize=1024, dedup_window=0)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self.latencies = deque(maxlen=512)
+        self._chat_buckets = OrderedDict()   # chat_id -> TokenBucket, least recent first
+        self._lock = threading.Lock()
+
+    def reset_session(self):
+        """Fresh keep-alive pool, also used after fork"""
+        self.session = requests.Session()
+        self.session.mount(TELEGRAM_API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=max(self.workers, 1) * 2))
+
+    def chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chat_buckets.pop(chat_id, None)
+            if bucket is None:
+                # Refilled buckets carry no state, so the least recent ones go first
+                while self._chat_buckets and next(iter(self._chat_buckets.values())).refilled():
+                    self._chat_buckets.popitem(last=False)
+                while len(self._chat_buckets) >= self.max_chats:
+                    self._chat_buckets.popitem(last=False)
+                # Negative ids are groups and channels, which have a lower limit
+                rate = TELEGRAM_CHAT_RATE if chat_id > 0 else TELEGRAM_GROUP_RATE
+                bucket = TokenBucket(rate, burst=3 if chat_id > 0 else 1)
+            self._chat_buckets[chat_id] = bucket
+            return bucket
+
+    def call(self, method, payload=None, files=None, timeout=10):
+        """Call a Bot API method with rate limiting and retries; returns result or None"""
+        payload = payload or {}
+        chat_id = payload.get('chat_id')
+        started = time.monotonic()
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            if chat_id is not None:
+                self.chat_bucket(chat_id).acquire()
+            self.global_bucket.acquire()
+            retry_after = None
+            try:
+                if files:
+                    # A retry uploads every file from the start again
+                    for _, fileobj, *_ in files.values():
+                        fileobj.seek(0)
+                    r = self.session.post(f"{self.base_url}/{method}", data=payload, files=files, timeout=timeout)
+                else:
+                    r = self.session.post(f"{self.base_url}/{method}", json=payload, timeout=timeout)
+                if r.status_code == 429:
+                    self.throttled += 1
+                    retry_after = r.json().get('parameters', {}).get('retry_after', 1)
+                elif r.status_code < 500:
+                    body = r.json()
+                    if body.get('ok'):
+                        self.sent += 1
+                        self.latencies.append(time.monotonic() - started)
+                        TELEGRAM_SECONDS.observe(time.monotonic() - started, method)
+                        return body.get('result')
+                    self.failed += 1
+                    TELEGRAM_ERRORS.inc(method)
+                    logger.error(f"Telegram {method} rejected: {body.get('description')}")
+                    return None
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"Telegram {method} error: {e}")
+            if attempt == TELEGRAM_MAX_RETRIES:
+                break
+            self.retries += 1
+            delay = retry_after if retry_after is not None else min(2 ** attempt * 0.5, 30)
+            time.sleep(delay + random.uniform(0, 0.5))
+        self.failed += 1
+        TELEGRAM_ERRORS.inc(method)
+        TELEGRAM_SECONDS.observe(time.monotonic() - started, method)
+        logger.error(f"Telegram {method} failed after {TELEGRAM_MAX_RETRIES} retries")
+        return None
+
+    def send_message(self, chat_id, text, keyboard=None):
+        """Queue text for chat_id, split into messages of Telegram's maximum length"""
+        chunks = split_text(text)
+        for i, chunk in enumerate(chunks):
+            payload = {'chat_id': chat_id, 'text': chunk, 'parse_mode': 'HTML'}
+            if keyboard and i == len(chunks) - 1:
+                payload['reply_markup'] = keyboard
+            if self.outbox.submit(chat_id, None, lambda p=payload: self.call('sendMessage', p)) == 'full':
+                self.failed += 1
+                logger.error(f"Outbound queue full, dropping message to {chat_id}")
+
+    def send_document(self, chat_id, document):
+        """Queue an upload of a Document; its file is closed once sent or dropped"""
+        def job():
+            try:
+                self.call('sendDocument', {'chat_id': chat_id, 'caption': document.caption},
+                          files={'document': (document.filename, document.fileobj, 'application/gzip')}, timeout=120)
+            finally:
+                document.fileobj.close()
+        if self.outbox.submit(chat_id, None, job) == 'full':
+            self.failed += 1
+            document.fileobj.close()
+            logger.error(f"Outbound queue full, dropping document to {chat_id}")
+
+    def download(self, file_id, limit):
+        """Text of a file sent to the bot, or None if it is missing or over limit bytes"""
+        info = self.call('getFile', {'file_id': file_id})
+        if not info or 'file_path' not in info or info.get('file_size', 0) > limit:
+            return None
+        try:
+            r = self.session.get(f"{self.file_url}/{info['file_path']}", timeout=30)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logger.error(f"Telegram file download error: {e}")
+            return None
+        return r.content[:limit].decode('utf-8', errors='replace')
+
+    def edit_message(self, chat_id, message_id, text, keyboard=None):
+        """Queue an in-place edit of a message sent earlier"""
+        payload = {'chat_id': chat_id, 'message_id': message_id, 'text': text, 'parse_mode': 'HTML'}
+        if keyboard:
+            payload['reply_markup'] = keyboard
+        if self.outbox.submit(chat_id, None, lambda: self.call('editMessageText', payload)) == 'full':
+            self.failed += 1
+            logger.error(f"Outbound queue full, dropping edit for {chat_id}")
+
+    def answer_callback(self, chat_id, query_id, text=None):
+        """Queue the answer that stops the button spinner, ordered with the chat's other sends"""
+        payload = {'callback_query_id': query_id}
+        if text:
+            payload['text'] = text
+        if self.outbox.submit(chat_id, None, lambda: self.call('answerCallbackQuery', payload)) == 'full':
+            self.failed += 1
+            logger.error(f"Outbound queue full, dropping callback answer for {chat_id}")
+
+    def stats(self):
+        """Reply latency and delivery metrics"""
+        lat = sorted(self.latencies)
+        done = self.sent + self.failed
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'chat_buckets': len(self._chat_buckets),
+            'success_rate': round(self.sent / done, 4) if done else 1.0,
+            'latency_p50_ms': round(lat[len(lat) // 2] * 1000, 1) if lat else 0.0,
+            'latency_p95_ms': round(lat[int(len(lat) * 0.95)] * 1000, 1) if lat else 0.0,
+            'queue': self.outbox.stats(),
+        }
+
+telegram = TelegramClient(BOT_TOKEN)
+
+# ============== Rate Limiting ==============
+class RequestLimiter:
+    """Token buckets per chat and per chat and command, and coalescing of identical in-flight requests
+
+    With a shared cache, buckets, in-flight requests and notices live in the daemon, so the
+    limits hold for the whole host and not for each worker; the local ones are the fallback.
+    """
+    def __init__(self, rate=USER_RATE, burst=USER_BURST, max_chats=LIMITER_CHATS, shared=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self.shared = shared
+        self.limited = 0
+        self.coalesced = 0
+        self._buckets = OrderedDict()   # chat_id or (chat_id, command) -> TokenBucket, least recent first
+        self._inflight = set()          # (chat_id, command, text) queued or running
+        self._notified = {}             # bucket key -> time the "slow down" notice stops applying
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate, burst):
+        with self._lock:
+            bucket = self._buckets.pop(key, None) or TokenBucket(rate, burst)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_chats:
+                old, _ = self._buckets.popitem(last=False)
+                self._notified.pop(old, None)
+            return bucket
+
+    def admit(self, chat_id, text):
+        """Key to run the request under, or None if it was coalesced or limited"""
+        command, args = commands.resolve(text)
+        command = command or commands.exact['help']
+        # Parsed args can hold lists, so identical requests are matched on their normalized text
+        key = (chat_id, command.metric, ' '.join(text.split()))
+        with self._lock:
+            if key in self._inflight:
+                # Same request still queued or running: its reply answers this one too
+                self.coalesced += 1
+                return None
+            # Claimed in the same step as the check, so two threads cannot both pass it
+            self._inflight.add(key)
+        if not self._hold(key):
+            with self._lock:
+                self._inflight.discard(key)
+                self.coalesced += 1
+            return None
+        checks = [(chat_id, self.rate, self.burst)]
+        if command.limit:
+            checks.insert(0, ((chat_id, command.metric), *command.limit))
+        for bucket_key, rate, burst in checks:
+            wait = self._take(bucket_key, rate, burst)
+            if wait:
+                self.release(key)
+                self._deny(chat_id, bucket_key, wait)
+                return None
+        return key
+
+    @staticmethod
+    def _name(key):
+        return 'limit:' + ':'.join(str(part) for part in (key if isinstance(key, tuple) else (key,)))
+
+    @staticmethod
+    def _owner():
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _take(self, bucket_key, rate, burst):
+        if self.shared:
+            try:
+                return self.shared.take(self._name(bucket_key), rate, burst)
+            except SharedCacheError as e:
+                logger.warning(f"{e}; rate limiting per worker")
+        return self._bucket(bucket_key, rate, burst).try_take()
+
+    def _hold(self, key):
+        """Claim an in-flight request for this worker; False if another worker is running it"""
+        if not self.shared:
+            return True
+        try:
+            # Lapses if the worker dies mid-request, so the request is not blocked for good
+            return self.shared.lease(self._name(('inflight', *key)), self._owner(), LIMITER_INFLIGHT_TTL)
+        except SharedCacheError as e:
+            logger.warning(f"{e}; coalescing per worker")
+            return True
+
+    def _unhold(self, key):
+        if self.shared:
+            try:
+                self.shared.unlease(self._name(('inflight', *key)), self._owner())
+            except SharedCacheError as e:
+                logger.warning(f"{e}; in-flight request kept until it lapses")
+
+    def _deny(self, chat_id, bucket_key, wait):
+        now = time.monotonic()
+        with self._lock:
+            self.limited += 1
+            if self._notified.get(bucket_key, 0) > now:
+                return
+            self._notified[bucket_key] = now + wait
+        if self.shared:
+            try:
+                # A lease nobody renews: granted to the first worker until the bucket refills
+                if not self.shared.lease(self._name(('notice', bucket_key)), f"{self._owner()}:{now}", wait):
+                    return
+            except SharedCacheError:
+                pass
+        # One notice per empty bucket, so the notices are rate limited too
+        send_message(chat_id, f"⏳ Too many requests, try again in {math.ceil(wait)}s")
+
+    def release(self, key):
+        """Mark a request as finished, or as never queued"""
+        with self._lock:
+            self._inflight.discard(key)
+        self._unhold(key)
+
+    def run(self, key, fn, *args):
+        try:
+            return fn(*args)
+        finally:
+            self.release(key)
+
+    def stats(self):
+        return {
+            'limited': self.limited,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._inflight),
+            'buckets': len(self._buckets),
+        }
+
+limiter = RequestLimiter(shared=shared_cache)
+
 # ============== Main Webhook ==============
+_background_started = False
+
+def start_background():
+    """Start background samplers once per process"""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    leader.start()
+    fleet.start_samplers()
+    if history:
+        history.start()
+
+def after_fork():
+    """Drop connections and threads inherited from a parent that imported the app (gunicorn --preload)"""
+    global _background_started
+    _background_started = False
+    leader._thread = None
+    for router in fleet.routers.values():
+        router.link = RouterLink(router)
+    telegram.reset_session()
+    if history:
+        history.reopen()
+
 @app.route(f'/{BOT_TOKEN}', methods=['POST'])
 def webhook():
-    """Main webhook handler"""
+    """Main webhook handler: validate, queue and acknowledge at once"""
     try:
         update = request.get_json(force=True)
     except:
         return jsonify({'ok': False})
     
+    if accept_update(update) == 'full':
+        # Non-2xx makes Telegram redeliver later instead of dropping the update
+        return jsonify({'ok': False}), 503
+    return jsonify({'ok': True})
+
+def accept_update(update, done=None):
+    """Validate and queue one update; returns 'queued', 'duplicate', 'full' or 'ignored'
+
+    done(), if given, is called after a queued update has been handled.
+    """
     # Safety checks
-    if 'message' not in update:
-        return jsonify({'ok': True})
+    if not isinstance(update, dict):
+        return 'ignored'
+    if updates.duplicate(update.get('update_id')):
+        # Before the limiter: a redelivered update must not spend the chat's tokens
+        return 'duplicate'
     
-    msg = update['message']
-    if 'text' not in msg or 'chat' not in msg:
-        return jsonify({'ok': True})
-    
-    chat_id = msg['chat']['id']
-    text = msg['text'].strip()
+    key = None
+    if 'callback_query' in update:
+        # Inline button presses: page turns
+        query = update['callback_query']
+        msg = query.get('message') or {}
+        if 'chat' not in msg or 'data' not in query:
+            return 'ignored'
+        chat_id = msg['chat']['id']
+        job = lambda: handle_callback(chat_id, msg['message_id'], query['id'], query['data'])
+    elif 'message' in update:
+        msg = update['message']
+        if 'chat' not in msg or ('text' not in msg and 'document' not in msg):
+            return 'ignored'
+        
+        chat_id = msg['chat']['id']
+        if 'document' in msg:
+            # Address lists sent as a file, captioned "block" or "unblock"
+            caption = msg.get('caption', '').strip()
+            logger.info(f"Document from {chat_id}: {caption}")
+            job = lambda: handle_document(chat_id, caption, msg['document'])
+        else:
+            text = msg['text'].strip()
+            logger.info(f"Message from {chat_id}: {text}")
+            key = limiter.admit(chat_id, text)
+            if key is None:
+                return 'ignored'
+            job = lambda: limiter.run(key, handle_message, chat_id, text)
+    else:
+        return 'ignored'
     
-    logger.info(f"Message from {chat_id}: {text}")
+    start_background()
     
+    if done is not None:
+        handle = job
+        def job():
+            try:
+                handle()
+            finally:
+                done()
+    result = updates.submit(chat_id, update.get('update_id'), job)
+    if result != 'queued' and key:
+        limiter.release(key)
+    if result == 'full':
+        logger.warning(f"Update queue full, deferring update from {chat_id}")
+    return result
+
+def handle_message(chat_id, text):
+    """Run a command and send the reply"""
     try:
-        admin = is_admin(chat_id)
-        keyboard = ADMIN_KB if admin else KB
-        reply = ""
-        
-        # Main commands
-        if text in ['Speed', '/speed', '📊 Speed']:
-            reply = cmd_speed(chat_id)
-        elif text in ['Devices', '/devices', '📱 Devices']:
-            reply = cmd_devices(chat_id)
-        elif text in ['Status', '/status', '⚙️ Status']:
-            reply = cmd_status(chat_id)
-        elif text in ['Top5', '/top5', '🔥 Top5']:
-            reply = cmd_top5(chat_id)
-        elif text in ['Traffic', '/traffic', '📈 Traffic']:
-            reply = cmd_traffic(chat_id)
-        elif text in ['Logs', '/logs', '📝 Logs']:
-            reply = cmd_logs(chat_id)
-        elif text in ['Backup', '/backup', '🗂️ Backup']:
-            reply = cmd_backup(chat_id)
-        elif text in ['Firewall', '/firewall', '🚫 Firewall']:
-            reply = cmd_firewall(chat_id)
-        elif text in ['Help', '/help', '❓ Help']:
-            reply = cmd_help(chat_id)
-        elif text in ['Terminal', '/terminal', '💻 Terminal']:
-            reply = "💻 Terminal Mode\n\nSend commands like:\n/system/resource\n/ip/address print\n/interface print\n\nExample:\nterminal /system/resource"
-        elif text in ['Checklist', '/checklist', '📋 Checklist']:
-            reply = cmd_daily_checklist(chat_id)
-        
-        # Inline commands
-        elif text.lower().startswith('block '):
-            ip = text.split('block ', 1)[1].strip()
-            reply = cmd_block(chat_id, ip)
-        elif text.lower().startswith('unblock '):
-            ip = text.split('unblock ', 1)[1].strip()
-            reply = cmd_unblock(chat_id, ip)
-        elif text.lower().startswith('terminal '):
-            cmd = text.split('terminal ', 1)[1].strip()
-            reply = cmd_terminal(chat_id, cmd)
-        
-        else:
-            reply = cmd_help(chat_id)
-        
-        send_message(chat_id, reply, keyboard)
-        return jsonify({'ok': True})
-        
+        keyboard = ADMIN_KB if is_admin(chat_id) else KB
+        send_reply(chat_id, commands.dispatch(chat_id, text), keyboard)
     except Exception as e:
         logger.error(f"Error: {e}")
         send_message(chat_id, "❌ Error occurred", KB)
-        return jsonify({'ok': True})
+
+def handle_document(chat_id, caption, document):
+    """Run block or unblock on the addresses in an attached text file"""
+    keyboard = ADMIN_KB if is_admin(chat_id) else KB
+    try:
+        command = caption.split()[0].lower().lstrip('/') if caption else ''
+        if command not in ('block', 'unblock'):
+            send_message(chat_id, "📎 Caption the file with block or unblock (optionally timeout=1h)", keyboard)
+        elif not is_admin(chat_id):
+            send_message(chat_id, "🔒 Admin only", keyboard)
+        elif document.get('file_size', 0) > BLOCK_FILE_LIMIT:
+            send_message(chat_id, f"❌ File too large (max {format_bytes(BLOCK_FILE_LIMIT)})", keyboard)
+        else:
+            content = telegram.download(document['file_id'], BLOCK_FILE_LIMIT)
+            if content is None:
+                send_message(chat_id, "❌ Could not download the file", keyboard)
+            else:
+                handle_message(chat_id, f"{caption} {content}")
+    except Exception as e:
+        logger.error(f"Document error: {e}")
+        send_message(chat_id, "❌ Error occurred", KB)
+
+def handle_callback(chat_id, message_id, query_id, data):
+    """Inline buttons: turn the page of a paginated reply, or stop a live view"""
+    try:
+        if data == 'lv:stop':
+            stopped = live.stop(chat_id, message_id)
+            telegram.answer_callback(chat_id, query_id, None if stopped else "⌛ This live view already ended")
+            return
+        parts = data.split(':')
+        if len(parts) != 3 or parts[0] != 'pg' or not parts[2].isdigit():
+            # The page counter, or a button from an older bot version
+            telegram.answer_callback(chat_id, query_id)
+            return
+        _, cursor, page = parts
+        paged = pages.get(chat_id, cursor)
+        if paged is None:
+            telegram.answer_callback(chat_id, query_id, "⌛ This list expired, run the command again")
+            return
+        page = min(int(page), paged.pages - 1)
+        telegram.answer_callback(chat_id, query_id)
+        telegram.edit_message(chat_id, message_id, paged.render(page), pages.keyboard(cursor, page, paged.pages))
+    except Exception as e:
+        logger.error(f"Callback error: {e}")
+
+# ============== Long Polling ==============
+class UpdatePoller:
+    """getUpdates loop for sites without a public webhook
+
+    Updates are fetched in batches and queued through accept_update, so chats run
+    concurrently and in order within each chat, as with the webhook. Every update taken
+    from a batch is acknowledged by the next poll, so a slow one never holds the offset
+    back; updates still running are kept in the offset file instead and queued again
+    after a restart.
+    """
+    def __init__(self, offset_file=POLL_OFFSET_FILE, batch=POLL_BATCH, timeout=POLL_TIMEOUT):
+        self.offset_file = offset_file
+        self.batch = batch
+        self.timeout = timeout
+        self.polls = 0
+        self.received = 0
+        self.replayed = 0
+        self.errors = 0
+        self.last_poll = None
+        self.offset, self._pending = self._load()
+        self._running = {}   # update id -> queued update not yet handled
+        self._saved = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.offset_file) as f:
+                state = json.load(f)
+            return int(state.get('offset', 0)), state.get('pending', [])
+        except FileNotFoundError:
+            return 0, []
+        except (OSError, ValueError) as e:
+            logger.error(f"Poll offset file unreadable, starting from Telegram's oldest update: {e}")
+            return 0, []
+
+    def _save(self):
+        """Write the offset, and the updates it leaves behind, before Telegram is told about it"""
+        with self._lock:
+            state = {'offset': self.offset, 'pending': [self._running[u] for u in sorted(self._running)]}
+        if state == self._saved:
+            return
+        tmp = f"{self.offset_file}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.offset_file)
+        self._saved = state
+
+    def _finish(self, update_id):
+        with self._lock:
+            self._running.pop(update_id, None)
+
+    def _queue(self, update):
+        """accept_update, tracking the update until it has been handled"""
+        update_id = update['update_id']
+        with self._lock:
+            self._running[update_id] = update
+        result = accept_update(update, done=lambda: self._finish(update_id))
+        if result != 'queued':
+            self._finish(update_id)
+        return result
+
+    def replay(self):
+        """Queue the updates that were still running when the offset file was last written"""
+        pending, self._pending = self._pending, []
+        for update in pending:
+            if self._queue(update) == 'full':
+                logger.error(f"Update queue full, dropping replayed update {update.get('update_id')}")
+        self.replayed += len(pending)
+        if pending:
+            logger.info(f"Replayed {len(pending)} updates left running before the restart")
+
+    def take(self, batch):
+        """Queue a batch; returns how many updates were taken"""
+        new = 0
+        for update in batch:
+            update_id = update.get('update_id')
+            if not isinstance(update_id, int) or update_id < self.offset:
+                continue
+            if self._queue(update) == 'full':
+                # Not acknowledged: fetched again with everything after it
+                return new
+            with self._lock:
+                self.offset = update_id + 1
+            new += 1
+        return new
+
+    def poll(self):
+        """One getUpdates round trip; returns the batch, or None on failure"""
+        self._save()
+        self.polls += 1
+        self.last_poll = time.time()
+        return telegram.call('getUpdates', {
+            'offset': self.offset,
+            'limit': self.batch,
+            'timeout': self.timeout,
+            'allowed_updates': ['message', 'callback_query'],
+        }, timeout=self.timeout + 10)
+
+    def run(self):
+        """Poll forever; a webhook must not be set at the same time"""
+        telegram.call('deleteWebhook')
+        logger.info(f"Long polling from update {self.offset} ({self.offset_file})")
+        self.replay()
+        while True:
+            try:
+                batch = self.poll()
+                if batch is None:
+                    self.errors += 1
+                    time.sleep(5)
+                    continue
+                self.received += len(batch)
+                if batch and not self.take(batch):
+                    # The update queue is full; give it time to drain
+                    time.sleep(1)
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Polling error: {e}")
+                time.sleep(5)
+
+    def stats(self):
+        return {
+            'offset': self.offset,
+            'running': len(self._running),
+            'replayed': self.replayed,
+            'polls': self.polls,
+            'received': self.received,
+            'errors': self.errors,
+            'last_poll_age': round(time.time() - self.last_poll, 1) if self.last_poll else None,
+        }
+
+poller = UpdatePoller() if BOT_MODE == 'polling' else None
 
 # ============== Health Check ==============
+def monitoring_allowed(authorization, token=''):
+    """True when METRICS_TOKEN is unset or matches the bearer header or ?token="""
+    if not METRICS_TOKEN:
+        return True
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check for Render"""
-    return jsonify({'status': 'ok'})
+    down = [name for name, router in fleet.routers.items() if router.link.state != 'closed']
+    # Stays 200 so a router outage never makes the host restart the bot
+    status = 'degraded' if down else 'ok'
+    if not monitoring_allowed(request.headers.get('Authorization', ''), request.args.get('token', '')):
+        return jsonify({'status': status})
+    return jsonify({
+        'status': status,
+        'routers_down': down,
+        'routers': fleet.stats(),
+        'updates': updates.stats(),
+        'telegram': telegram.stats(),
+        'alerts': alerts.stats(),
+        'pages': pages.stats(),
+        'commands': commands.stats(),
+        'history': history.stats() if history else None,
+        'limiter': limiter.stats(),
+        'poller': poller.stats() if poller else None,
+        'leader': leader.stats(),
+        'live': live.stats(),
+    })
+
+# ============== Metrics Endpoint ==============
+def queue_metric(field):
+    """Collector for one ChatQueue stat across the update and outbound queues"""
+    return lambda: [((q.name,), q.stats()[field]) for q in (updates, telegram.outbox)]
+
+def router_metric(value):
+    """Collector for one per-router value"""
+    return lambda: [((name,), value(router)) for name, router in fleet.routers.items()]
+
+instruments.collected('bot_queue_depth', 'Jobs waiting in a queue', 'gauge', ('queue',), queue_metric('depth'))
+instruments.collected('bot_queue_busy_workers', 'Workers running a job', 'gauge', ('queue',), queue_metric('busy'))
+instruments.collected('bot_queue_capacity', 'Jobs a queue holds before rejecting', 'gauge', ('queue',), queue_metric('capacity'))
+instruments.collected('bot_queue_processed_total', 'Jobs run', 'counter', ('queue',), queue_metric('processed'))
+instruments.collected('bot_queue_rejected_total', 'Jobs refused because the queue was full', 'counter', ('queue',), queue_metric('rejected'))
+instruments.collected('bot_requests_limited_total', 'Requests refused by a per-chat or per-command token bucket', 'counter', (),
+                      lambda: [((), limiter.limited)])
+instruments.collected('bot_requests_coalesced_total', 'Requests answered by an identical request already in flight', 'counter', (),
+                      lambda: [((), limiter.coalesced)])
+instruments.collected('routeros_pool_connections', 'API connection slots', 'gauge', ('router',), router_metric(lambda r: r.link.size))
+instruments.collected('routeros_pool_in_use', 'API connection slots held by a call', 'gauge', ('router',),
+                      router_metric(lambda r: r.link.size - r.link.stats()['idle']))
+instruments.collected('routeros_breaker_open', '1 while the circuit breaker is open or half-open', 'gauge', ('router',),
+                      router_metric(lambda r: int(r.link.state != 'closed')))
+instruments.collected('routeros_reconnects_total', 'Connections re-established after a drop', 'counter', ('router',),
+                      router_metric(lambda r: r.link.reconnects))
+instruments.collected('routeros_cache_hits_total', 'Prints served from the snapshot cache', 'counter', ('router',),
+                      router_metric(lambda r: r.cache.hits + r.cache.coalesced))
+instruments.collected('routeros_cache_misses_total', 'Prints that went to the router', 'counter', ('router',),
+                      router_metric(lambda r: r.cache.misses))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint"""
+    if not monitoring_allowed(request.headers.get('Authorization', ''), request.args.get('token', '')):
+        return 'Unauthorized\n', 401, {'Content-Type': 'text/plain; charset=utf-8', 'WWW-Authenticate': 'Bearer'}
+    return instruments.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 # ============== Main ==============
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 10000))
     logger.info(f"🤖 Bot starting on port {port}")
+    start_background()
+    if poller:
+        # /health and /metrics stay up next to the polling loop
+        threading.Thread(target=poller.run, name='poller', daemon=True).start()
     app.run(host='0.0.0.0', port=port, debug=False)
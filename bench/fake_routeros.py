@@ -0,0 +1,349 @@
+"""
+Fake RouterOS API server for benchmarks
+Speaks the binary API word protocol over TCP and serves synthetic tables
+"""
+
+import argparse
+import itertools
+import json
+import random
+import socketserver
+import threading
+import time
+from collections import Counter
+
+# ============== Word Protocol ==============
+def encode_length(n):
+    """RouterOS API word length prefix"""
+    if n < 0x80:
+        return bytes([n])
+    if n < 0x4000:
+        return (n | 0x8000).to_bytes(2, 'big')
+    if n < 0x200000:
+        return (n | 0xC00000).to_bytes(3, 'big')
+    if n < 0x10000000:
+        return (n | 0xE0000000).to_bytes(4, 'big')
+    return b'\xF0' + n.to_bytes(4, 'big')
+
+def read_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('client closed')
+        data += chunk
+    return data
+
+def read_length(sock):
+    first = read_exact(sock, 1)[0]
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        return ((first & 0x3F) << 8) | read_exact(sock, 1)[0]
+    if first < 0xE0:
+        return ((first & 0x1F) << 16) | int.from_bytes(read_exact(sock, 2), 'big')
+    if first < 0xF0:
+        return ((first & 0x0F) << 24) | int.from_bytes(read_exact(sock, 3), 'big')
+    return int.from_bytes(read_exact(sock, 4), 'big')
+
+def read_sentence(sock):
+    """Words up to the empty terminator, decoded as UTF-8"""
+    words = []
+    while True:
+        n = read_length(sock)
+        if n == 0:
+            return words
+        words.append(read_exact(sock, n).decode('utf-8', errors='replace'))
+
+def encode_sentence(words):
+    out = bytearray()
+    for word in words:
+        data = word.encode()
+        out += encode_length(len(data)) + data
+    out += b'\x00'
+    return bytes(out)
+
+# ============== Synthetic Tables ==============
+class Table:
+    """Rows by .id in insertion order; callable values are evaluated at print time"""
+    def __init__(self, rows=()):
+        self.rows = {}
+        self._ids = itertools.count(1)
+        self.lock = threading.Lock()
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        row_id = f"*{next(self._ids):X}"
+        self.rows[row_id] = dict(row, **{'.id': row_id})
+        return row_id
+
+def mac(i):
+    return ':'.join(f"{b:02X}" for b in (0x02, 0, (i >> 24) & 255, (i >> 16) & 255, (i >> 8) & 255, i & 255))
+
+def ip(i, base=10):
+    return f"{base}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+
+def counter(rate, started):
+    """Byte counter growing at rate bytes/s since started"""
+    return lambda: str(int(rate * (time.monotonic() - started)))
+
+def connection(rng, i, leases):
+    """Connection-tracking entry: a few busy remotes and ports, bytes skewed towards them"""
+    protocol = rng.choices(('tcp', 'udp', 'icmp'), (80, 18, 2))[0]
+    remote = f"203.0.{int(rng.paretovariate(1.2)) % 256}.{rng.randint(1, 254)}"
+    src = ip(rng.randrange(max(leases, 1)) + 1) if rng.random() < 0.9 else ip(rng.randint(1, 250), base=172)
+    row = {'protocol': protocol, 'timeout': f"{rng.randint(1, 86400)}s", 'tcp-state': 'established' if protocol == 'tcp' else ''}
+    if protocol == 'icmp':
+        row.update({'src-address': src, 'dst-address': remote})
+    else:
+        port = rng.choices((443, 80, 53, 123, 5223, 22, rng.randint(1024, 65535)), (50, 10, 15, 2, 3, 1, 19))[0]
+        row.update({'src-address': f"{src}:{rng.randint(1024, 65535)}", 'dst-address': f"{remote}:{port}"})
+    size = int(rng.paretovariate(1.1) * 1000)
+    row.update({'orig-bytes': str(size // 10), 'repl-bytes': str(size), 'orig-packets': str(size // 10000 + 1),
+                'repl-packets': str(size // 1400 + 1)})
+    return row
+
+def build_tables(leases, queues, addresses, logs, interfaces, connections=0):
+    started = time.monotonic()
+    rng = random.Random(7)
+    topics = ['system,info', 'dhcp,info', 'firewall,info', 'wireless,info', 'system,error,critical', 'account,info']
+    tables = {
+        '/ip/dhcp-server/lease': Table({
+            'address': ip(i + 1),
+            'mac-address': mac(i),
+            'host-name': f"host-{i}",
+            'comment': f"Device {i}" if i % 3 == 0 else '',
+            'status': 'bound' if i % 10 else 'waiting',
+        } for i in range(leases)),
+        '/queue/simple': Table({
+            'name': f"q-{i}",
+            'target': f"{ip(i + 1)}/32",
+            'rate': f"{rng.randint(0, 10**6)}/{rng.randint(0, 10**7)}",
+            'bytes': (lambda up=counter(rng.randint(1, 10**5), started), down=counter(rng.randint(1, 10**6), started): f"{up()}/{down()}"),
+        } for i in range(queues)),
+        '/ip/firewall/address-list': Table({
+            'list': 'blocked' if i % 2 else 'allowed',
+            'address': ip(i, base=100),
+            'comment': 'synthetic',
+        } for i in range(addresses)),
+        '/log': Table({
+            'time': time.strftime('%H:%M:%S', time.gmtime(i)),
+            'topics': topics[i % len(topics)],
+            'message': f"synthetic log line {i}",
+        } for i in range(logs)),
+        '/interface': Table({
+            'name': f"ether{i + 1}",
+            'rx-byte': counter(rng.randint(10**5, 10**8), started),
+            'tx-byte': counter(rng.randint(10**5, 10**8), started),
+            'running': 'true',
+        } for i in range(interfaces)),
+        '/ip/firewall/filter': Table({
+            'chain': 'forward' if i % 2 else 'input',
+            'action': ['accept', 'drop', 'reject'][i % 3],
+            'protocol': ['tcp', 'udp', 'icmp'][i % 3],
+            'comment': f"rule {i}",
+        } for i in range(40)),
+        '/ip/firewall/connection': Table(connection(rng, i, leases) for i in range(connections)),
+        '/ip/service': Table({'name': name, 'port': str(port), 'disabled': 'false'}
+                             for name, port in (('api', 8728), ('winbox', 8291), ('ssh', 22))),
+        '/system/identity': Table([{'name': 'fake-router'}]),
+        '/system/resource': Table([{
+            'cpu-load': lambda: str(rng.randint(1, 60)),
+            'uptime': lambda: f"{int(time.monotonic() - started)}s",
+            'total-memory': str(256 * 1024 * 1024),
+            'free-memory': lambda: str(rng.randint(64, 192) * 1024 * 1024),
+            'version': '7.14 (fake)',
+        }]),
+    }
+    return tables
+
+# ============== Server ==============
+class Trap(Exception):
+    pass
+
+class RouterOSHandler(socketserver.BaseRequestHandler):
+    """One API session; commands run in order, listen/follow streams stay open until /cancel"""
+    def setup(self):
+        self.write_lock = threading.Lock()
+        self.streams = set()
+        self.logged_in = False
+
+    def send(self, *sentences):
+        data = b''.join(encode_sentence(words) for words in sentences)
+        with self.write_lock:
+            self.request.sendall(data)
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                words = read_sentence(self.request)
+                if not words:
+                    continue
+                command, attrs, queries, tag = self.parse(words)
+                server.count(command)
+                tag_word = [f".tag={tag}"] if tag is not None else []
+                if server.latency:
+                    time.sleep(max(server.latency + random.uniform(-server.jitter, server.jitter), 0))
+                try:
+                    replies = self.execute(command, attrs, queries, tag)
+                except Trap as e:
+                    self.send(['!trap', f"=message={e}"] + tag_word, ['!done'] + tag_word)
+                    continue
+                if replies is None:
+                    continue  # stream stays open
+                self.send(*([['!re'] + [f"={k}={v}" for k, v in row.items()] + tag_word for row in replies[0]]
+                            + [['!done'] + [f"={k}={v}" for k, v in replies[1].items()] + tag_word]))
+        except (ConnectionError, OSError):
+            pass
+
+    @staticmethod
+    def parse(words):
+        command, attrs, queries, tag = words[0], {}, [], None
+        for word in words[1:]:
+            if word.startswith('='):
+                key, _, value = word[1:].partition('=')
+                attrs[key] = value
+            elif word.startswith('?'):
+                key, _, value = word[1:].partition('=')
+                queries.append((key, value if '=' in word else None))
+            elif word.startswith('.tag='):
+                tag = word[5:]
+        return command, attrs, queries, tag
+
+    def execute(self, command, attrs, queries, tag):
+        """Returns (rows, done attributes), or None for an open stream"""
+        path, _, verb = command.rpartition('/')
+        path = path or '/'
+        if verb == 'login':
+            self.logged_in = True
+            return [], {}
+        if not self.logged_in:
+            raise Trap('not logged in')
+        if verb == 'cancel':
+            self.cancel(attrs.get('tag'))
+            return [], {}
+        if command == '/bench/stats':
+            # Commands served so far, for harnesses that measure router load
+            return [{'json': json.dumps(self.server.stats())}], {}
+        table = self.server.tables.get(path)
+        if path == '/interface' and verb == 'monitor-traffic':
+            if attrs.get('interface') not in {r.get('name') for r in table.rows.values()}:
+                raise Trap('no such item')
+            self.streams.add(tag)
+            threading.Thread(target=self.monitor, args=(attrs['interface'], tag), daemon=True).start()
+            return None
+        if path == '/system/backup' and verb == 'save':
+            return [], {}
+        if table is None:
+            raise Trap('no such command prefix')
+        if verb == 'listen' or (verb == 'print' and 'follow-only' in attrs):
+            self.streams.add(tag)
+            return None
+        if verb == 'print':
+            return self.print(table, attrs, queries), {}
+        if verb == 'add':
+            with table.lock:
+                if path == '/ip/firewall/address-list' and any(
+                        r.get('list') == attrs.get('list') and r.get('address') == attrs.get('address')
+                        for r in table.rows.values()):
+                    raise Trap('failure: already have such entry')
+                return [], {'ret': table.add(attrs)}
+        if verb == 'remove':
+            with table.lock:
+                for row_id in attrs.get('.id', '').split(','):
+                    if table.rows.pop(row_id, None) is None:
+                        raise Trap('no such item')
+            return [], {}
+        if verb == 'set':
+            with table.lock:
+                row = table.rows.get(attrs.get('.id'))
+                if row is None:
+                    raise Trap('no such item')
+                row.update((k, v) for k, v in attrs.items() if k != '.id')
+            return [], {}
+        raise Trap('no such command')
+
+    @staticmethod
+    def print(table, attrs, queries):
+        props = attrs['.proplist'].split(',') if '.proplist' in attrs else None
+        with table.lock:
+            rows = list(table.rows.values())
+        out = []
+        for row in rows:
+            if any((row.get(k) != v) if v is not None else (k not in row) for k, v in queries):
+                continue
+            keys = props if props is not None else row.keys()
+            out.append({k: (row[k]() if callable(row[k]) else row[k]) for k in keys if k in row})
+        return out
+
+    def monitor(self, interface, tag):
+        """One monitor-traffic row a second until the stream is cancelled"""
+        while tag in self.streams:
+            rx, tx = random.randint(10**6, 10**8), random.randint(10**5, 10**7)
+            try:
+                self.send(['!re', f"=name={interface}", f"=rx-bits-per-second={rx}", f"=tx-bits-per-second={tx}",
+                           f"=rx-packets-per-second={rx // 8000}", f"=tx-packets-per-second={tx // 8000}",
+                           f".tag={tag}"])
+            except OSError:
+                return
+            time.sleep(1)
+
+    def cancel(self, tag):
+        if tag in self.streams:
+            self.streams.discard(tag)
+            self.send(['!trap', '=category=2', '=message=interrupted', f".tag={tag}"], ['!done', f".tag={tag}"])
+
+class FakeRouterOS(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, tables, latency=0.0, jitter=0.0):
+        super().__init__(address, RouterOSHandler)
+        self.tables = tables
+        self.latency = latency
+        self.jitter = jitter
+        self.commands = Counter()
+        self.connections = 0
+        self._count_lock = threading.Lock()
+
+    def count(self, command):
+        with self._count_lock:
+            self.commands[command] += 1
+
+    def stats(self):
+        with self._count_lock:
+            return {'connections': self.connections, 'commands': dict(self.commands)}
+
+    def process_request(self, request, client_address):
+        with self._count_lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8728)
+    parser.add_argument('--leases', type=int, default=10000)
+    parser.add_argument('--queues', type=int, default=5000)
+    parser.add_argument('--addresses', type=int, default=50000, help='address-list entries, half of them on the blocked list')
+    parser.add_argument('--logs', type=int, default=100000)
+    parser.add_argument('--interfaces', type=int, default=8)
+    parser.add_argument('--connections', type=int, default=20000, help='connection-tracking entries')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='delay before each reply')
+    parser.add_argument('--jitter-ms', type=float, default=0.5)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    tables = build_tables(args.leases, args.queues, args.addresses, args.logs, args.interfaces, args.connections)
+    server = FakeRouterOS((args.host, args.port), tables, args.latency_ms / 1000, args.jitter_ms / 1000)
+    sizes = ', '.join(f"{path}={len(t.rows)}" for path, t in tables.items())
+    print(f"Fake RouterOS on {args.host}:{args.port} ({time.monotonic() - started:.1f}s to build: {sizes})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
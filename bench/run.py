@@ -0,0 +1,217 @@
+"""
+Benchmark harness: drives webhook() end to end against the fake RouterOS server
+Reports p50/p99 latency, throughput and RSS per command
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+# "{ip}" is replaced with an address unique to each request
+DEFAULT_COMMANDS = [
+    'status',
+    'speed',
+    'devices',
+    'top5',
+    'talkers',
+    'traffic',
+    'logs',
+    'logs critical 20',
+    'firewall',
+    'checklist',
+    'cpu 1h',
+    'terminal /ip/dhcp-server/lease print',
+    'block {ip}',
+    'unblock {ip}',
+    'help',
+]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)] if values else 0.0
+
+def rss_mb():
+    """Current resident set size"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return 0.0
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+def wait_for_port(host, port, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"Fake RouterOS did not start on {host}:{port}")
+
+def start_server(args):
+    """Run the fake router in its own process so it does not share our GIL or RSS"""
+    cmd = [sys.executable, os.path.join(BENCH_DIR, 'fake_routeros.py'),
+           '--port', str(args.port),
+           '--leases', str(args.leases),
+           '--queues', str(args.queues),
+           '--addresses', str(args.addresses),
+           '--logs', str(args.logs),
+           '--connections', str(args.connections),
+           '--latency-ms', str(args.latency_ms)]
+    proc = subprocess.Popen(cmd)
+    wait_for_port('127.0.0.1', args.port)
+    return proc
+
+class Replies:
+    """Stands in for the Bot API: records when each chat gets its first reply"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.done = {}
+        self._lock = threading.Lock()
+
+    def expect(self, chat_id):
+        event = threading.Event()
+        with self._lock:
+            self.done[chat_id] = event
+        return event
+
+    def call(self, method, payload=None, files=None, timeout=10):
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = (payload or {}).get('chat_id')
+        with self._lock:
+            event = self.done.pop(chat_id, None)
+        if event:
+            event.set()
+        return {'message_id': 1}
+
+def run_command(app, client, replies, template, requests, concurrency, cold, first_chat):
+    """Send requests updates for one command; returns latencies in seconds and wall time"""
+    latencies = []
+    lock = threading.Lock()
+
+    def one(i):
+        chat_id = first_chat + i
+        text = template.format(ip=f"198.18.{(i >> 8) & 255}.{i & 255}")
+        if cold:
+            for router in app.fleet.routers.values():
+                router.cache.invalidate()
+        event = replies.expect(chat_id)
+        started = time.perf_counter()
+        client.post(f'/{app.BOT_TOKEN}', json={
+            'update_id': chat_id,
+            'message': {'chat': {'id': chat_id}, 'text': text},
+        })
+        if not event.wait(120):
+            print(f"  no reply to {text!r} within 120s", file=sys.stderr)
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests)))
+    return latencies, time.perf_counter() - started
+
+def compare(results, baseline_file, tolerance, slack_ms):
+    """Commands whose p99 regressed beyond tolerance against a saved run"""
+    with open(baseline_file) as f:
+        baseline = {r['command']: r for r in json.load(f)['results']}
+    regressions = []
+    for r in results:
+        base = baseline.get(r['command'])
+        if base and r['p99_ms'] > base['p99_ms'] * (1 + tolerance) + slack_ms:
+            regressions.append(f"{r['command']}: p99 {base['p99_ms']:.1f} → {r['p99_ms']:.1f} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--requests', type=int, default=200, help='updates per command')
+    parser.add_argument('--concurrency', type=int, default=8, help='updates in flight at once')
+    parser.add_argument('--commands', nargs='+', default=DEFAULT_COMMANDS)
+    parser.add_argument('--port', type=int, default=18728)
+    parser.add_argument('--external', action='store_true', help='use a fake router that is already running on --port')
+    parser.add_argument('--leases', type=int, default=10000)
+    parser.add_argument('--queues', type=int, default=5000)
+    parser.add_argument('--addresses', type=int, default=50000)
+    parser.add_argument('--logs', type=int, default=100000)
+    parser.add_argument('--connections', type=int, default=20000)
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='fake router delay per API call')
+    parser.add_argument('--telegram-ms', type=float, default=0.0, help='simulated Bot API latency')
+    parser.add_argument('--cold', action='store_true', help='drop the snapshot cache before every request')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results file from an earlier run; exit 1 on p99 regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p99 growth against --baseline')
+    parser.add_argument('--slack-ms', type=float, default=2.0, help='absolute p99 growth always allowed')
+    args = parser.parse_args()
+
+    server = None if args.external else start_server(args)
+    os.environ.update({
+        'BOT_TOKEN': 'bench',
+        'ROUTER_HOST': '127.0.0.1',
+        'ROUTER_PORT': str(args.port),
+        'ROUTER_USER': 'bench',
+        'ROUTER_PASS': 'bench',
+    })
+    os.environ.pop('ROUTERS_FILE', None)
+    os.environ.pop('ADMIN_IDS', None)
+    try:
+        import app
+        replies = Replies(args.telegram_ms / 1000)
+        app.telegram.call = replies.call
+        client = app.app.test_client()
+        app.start_background()
+        base_rss = rss_mb()
+
+        print(f"{'command':<40} {'n':>5} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>8} {'rss MB':>8} {'peak MB':>8}")
+        results = []
+        for index, command in enumerate(args.commands):
+            # Warm up connections, streams and caches outside the measurement
+            run_command(app, client, replies, command, 1, 1, False, 10**9 + index)
+            latencies, wall = run_command(app, client, replies, command, args.requests, args.concurrency,
+                                          args.cold, (index + 1) * 10**6)
+            row = {
+                'command': command,
+                'n': len(latencies),
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+                'throughput': round(len(latencies) / wall, 1) if wall else 0.0,
+                'rss_mb': round(rss_mb(), 1),
+                'peak_rss_mb': round(peak_rss_mb(), 1),
+            }
+            results.append(row)
+            print(f"{command:<40} {row['n']:>5} {row['p50_ms']:>9.1f} {row['p99_ms']:>9.1f} "
+                  f"{row['throughput']:>8.1f} {row['rss_mb']:>8.1f} {row['peak_rss_mb']:>8.1f}", flush=True)
+
+        print(f"\nRSS at start {base_rss:.1f} MB, peak {peak_rss_mb():.1f} MB")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'results': results}, f, indent=2)
+        if args.baseline:
+            regressions = compare(results, args.baseline, args.tolerance, args.slack_ms)
+            for line in regressions:
+                print(f"REGRESSION {line}")
+            if regressions:
+                sys.exit(1)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+if __name__ == '__main__':
+    main()
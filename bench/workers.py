@@ -0,0 +1,202 @@
+"""
+Startup benchmark for gunicorn worker counts: boots the bot under gunicorn.conf.py with
+1, 4 and 16 workers against the fake RouterOS server and a stub Bot API, then reports
+time to healthy, total RSS, throughput and how many API commands reached the router
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from routeros_api import RouterOsApiPool
+
+from run import wait_for_port
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+class BotApiStub(BaseHTTPRequestHandler):
+    """Answers every Bot API call with ok and counts sendMessage"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/sendMessage'):
+            with self.server.lock:
+                self.server.replies += 1
+        body = b'{"ok": true, "result": {"message_id": 1}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_stub(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), BotApiStub)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.replies = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def router_commands(port):
+    """Total API commands the fake router has served"""
+    pool = RouterOsApiPool('127.0.0.1', username='bench', password='bench', port=port, plaintext_login=True)
+    try:
+        stats = json.loads(pool.get_api().get_resource('/bench').call('stats')[0]['json'])
+    finally:
+        pool.disconnect()
+    # Less the login and the stats call of this connection
+    return sum(stats['commands'].values()) - 2
+
+def tree_rss_mb(pid):
+    """RSS of a process and all its descendants"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        stack.extend(children.get(p, []))
+        try:
+            with open(f'/proc/{p}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass
+    return total / 2**20
+
+def run_workers(args, workers, stub):
+    port = args.bot_port
+    env = dict(os.environ,
+               PORT=str(port),
+               WEB_CONCURRENCY=str(workers),
+               BOT_TOKEN='bench',
+               ROUTER_HOST='127.0.0.1',
+               ROUTER_PORT=str(args.port),
+               ROUTER_USER='bench',
+               ROUTER_PASS='bench',
+               TELEGRAM_API_URL=f"http://127.0.0.1:{args.stub_port}",
+               HISTORY_DB='',
+               USER_RATE='1000',
+               USER_BURST='1000')
+    env.pop('ROUTERS_FILE', None)
+    env.pop('ADMIN_IDS', None)
+    if args.no_shared:
+        env['SHARED_CACHE_SOCKET'] = ''
+    commands_before = router_commands(args.port)
+    replies_before = stub.replies
+
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), 'app:app'],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 120
+        while True:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/health", timeout=2).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if time.monotonic() > deadline or proc.poll() is not None:
+                raise SystemExit(f"gunicorn with {workers} workers did not become healthy")
+            time.sleep(0.05)
+        startup = time.perf_counter() - started
+        # Let every worker finish booting before measuring memory
+        time.sleep(args.settle)
+        idle_rss = tree_rss_mb(proc.pid)
+
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+        def post(i):
+            text = args.commands[i % len(args.commands)]
+            return session.post(f"http://127.0.0.1:{port}/bench", json={
+                'update_id': i, 'message': {'chat': {'id': 10**6 + i}, 'text': text}}, timeout=30).status_code
+
+        load_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            # 503 means the worker's update queue was full; Telegram would redeliver later
+            accepted = sum(status == 200 for status in pool.map(post, range(args.requests)))
+        while stub.replies - replies_before < accepted and time.perf_counter() - load_started < 120:
+            time.sleep(0.02)
+        wall = time.perf_counter() - load_started
+        answered = stub.replies - replies_before
+        busy_rss = tree_rss_mb(proc.pid)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    return {
+        'workers': workers,
+        'shared': not args.no_shared and workers > 1,
+        'startup_s': round(startup, 2),
+        'idle_rss_mb': round(idle_rss, 1),
+        'rss_mb': round(busy_rss, 1),
+        'rejected': args.requests - accepted,
+        'answered': answered,
+        'throughput': round(answered / wall, 1) if wall else 0.0,
+        'router_commands': router_commands(args.port) - commands_before,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--commands', nargs='+', default=['status', 'speed', 'devices'])
+    parser.add_argument('--no-shared', action='store_true', help='run every worker without the shared cache daemon')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds to wait after startup before measuring')
+    parser.add_argument('--port', type=int, default=18728, help='fake RouterOS port')
+    parser.add_argument('--bot-port', type=int, default=18080)
+    parser.add_argument('--stub-port', type=int, default=18081)
+    parser.add_argument('--leases', type=int, default=10000)
+    parser.add_argument('--queues', type=int, default=5000)
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_routeros.py'),
+                               '--port', str(args.port), '--leases', str(args.leases), '--queues', str(args.queues),
+                               '--addresses', '1000', '--logs', '1000', '--latency-ms', str(args.latency_ms)])
+    stub = start_stub(args.stub_port)
+    try:
+        wait_for_port('127.0.0.1', args.port)
+        print(f"{'workers':>7} {'shared':>6} {'startup s':>9} {'idle MB':>8} {'rss MB':>8} {'rejected':>8} {'answered':>8} "
+              f"{'req/s':>8} {'router cmds':>11}")
+        results = []
+        for workers in args.workers:
+            row = run_workers(args, workers, stub)
+            results.append(row)
+            print(f"{row['workers']:>7} {'yes' if row['shared'] else 'no':>6} {row['startup_s']:>9.2f} "
+                  f"{row['idle_rss_mb']:>8.1f} {row['rss_mb']:>8.1f} {row['rejected']:>8} {row['answered']:>8} "
+                  f"{row['throughput']:>8.1f} {row['router_commands']:>11}", flush=True)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    finally:
+        stub.shutdown()
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    main()
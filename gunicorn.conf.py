@@ -0,0 +1,61 @@
+"""
+Gunicorn settings: gunicorn -c gunicorn.conf.py app:app
+With more than one worker, a shared cache daemon is started so workers share router snapshots
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+# Import once in the master; each worker then drops what it inherited in post_fork
+preload_app = True
+timeout = 60
+
+# app.py reads this at import, which with preload happens before any hook runs
+if workers > 1:
+    os.environ.setdefault('SHARED_CACHE_SOCKET', f"/tmp/mikrotik-bot-{os.getpid()}.sock")
+
+_daemon = None
+
+def _listening(path):
+    """A daemon started outside gunicorn is already serving path"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+def on_starting(server):
+    global _daemon
+    path = os.getenv('SHARED_CACHE_SOCKET')
+    if not path or _listening(path):
+        return
+    _daemon = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shared_cache.py'),
+                                '--socket', path])
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    server.log.info(f"Shared cache daemon on {path} (pid {_daemon.pid})")
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
+
+def worker_exit(server, worker):
+    # Workers may leave without running atexit handlers
+    import app
+    if app.history:
+        app.history.flush()
+
+def on_exit(server):
+    if _daemon:
+        _daemon.terminate()
+        _daemon.wait()
@@ -0,0 +1,273 @@
+"""
+Cross-process snapshot cache for running several bot workers on one host
+A small daemon on a Unix socket; workers share print results and elect one background leader
+Run with: python shared_cache.py --socket /tmp/mikrotik-bot.sock
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# ============== Server ==============
+class CacheStore:
+    """Values with expiry, fetch claims so one worker queries the router, named leases and token buckets"""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self._values = {}   # key -> (expires, value)
+        self._claims = {}   # key -> claim expiry
+        self._leases = {}   # name -> (owner, expires)
+        self._buckets = {}  # key -> (tokens, updated, seconds to refill)
+        self._changed = threading.Condition()
+
+    def _prune(self, now):
+        for key in [k for k, (expires, _) in self._values.items() if expires <= now]:
+            del self._values[key]
+
+    def get(self, key, claim):
+        """Fresh value, or a claim telling the caller to fetch it; waits while another worker fetches"""
+        with self._changed:
+            waited = False
+            while True:
+                now = time.monotonic()
+                entry = self._values.get(key)
+                if entry and entry[0] > now:
+                    self.hits += 1
+                    return {'value': entry[1], 'ttl': entry[0] - now}
+                claimed = self._claims.get(key)
+                if claimed is None or claimed <= now:
+                    if len(self._values) > 1024:
+                        self._prune(now)
+                    self.misses += 1
+                    self._claims[key] = now + claim
+                    return {'claimed': True}
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self._changed.wait(claimed - now)
+
+    def peek(self, key):
+        """Fresh value if there is one; never claims a fetch"""
+        with self._changed:
+            entry = self._values.get(key)
+            if entry and entry[0] > time.monotonic():
+                return {'value': entry[1]}
+            return {}
+
+    def touch(self, key, ttl):
+        """Keep a fresh value for another ttl seconds"""
+        with self._changed:
+            entry = self._values.get(key)
+            now = time.monotonic()
+            if not entry or entry[0] <= now:
+                return {'found': False}
+            self._values[key] = (now + ttl, entry[1])
+            return {'found': True}
+
+    def put(self, key, value, ttl):
+        with self._changed:
+            self._values[key] = (time.monotonic() + ttl, value)
+            self._claims.pop(key, None)
+            self._changed.notify_all()
+        return {}
+
+    def release(self, key):
+        """Give up a claim after a failed fetch so a waiting worker can try"""
+        with self._changed:
+            self._claims.pop(key, None)
+            self._changed.notify_all()
+        return {}
+
+    def drop(self, prefix):
+        """Forget every value whose key starts with prefix, after a write on the router"""
+        with self._changed:
+            for key in [k for k in self._values if k.startswith(prefix)]:
+                del self._values[key]
+        return {}
+
+    def lease(self, name, owner, ttl):
+        """Hold or renew a named lease; expires unless renewed, so a dead holder is replaced"""
+        with self._changed:
+            now = time.monotonic()
+            if len(self._leases) > 4096:
+                for key in [k for k, (_, expires) in self._leases.items() if expires <= now]:
+                    del self._leases[key]
+            holder = self._leases.get(name)
+            if holder is None or holder[0] == owner or holder[1] <= now:
+                self._leases[name] = (owner, now + ttl)
+                return {'granted': True}
+            return {'granted': False, 'owner': holder[0]}
+
+    def unlease(self, name, owner):
+        """Give up a lease early; only its holder can"""
+        with self._changed:
+            holder = self._leases.get(name)
+            if holder and holder[0] == owner:
+                del self._leases[name]
+        return {}
+
+    def take(self, key, rate, burst):
+        """Take a token from a bucket shared by every worker; 0, or seconds until one is available"""
+        with self._changed:
+            now = time.monotonic()
+            if len(self._buckets) > 4096:
+                # A bucket that has refilled is the same as a new one
+                for k in [k for k, (_, updated, refill) in self._buckets.items() if now - updated >= refill]:
+                    del self._buckets[k]
+            tokens, updated, _ = self._buckets.get(key, (burst, now, 0))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, (burst - tokens) / rate)
+            return {'wait': wait}
+
+    def stats(self):
+        with self._changed:
+            now = time.monotonic()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'values': len(self._values),
+                'claims': len(self._claims),
+                'buckets': len(self._buckets),
+                # Request leases of the rate limiter are counted, not listed
+                'leases': {name: owner for name, (owner, expires) in self._leases.items()
+                           if expires > now and not name.startswith('limit:')},
+                'request_leases': sum(1 for name in self._leases if name.startswith('limit:')),
+            }
+
+class CacheHandler(socketserver.StreamRequestHandler):
+    """One worker connection: newline-delimited JSON requests, answered in order"""
+    def handle(self):
+        store = self.server.store
+        ops = {
+            'get': lambda r: store.get(r['key'], r.get('claim', 10)),
+            'peek': lambda r: store.peek(r['key']),
+            'touch': lambda r: store.touch(r['key'], r['ttl']),
+            'put': lambda r: store.put(r['key'], r['value'], r['ttl']),
+            'release': lambda r: store.release(r['key']),
+            'drop': lambda r: store.drop(r['prefix']),
+            'lease': lambda r: store.lease(r['name'], r['owner'], r['ttl']),
+            'unlease': lambda r: store.unlease(r['name'], r['owner']),
+            'take': lambda r: store.take(r['key'], r['rate'], r['burst']),
+            'stats': lambda r: store.stats(),
+        }
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = ops[request['op']](request)
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': str(e)[:120]}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+class CacheServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, CacheHandler)
+        os.chmod(path, 0o600)
+        self.store = CacheStore()
+
+# ============== Client ==============
+class SharedCacheError(Exception):
+    """The daemon could not be reached; callers fall back to working alone"""
+
+class CacheClient:
+    """Connection to the daemon, one per thread and re-opened after fork"""
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.errors = 0
+        self._local = threading.local()
+
+    def _request(self, request):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn[0] != os.getpid():
+            # Inherited across fork: the parent still owns that socket
+            conn = None
+        try:
+            if conn is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                conn = self._local.conn = (os.getpid(), sock, sock.makefile('rb'))
+            conn[1].sendall(json.dumps(request).encode() + b'\n')
+            line = conn[2].readline()
+            if not line:
+                raise ConnectionError('daemon closed the connection')
+            return json.loads(line)
+        except (OSError, ValueError) as e:
+            self.errors += 1
+            self._local.conn = None
+            if conn is not None:
+                conn[1].close()
+            raise SharedCacheError(f"Shared cache {self.path}: {e}")
+
+    def get(self, key, claim):
+        """{'value': ..., 'ttl': seconds} on a hit, {'claimed': True} when the caller should fetch"""
+        return self._request({'op': 'get', 'key': key, 'claim': claim})
+
+    def peek(self, key):
+        """Fresh value, or None"""
+        return self._request({'op': 'peek', 'key': key}).get('value')
+
+    def touch(self, key, ttl):
+        """True if the value was still there and now lives ttl more seconds"""
+        return self._request({'op': 'touch', 'key': key, 'ttl': ttl}).get('found', False)
+
+    def put(self, key, value, ttl):
+        self._request({'op': 'put', 'key': key, 'value': value, 'ttl': ttl})
+
+    def release(self, key):
+        self._request({'op': 'release', 'key': key})
+
+    def drop(self, prefix):
+        self._request({'op': 'drop', 'prefix': prefix})
+
+    def lease(self, name, owner, ttl):
+        """True while owner holds the named lease"""
+        return self._request({'op': 'lease', 'name': name, 'owner': owner, 'ttl': ttl}).get('granted', False)
+
+    def unlease(self, name, owner):
+        self._request({'op': 'unlease', 'name': name, 'owner': owner})
+
+    def take(self, key, rate, burst):
+        """0 if a token was taken, else seconds until the shared bucket has one"""
+        return self._request({'op': 'take', 'key': key, 'rate': rate, 'burst': burst}).get('wait', 0.0)
+
+    def stats(self):
+        return self._request({'op': 'stats'})
+
+# ============== Main ==============
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--socket', default=os.getenv('SHARED_CACHE_SOCKET', '/tmp/mikrotik-bot.sock'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = CacheServer(args.socket)
+    logger.info(f"Shared cache listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+# The tests build their own routers; nothing may be picked up from the environment
+for name in ('BOT_TOKEN', 'ROUTER_HOST', 'ROUTERS_FILE', 'ADMIN_IDS', 'HISTORY_DB', 'SHARED_CACHE_SOCKET',
+             'ALERT_RULES_FILE', 'METRICS_TOKEN'):
+    os.environ.pop(name, None)
+
+import app  # noqa: E402
+from fake_routeros import FakeRouterOS, build_tables  # noqa: E402
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Messages the code under test tried to send, as (chat_id, text)"""
+    messages = []
+    monkeypatch.setattr(app, 'send_message', lambda chat_id, text, keyboard=None: messages.append((chat_id, text)))
+    return messages
+
+@pytest.fixture
+def fake_router():
+    """A fake RouterOS API server on a free port, with small synthetic tables"""
+    server = FakeRouterOS(('127.0.0.1', 0), build_tables(leases=20, queues=5, addresses=10, logs=10, interfaces=2))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def router(fake_router):
+    """A Router connected to fake_router"""
+    return app.Router('test', '127.0.0.1', username='admin', password='admin', port=fake_router.server_address[1])
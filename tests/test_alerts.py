@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app import AlertEngine, AlertRule
+
+ROUTER = SimpleNamespace(name='r1')
+
+@pytest.fixture
+def engine(monkeypatch):
+    def build(*specs):
+        engine = AlertEngine([AlertRule(spec) for spec in specs])
+        engine.events = []
+        monkeypatch.setattr(engine, 'notify', engine.events.append)
+        return engine
+    return build
+
+def feed(engine, values, start=0, step=10, key='cpu'):
+    for n, value in enumerate(values):
+        engine.evaluate(ROUTER, start + n * step, {key: value})
+
+def test_fires_after_sustain_and_clears_below_clear_level(engine):
+    alerts = engine({'name': 'CPU', 'metric': 'cpu', 'above': 90, 'clear': 70, 'for': 3, 'cooldown': 0})
+    feed(alerts, [95, 95])
+    assert alerts.events == []
+    feed(alerts, [95], start=20)
+    assert len(alerts.events) == 1 and alerts.events[0].startswith('🚨')
+    # Between the two thresholds the alert stays active and quiet
+    feed(alerts, [85, 75, 71, 95], start=30)
+    assert len(alerts.events) == 1
+    feed(alerts, [70], start=70)
+    assert len(alerts.events) == 2 and alerts.events[1].startswith('✅')
+    assert alerts.active() == []
+
+def test_a_dip_restarts_the_sustain_count(engine):
+    alerts = engine({'name': 'CPU', 'metric': 'cpu', 'above': 90, 'for': 3, 'cooldown': 0})
+    feed(alerts, [95, 95, 50, 95, 95])
+    assert alerts.events == []
+    feed(alerts, [95], start=50)
+    assert len(alerts.events) == 1
+
+def test_cooldown_suppresses_a_quick_refire(engine):
+    alerts = engine({'name': 'CPU', 'metric': 'cpu', 'above': 90, 'clear': 70, 'cooldown': 600})
+    feed(alerts, [95, 50, 95])
+    assert [e[0] for e in alerts.events] == ['🚨', '✅']
+    feed(alerts, [95], start=700)
+    assert len(alerts.events) == 3
+
+def test_below_rule_clears_at_or_above_its_level(engine):
+    alerts = engine({'name': 'Memory', 'metric': 'mem', 'below': 10, 'clear': 20, 'cooldown': 0})
+    feed(alerts, [5, 15, 20], key='mem')
+    assert [e[0] for e in alerts.events] == ['🚨', '✅']
+
+def test_change_rule_compares_the_rate_per_minute(engine):
+    alerts = engine({'name': 'Churn', 'metric': 'dhcp_events', 'above': 100, 'change': True, 'cooldown': 0})
+    # +20 per 10 s is 120 per minute
+    feed(alerts, [0, 20], key='dhcp_events')
+    assert len(alerts.events) == 1
+
+def test_glob_rules_keep_state_per_key(engine):
+    alerts = engine({'name': 'Uplink', 'metric': '*:rx', 'above': 1000, 'cooldown': 0})
+    alerts.evaluate(ROUTER, 0, {'ether1:rx': 5000, 'ether2:rx': 10, 'cpu': 99})
+    assert len(alerts.events) == 1 and 'ether1:rx' in alerts.events[0]
+    assert alerts.active() == [('Uplink', 'r1', 'ether1:rx')]
+
+def test_rule_needs_exactly_one_threshold():
+    with pytest.raises(ValueError):
+        AlertRule({'name': 'Bad', 'metric': 'cpu'})
+    with pytest.raises(ValueError):
+        AlertRule({'name': 'Bad', 'metric': 'cpu', 'above': 1, 'below': 0})
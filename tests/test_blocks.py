@@ -0,0 +1,39 @@
+import pytest
+
+import app
+from app import parse_block_entry, parse_block_request
+
+def test_single_address_and_cidr():
+    assert parse_block_entry('192.168.1.100') == ['192.168.1.100']
+    assert parse_block_entry('192.168.1.100/32') == ['192.168.1.100']
+    # Host bits are dropped, as RouterOS does
+    assert parse_block_entry('10.0.0.7/24') == ['10.0.0.0/24']
+
+def test_aligned_range_is_one_block():
+    assert parse_block_entry('10.0.0.0-10.0.0.255') == ['10.0.0.0/24']
+
+def test_unaligned_range_is_the_covering_blocks():
+    assert parse_block_entry('1.2.3.4-9') == ['1.2.3.4/30', '1.2.3.8/31']
+    assert parse_block_entry('1.2.3.5-1.2.3.5') == ['1.2.3.5']
+    assert parse_block_entry('10.0.0.255-10.0.1.1') == ['10.0.0.255', '10.0.1.0/31']
+
+@pytest.mark.parametrize('token', ['0.0.0.0/0', '1.0.0.0-200.0.0.0', '10.0.0.9-1', '10.0.0.300', 'example.com'])
+def test_rejected_entries(token):
+    with pytest.raises(ValueError):
+        parse_block_entry(token)
+
+def test_request_splits_dedups_and_reads_timeout():
+    entries, invalid, timeout = parse_block_request(
+        "1.2.3.4, 10.0.0.0/24; 1.2.3.4\n10.0.0.0-10.0.0.255 bogus timeout=1h  # comment 9.9.9.9\ntimeout=x")
+    assert entries == ['1.2.3.4', '10.0.0.0/24']
+    assert invalid == ['bogus', 'timeout=x']
+    assert timeout == '1h'
+
+def test_block_adds_the_range_blocks_to_the_router(monkeypatch, router, fake_router):
+    monkeypatch.setattr(app, 'ADMIN_IDS', [])
+    reply = app.cmd_block(1, '172.16.0.0-172.16.0.5 timeout=1h', router=router)
+    assert reply == '🚫 Blocked 2 addresses for 1h'
+    rows = fake_router.tables[app.ADDRESS_LIST_PATH].rows.values()
+    blocked = {row['address'] for row in rows if row.get('list') == app.BLOCK_LIST}
+    assert {'172.16.0.0/30', '172.16.0.4/31'} <= blocked
+    assert app.cmd_block(1, '172.16.0.4-5', router=router) == 'ℹ️ 172.16.0.4/31 is already blocked'
@@ -0,0 +1,45 @@
+import pytest
+
+import app
+from app import commands
+
+def resolve(text):
+    command, args = commands.resolve(text)
+    return (command.handler if command else None), args
+
+@pytest.mark.parametrize('text', ['speed', '/speed', 'SPEED ', '📊 Speed', '/speed@MyBot'])
+def test_exact_aliases(text):
+    assert resolve(text) == (app.cmd_speed, ())
+
+def test_keyword_with_arguments():
+    assert resolve('cpu last 24h') == (app.cmd_cpu_history, (86400,))
+    assert resolve('/logs@MyBot critical 50') == (app.cmd_logs_topic, ('critical', 50))
+    assert resolve('usage laptop 7d') == (app.cmd_usage, ('laptop', 7 * 86400))
+
+def test_argument_text_is_passed_verbatim():
+    assert resolve('block 10.0.0.0/24,  1.2.3.4') == (app.cmd_block, ('10.0.0.0/24,  1.2.3.4',))
+    assert resolve('Terminal /ip/arp print ?interface=Bridge') == (app.cmd_terminal, ('/ip/arp print ?interface=Bridge',))
+
+def test_longest_keyword_wins():
+    assert resolve('terminal export csv /ip/route') == (app.cmd_export, ('csv /ip/route',))
+    assert resolve('speed live ether1 2m') == (app.cmd_live, ('ether1', 120))
+    assert resolve('live') == (app.cmd_live, (None, app.LIVE_DEFAULT_DURATION))
+
+def test_fleet_form_runs_the_base_command():
+    command, args = commands.resolve('status all')
+    assert args == ('all',)
+    assert command.base.handler is app.cmd_status
+    assert command.metric == 'status:fleet'
+
+def test_logs_topic_and_fleet_forms_share_a_keyword():
+    command, args = commands.resolve('logs all')
+    assert command.base.handler is app.cmd_logs and args == ('all',)
+    assert resolve('logs firewall') == (app.cmd_logs_topic, ('firewall', 5))
+
+@pytest.mark.parametrize('text', ['', 'hello', 'cpu sometime', 'status a b', 'speedy'])
+def test_unknown_text(text):
+    assert resolve(text) == (None, ())
+
+def test_admin_only_command_is_refused(monkeypatch):
+    monkeypatch.setattr(app, 'ADMIN_IDS', [42])
+    assert commands.dispatch(1, 'backup') == '🔒 Admin only'
@@ -0,0 +1,65 @@
+import threading
+
+from app import RequestLimiter
+
+def test_burst_then_limited_with_one_notice(sent):
+    limiter = RequestLimiter(rate=0.001, burst=2)
+    for n in range(2):
+        key = limiter.admit(1, f"status {n}")
+        assert key is not None
+        limiter.release(key)
+    assert limiter.admit(1, 'status 2') is None
+    assert limiter.admit(1, 'status 3') is None
+    assert limiter.limited == 2
+    assert len(sent) == 1 and sent[0][0] == 1
+
+def test_chats_have_separate_buckets(sent):
+    limiter = RequestLimiter(rate=0.001, burst=1)
+    limiter.release(limiter.admit(1, 'status'))
+    assert limiter.admit(1, 'status') is None
+    assert limiter.admit(2, 'status') is not None
+
+def test_identical_request_in_flight_is_coalesced(sent):
+    limiter = RequestLimiter(rate=100, burst=100)
+    key = limiter.admit(1, 'speed')
+    assert limiter.admit(1, '  speed ') is None
+    assert limiter.coalesced == 1
+    limiter.release(key)
+    assert limiter.admit(1, 'speed') is not None
+
+def test_limited_request_is_not_left_in_flight(sent):
+    limiter = RequestLimiter(rate=0.001, burst=1)
+    limiter.release(limiter.admit(1, 'speed'))
+    assert limiter.admit(1, 'speed') is None
+    assert limiter.coalesced == 0
+    assert not limiter._inflight
+
+def test_command_limit_applies_before_the_chat_limit(sent):
+    # backup allows one request per five minutes
+    limiter = RequestLimiter(rate=100, burst=100)
+    limiter.release(limiter.admit(1, 'backup'))
+    assert limiter.admit(1, 'backup') is None
+    assert limiter.admit(1, 'status') is not None
+
+def test_concurrent_identical_requests_admit_one(sent):
+    limiter = RequestLimiter(rate=1000, burst=1000)
+    start = threading.Barrier(16)
+    keys = []
+
+    def admit():
+        start.wait()
+        keys.append(limiter.admit(1, 'speed'))
+
+    threads = [threading.Thread(target=admit) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(key is not None for key in keys) == 1
+    assert limiter.coalesced == 15
+
+def test_bucket_count_is_bounded(sent):
+    limiter = RequestLimiter(rate=100, burst=100, max_chats=10)
+    for chat_id in range(50):
+        limiter.release(limiter.admit(chat_id, 'status'))
+    assert len(limiter._buckets) == 10
@@ -0,0 +1,53 @@
+import pytest
+
+from app import RateEngine
+
+def test_rate_from_counter_delta():
+    engine = RateEngine(alpha=0.5)
+    assert engine.update('iface:ether1', 0.0, (0, 0)) is None
+    assert engine.update('iface:ether1', 10.0, (1000, 500)) == (800.0, 400.0)
+
+def test_32bit_wrap_counts_the_bytes_across_the_wrap():
+    engine = RateEngine()
+    engine.update('iface:ether1', 0.0, (2 ** 32 - 1000, 0))
+    engine.update('iface:ether1', 1.0, (2 ** 32 - 500, 0))
+    rx, tx = engine.update('iface:ether1', 2.0, (500, 0))
+    assert rx == 1000 * 8
+    assert engine.wraps == 1
+    assert engine.resets == 0
+
+def test_drop_far_from_the_width_is_a_reset():
+    engine = RateEngine()
+    engine.update('queue:q-1', 0.0, (10 ** 6, 10 ** 6))
+    engine.update('queue:q-1', 1.0, (2 * 10 ** 6, 2 * 10 ** 6))
+    assert engine.update('queue:q-1', 2.0, (100, 100)) is None
+    assert engine.resets == 2
+    assert engine.wraps == 0
+    # The reset sample is the new baseline
+    assert engine.update('queue:q-1', 3.0, (200, 300)) == (800.0, 1600.0)
+
+def test_drop_near_the_width_beyond_the_last_rate_is_a_reset():
+    engine = RateEngine()
+    engine.update('iface:ether1', 0.0, (2 ** 32 - 10 ** 6, 0))
+    engine.update('iface:ether1', 1.0, (2 ** 32 - 10 ** 6 + 10, 0))
+    # 10 B/s last time, so a million bytes in a second is not a wrap
+    assert engine.update('iface:ether1', 2.0, (10 ** 6, 0)) is None
+    assert engine.resets == 1
+
+def test_uptime_going_back_forgets_previous_counters():
+    engine = RateEngine()
+    engine.observe_uptime(1000)
+    engine.update('iface:ether1', 0.0, (5000, 5000))
+    engine.observe_uptime(5)
+    assert engine.reboots == 1
+    assert engine.update('iface:ether1', 1.0, (10, 10)) is None
+    assert engine.resets == 0
+
+def test_average_is_smoothed():
+    engine = RateEngine(alpha=0.5)
+    engine.update('iface:ether1', 0.0, (0, 0))
+    engine.update('iface:ether1', 1.0, (100, 0))
+    engine.update('iface:ether1', 2.0, (300, 0))
+    rate, = engine.snapshot('iface')
+    assert rate.rx == 1600
+    assert rate.rx_avg == pytest.approx((800 + 1600) / 2)
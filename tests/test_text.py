@@ -0,0 +1,75 @@
+import time
+
+from app import Paged, ResultPages, split_text, utf16_len
+
+def test_utf16_len_counts_astral_characters_twice():
+    assert utf16_len('abc') == 3
+    assert utf16_len('é') == 1
+    assert utf16_len('🔥') == 2
+    assert utf16_len('📶 ok') == 5
+
+def test_short_text_is_one_chunk():
+    assert split_text('') == ['']
+    assert split_text('hello') == ['hello']
+
+def test_chunks_prefer_line_breaks():
+    text = '\n'.join(['x' * 30] * 10)
+    chunks = split_text(text, limit=100)
+    assert all(utf16_len(chunk) <= 100 for chunk in chunks)
+    assert all(line == 'x' * 30 for chunk in chunks for line in chunk.split('\n'))
+    assert '\n'.join(chunks) == text
+
+def test_chunks_are_measured_in_utf16_units():
+    text = '🔥' * 3000
+    chunks = split_text(text)
+    assert [utf16_len(chunk) for chunk in chunks] == [4096, 1904]
+    assert ''.join(chunks) == text
+
+def test_surrogate_pair_is_never_split():
+    text = 'a' + '🔥' * 10
+    chunks = split_text(text, limit=4)
+    assert chunks == ['a🔥', '🔥🔥'] + ['🔥🔥'] * 3 + ['🔥']
+    assert ''.join(chunks) == text
+
+def test_pages_and_headers():
+    paged = Paged('Devices:', [f"item {n}" for n in range(25)], 10)
+    assert paged.pages == 3
+    assert paged.render(0).splitlines()[:3] == ['Devices · page 1/3', '', 'item 0']
+    assert paged.render(2).splitlines()[2:] == [f"item {n}" for n in range(20, 25)]
+    assert str(paged).endswith('item 9\n... and 15 more')
+    assert Paged('Devices:', ['a'], 10).render(0) == 'Devices:\n\na'
+
+def test_page_is_cut_at_a_whole_item_within_the_utf16_limit():
+    paged = Paged('Queues:', ['📶' * 40 + f" {n}" for n in range(60)], 60)
+    text = paged.render(0)
+    assert utf16_len(text) <= 4096
+    assert text.splitlines()[-1].endswith(' 47')
+    # Counting Python characters, the same page would have looked short enough
+    assert len(text) + len('📶' * 40 + ' 48') < 4096
+
+def test_one_oversized_item_is_cut():
+    text = Paged('Log:', ['🔥' * 5000], 10).render(0)
+    assert 4000 < utf16_len(text) <= 4096
+
+def test_cursor_is_per_chat_and_expires():
+    store = ResultPages(ttl=0.05, capacity=10)
+    paged = Paged('Devices:', ['a', 'b', 'c'], 1)
+    cursor = store.open(1, paged)
+    assert store.get(1, cursor) is paged
+    assert store.get(2, cursor) is None
+    time.sleep(0.1)
+    assert store.get(1, cursor) is None
+    assert store.stats() == {'open': 0, 'opened': 1, 'turns': 1, 'expired': 2}
+
+def test_oldest_cursors_are_dropped_at_capacity():
+    store = ResultPages(ttl=60, capacity=2)
+    cursors = [store.open(1, Paged('T', [str(n)], 1)) for n in range(3)]
+    assert store.get(1, cursors[0]) is None
+    assert store.get(1, cursors[2]).items == ['2']
+
+def test_keyboard_shows_only_possible_turns():
+    store = ResultPages()
+    first, = store.keyboard('ab', 0, 3)['inline_keyboard']
+    assert [b['text'] for b in first] == ['1/3', '▶']
+    middle, = store.keyboard('ab', 1, 3)['inline_keyboard']
+    assert [b['callback_data'] for b in middle] == ['pg:ab:0', 'pg:noop', 'pg:ab:2']